@@ -1,6 +1,10 @@
+import json
 import os
 import sys
 import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pytest
 
@@ -35,7 +39,7 @@ def app():
     yield app
 
     # clean up / reset resources here
-
+    db.pool.dispose(db_path)
     os.close(db_fd)
     os.unlink(db_path)
 
@@ -49,3 +53,61 @@ def client(app):
 @pytest.fixture()
 def runner(app):
     return app.test_cli_runner()
+
+
+class ProviderStub:
+    # Local HTTP server standing in for the Google and Facebook OAuth endpoints in tests.
+    # routes maps a path to (status, headers, body) where body is dumped to JSON. delays maps a path to the seconds to
+    # wait before responding. requests records the paths requested.
+
+    def __init__(self):
+        self.routes = {}
+        self.delays = {}
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.respond()
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self.respond()
+
+            def respond(self):
+                path = self.path.split('?')[0]
+                stub.requests.append(path)
+                time.sleep(stub.delays.get(path, 0))
+                status, headers, body = stub.routes.get(path, (404, {}, {'error': 'not found'}))
+                data = json.dumps(body).encode('utf8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server.server_port, path)
+
+    def count(self, path):
+        return self.requests.count(path)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture()
+def provider_stub():
+    stub = ProviderStub()
+    yield stub
+    stub.close()
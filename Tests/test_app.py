@@ -11,8 +11,10 @@ import pytest
 
 sys.path.append(os.path.join(sys.path[0], '..'))
 
+import db
 import user
 import post
+import refresh_tokens
 
 GOOGLE_DISCOVERY_URL = (
     "https://accounts.google.com/.well-known/openid-configuration"
@@ -72,6 +74,196 @@ def test_index(client, app):
     assert response.status_code == 200
 
 
+def test_index_pagination(client, app):
+    token = generate_mock_user_token(app, 1)
+    response = client.get('/',
+                          query_string={'page': '2', 'perpage': '3'},
+                          headers={'Authorization': 'Bearer {}'.format(token)})
+    assert response.status_code == 200
+    posts = response.get_json()['posts']
+    # Page 2 skips the three most recent posts (by user 6) and starts at the latest posts by user 5.
+    assert [(p['author_id'], p['title']) for p in posts] == [(5, 'Post 6'), (5, 'Post 5'), (5, 'Post 4')]
+
+    # A page past the last post is empty.
+    response = client.get('/',
+                          query_string={'page': '10', 'perpage': '5'},
+                          headers={'Authorization': 'Bearer {}'.format(token)})
+    assert response.get_json()['posts'] == []
+
+    # Huge values don't overflow the query: perpage is capped and a page far past the end is empty.
+    response = client.get('/',
+                          query_string={'page': '99999999999999999999', 'perpage': '99999999999999999999'},
+                          headers={'Authorization': 'Bearer {}'.format(token)})
+    assert response.status_code == 200
+    assert response.get_json()['posts'] == []
+    response = client.get('/',
+                          query_string={'perpage': '99999999999999999999'},
+                          headers={'Authorization': 'Bearer {}'.format(token)})
+    assert len(response.get_json()['posts']) == 18
+    response = client.get('/search', query_string={'q': 'post', 'page': '99999999999999999999'},
+                          headers={'Authorization': 'Bearer {}'.format(token)})
+    assert response.status_code == 200
+
+
+def test_index_next_token(client, app):
+    token = generate_mock_user_token(app, 1)
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+    response = client.get('/', query_string={'perpage': '4'}, headers=headers)
+    data = response.get_json()
+    seen = [(p['author_id'], p['title']) for p in data['posts']]
+
+    # A post created while paging does not shift the following pages.
+    client.post('/create', headers=dict(headers, **{'Content-Type': 'application/json'}),
+                data=json.dumps(dict(title='ValidTitle', body='ValidBody')))
+
+    # Follow the next page links until the last page.
+    while data['next_page']:
+        response = client.get(data['next_page'], headers=headers)
+        assert response.status_code == 200
+        data = response.get_json()
+        seen += [(p['author_id'], p['title']) for p in data['posts']]
+    assert data['next'] is None
+    # All 18 posts from data.sql are seen once each, most recent first.
+    assert len(seen) == 18
+    assert len(set(seen)) == 18
+    assert seen[0] == (6, 'Post 3')
+    assert seen[-1] == (1, 'Post 1')
+
+    # Tokens that were not issued by the server are rejected.
+    response = client.get('/', query_string={'next': 'forged'}, headers=headers)
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('path', ['/', '/1/posts', '/1/posts/1', '/1/posts/1/likes'])
+def test_conditional_get(client, app, path):
+    token = generate_mock_user_token(app, 3)
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+    response = client.get(path, headers=headers)
+    etag = response.headers['ETag']
+
+    # The client already has the latest version.
+    response = client.get(path, headers=dict(headers, **{'If-None-Match': etag}))
+    assert response.status_code == 304
+    assert response.data == b''
+
+    # Unliking post 1 changes every resource.
+    client.delete('/1/posts/1/like', headers=headers)
+    response = client.get(path, headers=dict(headers, **{'If-None-Match': etag}))
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+    # So does updating the info of its author.
+    etag = response.headers['ETag']
+    author_headers = {'Authorization': 'Bearer {}'.format(generate_mock_user_token(app, 1)),
+                      'Content-Type': 'application/json'}
+    client.patch('/updateinfo', headers=author_headers, data=json.dumps(dict(name='NewName', occupation='Student')))
+    response = client.get(path, headers=dict(headers, **{'If-None-Match': etag}))
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_search(client, app):
+    token = generate_mock_user_token(app, 1)
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+    response = client.get('/search', query_string={'q': 'body post', 'perpage': '5'}, headers=headers)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert len(data['posts']) == 5
+    assert '<mark>Body</mark>' in data['posts'][0]['snippet']
+    assert data['posts'][0]['likes']
+
+    # Follow the pages to the end. Every post of data.sql matches once.
+    seen = [p['post_id'] for p in data['posts']]
+    while data['next_page']:
+        data = client.get(data['next_page'], headers=headers).get_json()
+        seen += [p['post_id'] for p in data['posts']]
+    assert sorted(seen) == list(range(1, 19))
+
+    # Words are matched, including new posts, and a title match comes first.
+    client.post('/create', headers=dict(headers, **{'Content-Type': 'application/json'}),
+                data=json.dumps(dict(title='Gardening', body='Post about running and gardens')))
+    client.post('/create', headers=dict(headers, **{'Content-Type': 'application/json'}),
+                data=json.dumps(dict(title='Weekend', body='I went gardening')))
+    data = client.get('/search', query_string={'q': 'garden'}, headers=headers).get_json()
+    assert [p['title'] for p in data['posts']] == ['<mark>Gardening</mark>', 'Weekend']
+
+    # Query syntax is searched as text.
+    for query in ['body -post', 'NOT', '"', 'post*', 'title:x']:
+        assert client.get('/search', query_string={'q': query}, headers=headers).status_code == 200
+    assert client.get('/search', query_string={'q': 'nomatch'}, headers=headers).get_json()['posts'] == []
+    assert client.get('/search', query_string={'q': ' '}, headers=headers).status_code == 400
+    assert client.get('/search', query_string={'q': '\x00'}, headers=headers).status_code == 400
+    assert client.get('/search', query_string={'q': 'garden\x00ing\x1f'}, headers=headers).status_code == 200
+
+    # The text of posts is escaped; only the marks are HTML.
+    client.post('/create', headers=dict(headers, **{'Content-Type': 'application/json'}),
+                data=json.dumps(dict(title='<script>alert(1)</script> tulip',
+                                     body='<img src=x onerror=alert(1)> tulip')))
+    result = client.get('/search', query_string={'q': 'tulip'}, headers=headers).get_json()['posts'][0]
+    assert result['title'] == '&lt;script&gt;alert(1)&lt;/script&gt; <mark>tulip</mark>'
+    assert result['snippet'] == '&lt;img src=x onerror=alert(1)&gt; <mark>tulip</mark>'
+    assert client.get('/search').status_code == 401
+
+
+def test_token_header(client, app):
+    assert client.get('/info', headers={'Authorization': 'Bearer'}).status_code == 401
+    assert client.get('/info', headers={'Authorization': 'Bearer '}).status_code == 401
+    token = generate_mock_user_token(app, 1)
+    assert client.get('/info', headers={'Authorization': 'Bearer {}'.format(token)}).status_code == 200
+
+
+def test_token_refresh(client, app):
+    with app.app_context():
+        refresh_token = refresh_tokens.issue(1)
+
+    response = client.post('/token/refresh', json={'refresh_token': refresh_token})
+    assert response.status_code == 200
+    data = response.get_json()
+    assert client.get('/info', headers={'Authorization': 'Bearer {}'.format(data['token'])}).status_code == 200
+
+    # A refresh token can only be used once.
+    assert client.post('/token/refresh', json={'refresh_token': refresh_token}).status_code == 401
+    assert client.post('/token/refresh', json={'refresh_token': data['refresh_token']}).status_code == 401
+    assert client.post('/token/refresh', json={}).status_code == 400
+
+    with app.app_context():
+        refresh_token = refresh_tokens.issue(1)
+    assert client.post('/token/revoke', json={'refresh_token': refresh_token}).status_code == 200
+    assert client.post('/token/refresh', json={'refresh_token': refresh_token}).status_code == 401
+    assert client.post('/token/revoke', data='x').status_code == 400
+
+
+def test_likes_to_display(client, app):
+    token = generate_mock_user_token(app, 1)
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+    response = client.get('/1/posts/4', headers=headers)
+    assert response.get_json()['likes'] == 'valid_gg_user2 liked this post.'
+    response = client.get('/1/posts/5', headers=headers)
+    assert response.get_json()['likes'] == 'No one has liked this post yet.'
+
+    response = client.get('/1/posts', headers=headers)
+    likes = {p['title']: p['likes'] for p in response.get_json()['posts']}
+    assert likes['Post 1'].endswith(' and 2 other people liked this post.')
+    assert likes['Post 2'].endswith(' and 1 other people liked this post.')
+    assert likes['Post 3'].endswith(' liked this post.')
+
+
+def test_user_loaded_once(client, app, monkeypatch):
+    calls = []
+    get = user.get
+
+    def counting_get(user_id):
+        calls.append(user_id)
+        return get(user_id)
+
+    monkeypatch.setattr(user, 'get', counting_get)
+    token = generate_mock_user_token(app, 1)
+    response = client.get('/1/posts/1', headers={'Authorization': 'Bearer {}'.format(token)})
+    assert response.status_code == 200
+    # Only the authenticated user is loaded; the author is known from the post.
+    assert calls == [1]
+
+
 def test_info(client, app):
     # Invalid token provided
     response = client.get('/info')
@@ -253,6 +445,174 @@ def test_create(client, app):
     assert response.status_code == 400
 
 
+def test_create_batch(client, app, monkeypatch):
+    assert client.post('/create/batch').status_code == 401
+    token = generate_mock_user_token(app, 2)
+    response = client.post('/create/batch', headers={'Authorization': 'Bearer {}'.format(token)}, json=[])
+    assert response.status_code == 403
+
+    token = generate_mock_user_token(app, 3)
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+    # Every post is valid.
+    posts = [dict(title='Batch {}'.format(i), body='Body {}'.format(i)) for i in range(50)]
+    response = client.post('/create/batch', headers=headers, json=posts)
+    assert response.status_code == 201
+    assert response.get_json()['created'] == 50
+    data = client.get('/3/posts', query_string={'perpage': '50'}, headers=headers).get_json()
+    assert len(data['posts']) == 50
+
+    # Some posts are invalid: the valid ones are created and each result says what went wrong.
+    posts = [dict(title='Valid', body='Body'), dict(title='', body='Body'), dict(title='Valid'), 'post',
+             dict(title=1, body=2)]
+    response = client.post('/create/batch', headers=headers, json=posts)
+    assert response.status_code == 207
+    data = response.get_json()
+    assert (data['created'], data['failed']) == (1, 4)
+    assert [result['status'] for result in data['results']] == [201, 400, 400, 400, 400]
+    assert data['results'][2]['message'].startswith('Post body cannot be empty.')
+
+    # One post per line.
+    lines = '{"title": "Line 1", "body": "Body"}\n\nnot json\n{"title": "Line 2", "body": "Body"}\n'
+    response = client.post('/create/batch', headers=dict(headers, **{'Content-Type': 'application/x-ndjson'}),
+                           data=lines)
+    assert response.status_code == 207
+    assert [result['status'] for result in response.get_json()['results']] == [201, 400, 201]
+
+    # No post is valid.
+    response = client.post('/create/batch', headers=headers, json=[dict(title='')])
+    assert response.status_code == 400
+    assert response.get_json()['created'] == 0
+    response = client.post('/create/batch', headers=headers, json=dict(title='Not a list', body='Body'))
+    assert response.status_code == 400
+
+    monkeypatch.setitem(app.config, 'BATCH_CREATE_MAX_POSTS', 2)
+    response = client.post('/create/batch', headers=headers, json=posts)
+    assert response.status_code == 413
+
+
+def test_like_batch(client, app, monkeypatch):
+    assert client.post('/likes/batch').status_code == 401
+    token = generate_mock_user_token(app, 2)
+    response = client.post('/likes/batch', headers={'Authorization': 'Bearer {}'.format(token)}, json=[])
+    assert response.status_code == 403
+
+    token = generate_mock_user_token(app, 3)
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+    # User 3 has liked posts 1, 2 and 3.
+    items = [dict(post_id=5, action='like'), dict(post_id=1, action='unlike'), dict(post_id=6, action='like')]
+    response = client.post('/likes/batch', headers=headers, json=items)
+    assert response.status_code == 200
+    assert [result['status'] for result in response.get_json()['results']] == [201, 200, 201]
+    with app.app_context():
+        assert post.is_liked(3, 5) and post.is_liked(3, 6) and not post.is_liked(3, 1)
+
+    items = [dict(post_id=2, action='like'), dict(post_id=1, action='unlike'), dict(post_id=9999, action='like'),
+             dict(post_id='2', action='like'), dict(post_id=2, action='share'), 'like', dict(post_id=2, action='unlike'),
+             dict(post_id=2, action=['like']), dict(post_id=2, action={'like': 1})]
+    response = client.post('/likes/batch', headers=headers, json=items)
+    assert response.status_code == 207
+    data = response.get_json()
+    assert [result['status'] for result in data['results']] == [400, 400, 404, 404, 400, 400, 200, 400, 400]
+    assert (data['succeeded'], data['failed']) == (1, 8)
+
+    response = client.post('/likes/batch', headers=headers, json=[dict(post_id=2, action='unlike')])
+    assert response.status_code == 400
+    response = client.post('/likes/batch', headers=headers, json=dict(post_id=2, action='like'))
+    assert response.status_code == 400
+
+    monkeypatch.setitem(app.config, 'LIKE_BATCH_MAX_ITEMS', 2)
+    response = client.post('/likes/batch', headers=headers, json=items)
+    assert response.status_code == 413
+
+
+def read_ndjson(response):
+    assert response.mimetype == 'application/x-ndjson'
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_ndjson(client, app):
+    token = generate_mock_user_token(app, 1)
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+
+    # All posts of an author, the same as on the pages.
+    response = client.get('/5/posts', query_string={'format': 'ndjson'}, headers=headers)
+    assert response.status_code == 200
+    page = client.get('/5/posts', query_string={'perpage': '10'}, headers=headers).get_json()
+    assert read_ndjson(response) == page['posts']
+    response = client.get('/5/posts', headers=dict(headers, Accept='application/x-ndjson'))
+    assert read_ndjson(response) == page['posts']
+    response = client.get('/9999/posts', query_string={'format': 'ndjson'}, headers=headers)
+    assert response.status_code == 404
+
+    # Users who liked a post.
+    response = client.get('/1/posts/1/likes', query_string={'format': 'ndjson'}, headers=headers)
+    likes = client.get('/1/posts/1/likes', headers=headers).get_json()
+    assert read_ndjson(response) == likes['users']
+    response = client.get('/6/posts/1/likes', query_string={'format': 'ndjson'}, headers=headers)
+    assert response.status_code == 404
+
+    # The whole site, one table at a time.
+    posts = read_ndjson(client.get('/export', query_string={'table': 'post'}, headers=headers))
+    likes = read_ndjson(client.get('/export', query_string={'table': 'like'}, headers=headers))
+    assert [record['id'] for record in posts] == list(range(1, 19))
+    assert set(posts[0]) == {'id', 'author_id', 'created', 'title', 'body'}
+    assert posts[0]['body'] == 'Body of post 1'
+    assert len(likes) == 10
+    assert likes[0] == {'post_id': 1, 'user_id': 1, 'created': '2022-06-20 00:00:00'}
+    assert client.get('/export', headers=headers).status_code == 400
+    assert client.get('/export', query_string={'table': 'user'}, headers=headers).status_code == 400
+    assert client.get('/export', query_string={'table': 'post'}).status_code == 401
+
+
+def test_export_import(client, app, runner, tmp_path):
+    # An export can be loaded back with "flask import-data".
+    headers = {'Authorization': 'Bearer {}'.format(generate_mock_user_token(app, 1))}
+    exports = {}
+    for table in ('post', 'like'):
+        response = client.get('/export', query_string={'table': table}, headers=headers)
+        exports[table] = tmp_path / '{}.ndjson'.format(table)
+        exports[table].write_bytes(response.get_data())
+    with app.app_context():
+        db_ = db.get_db()
+        db_.execute('DELETE FROM like')
+        db_.execute('DELETE FROM post')
+        db_.commit()
+
+    for table in ('post', 'like'):
+        result = runner.invoke(args=['import-data', table, str(exports[table])])
+        assert result.exit_code == 0, result.output
+        response = client.get('/export', query_string={'table': table}, headers=headers)
+        assert response.get_data() == exports[table].read_bytes()
+    assert client.get('/', headers=headers).status_code == 200
+
+
+def test_ndjson_vary(client, app):
+    # Both variants of a resource say they depend on Accept, so a cache doesn't send one in place of the other.
+    headers = {'Authorization': 'Bearer {}'.format(generate_mock_user_token(app, 1))}
+    ndjson_headers = dict(headers, Accept='application/x-ndjson')
+    for path in ('/5/posts', '/1/posts/1/likes'):
+        json_response = client.get(path, headers=headers)
+        assert 'Accept' in json_response.headers['Vary']
+        assert 'Accept' in client.get(path, headers=ndjson_headers).headers['Vary']
+        response = client.get(path, headers=dict(headers, **{'If-None-Match': json_response.headers['ETag']}))
+        assert response.status_code == 304
+        assert 'Accept' in response.headers['Vary']
+    assert 'Accept' in client.get('/export', query_string={'table': 'like'}, headers=headers).headers['Vary']
+
+
+def test_user_posts_pagination(client, app):
+    token = generate_mock_user_token(app, 1)
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+    response = client.get('/5/posts', query_string={'perpage': '4'}, headers=headers)
+    data = response.get_json()
+    assert [p['title'] for p in data['posts']] == ['Post 6', 'Post 5', 'Post 4', 'Post 3']
+
+    response = client.get(data['next_page'], headers=headers)
+    data = response.get_json()
+    assert [p['title'] for p in data['posts']] == ['Post 2', 'Post 1']
+    assert data['next_page'] is None
+
+
 # Creating a class to have methods share the same parametrized arguments
 # Name of class need to start with Test for pytest to detect it
 @pytest.mark.parametrize('author_id', ['1', '6', '9999', 'abcd'])
@@ -307,7 +667,7 @@ class TestParameterize:
         if user.get(author_id) and (post_ is not None):
             author_id = int(author_id)
             # If author didn't write post
-            if author_id != post_[4]:
+            if author_id != post_.author_id:
                 assert response.status_code == 404
             # If author wrote the post
             else:
@@ -344,7 +704,7 @@ class TestParameterize:
             if user.get(author_id) and (post_ is not None):
                 author_id = int(author_id)
                 # If author didn't write post
-                if author_id != post_[4]:
+                if author_id != post_.author_id:
                     assert response.status_code == 404
                 # If author wrote the post
                 else:
@@ -386,7 +746,7 @@ class TestParameterize:
             if user.get(author_id) and (post_ is not None):
                 author_id = int(author_id)
                 # If author didn't write post
-                if author_id != post_[4]:
+                if author_id != post_.author_id:
                     assert response.status_code == 404
                 # If author wrote the post
                 else:
@@ -424,7 +784,7 @@ class TestParameterize:
         if user.get(author_id) and (post_ is not None):
             author_id = int(author_id)
             # If author didn't write post
-            if author_id != post_[4]:
+            if author_id != post_.author_id:
                 assert response.status_code == 404
             # If author wrote the post
             else:
@@ -0,0 +1,60 @@
+import datetime
+import sys
+import os
+import time
+
+import jwt
+import pytest
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+import auth
+import user
+from auth import TokenCache
+
+
+def make_token(app, user_id, seconds=60):
+    return jwt.encode({'id': user_id, 'exp': datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)},
+                      app.config['SECRET_KEY'])
+
+
+def test_authenticate(app):
+    cache = TokenCache()
+    token = make_token(app, 1)
+    with app.app_context():
+        claims, user_ = cache.authenticate(token)
+        assert claims['id'] == 1
+        assert user_.name == 'valid_gg_user'
+        assert cache.authenticate(token)[1] is user_
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['size']) == (1, 1, 1)
+        assert stats['verify_seconds'] > 0
+        assert stats['saved_seconds'] > 0
+
+        # Unknown users and invalid tokens are not cached.
+        assert cache.authenticate(make_token(app, 9999))[1] is None
+        with pytest.raises(jwt.exceptions.InvalidTokenError):
+            cache.authenticate(token + 'x')
+        assert cache.stats()['size'] == 1
+
+
+def test_user_change(app):
+    token = make_token(app, 1)
+    with app.app_context():
+        auth.token_cache.authenticate(token)
+        user.update(1, 'NewName', '', 'Student')
+        hits = auth.token_cache.stats()['hits']
+        assert auth.token_cache.authenticate(token)[1].name == 'NewName'
+        assert auth.token_cache.stats()['hits'] == hits
+
+
+def test_expiry(app):
+    # Entries are not kept after their token expires. PyJWT compares exp with the current second, so a token is
+    # rejected a second after exp.
+    cache = TokenCache()
+    token = make_token(app, 1, seconds=1)
+    with app.app_context():
+        cache.authenticate(token)
+        time.sleep(2.1)
+        with pytest.raises(jwt.exceptions.ExpiredSignatureError):
+            cache.authenticate(token)
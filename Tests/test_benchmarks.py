@@ -0,0 +1,105 @@
+import sys
+import os
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+sys.path.append(os.path.join(sys.path[0], '..', 'benchmarks'))
+
+import sqlite3
+
+import click
+import pytest
+
+import bench
+import datagen
+import feed_cache
+import loadtest
+import oauth
+import user
+from db import pool
+
+
+def test_generate(tmp_path):
+    path = str(tmp_path / 'bench.sqlite')
+    datagen.generate(path, 50, 400, 2000, seed=1)
+
+    db = sqlite3.connect(path)
+    assert db.execute('SELECT COUNT(*) FROM user').fetchone()[0] == 50
+    assert db.execute('SELECT COUNT(*) FROM post').fetchone()[0] == 400
+    assert db.execute('SELECT COUNT(*) FROM like').fetchone()[0] == 2000
+    # The counters and the search index are built as with any import.
+    assert db.execute('SELECT SUM(like_count) FROM post').fetchone()[0] == 2000
+    assert db.execute("SELECT COUNT(*) FROM post_fts WHERE post_fts MATCH 'blog'").fetchone()[0] > 0
+    # Likes are skewed: the 1% most liked posts have far more than their share of likes.
+    top = db.execute('SELECT SUM(like_count) FROM (SELECT like_count FROM post ORDER BY like_count DESC LIMIT 4)')
+    assert top.fetchone()[0] > 2000 * 0.05
+    rows = db.execute('SELECT * FROM like ORDER BY post_id, user_id').fetchall()
+    db.close()
+
+    # The same seed gives the same data.
+    other = str(tmp_path / 'other.sqlite')
+    datagen.generate(other, 50, 400, 2000, seed=1)
+    db = sqlite3.connect(other)
+    assert db.execute('SELECT * FROM like ORDER BY post_id, user_id').fetchall() == rows
+    db.close()
+
+
+def test_compare():
+    baselines = {'results': {'small': {'feed': {'p95': 2.0}, 'search': {'p95': 5.0}}}}
+    results = {'small': {'feed': {'p95': 2.4}, 'search': {'p95': 7.0}, 'new': {'p95': 1.0}},
+               'medium': {'feed': {'p95': 9.0}}}
+    assert bench.compare(results, baselines, 0.25) == [('small', 'search', 5.0, 7.0)]
+    assert bench.percentile([1, 2, 3, 4], 0.5) == 2
+    assert bench.percentile([1, 2, 3, 4], 0.99) == 4
+
+
+def test_loadtest_helpers():
+    assert loadtest.parse_mix('feed=50, like=20') == {'feed': 50.0, 'like': 20.0}
+    with pytest.raises(click.BadParameter):
+        loadtest.parse_mix('feed=50,delete=1')
+    with pytest.raises(click.BadParameter):
+        loadtest.parse_mix('feed=0')
+    assert loadtest.parse_overrides(['SQLITE_BUSY_TIMEOUT=0', 'SQLITE_JOURNAL_MODE=DELETE']) == \
+        {'SQLITE_BUSY_TIMEOUT': 0, 'SQLITE_JOURNAL_MODE': 'DELETE'}
+
+    stats = loadtest.Stats()
+    for elapsed, status in ((0.0005, 200), (0.003, 200), (0.003, 500), (9, 'connection error')):
+        stats.add(elapsed, status, status == 200)
+    summary = stats.summary()
+    assert summary['requests'] == 4
+    assert summary['error_rate'] == 0.5
+    assert summary['histogram'][0] == 1
+    assert summary['histogram'][2] == 2
+    assert summary['histogram'][-1] == 1
+
+
+def test_run_size_context(app, monkeypatch):
+    # Requests are sent outside of any app context, so each one takes a connection from the pool and gives it back,
+    # as in production.
+    monkeypatch.setattr(datagen, 'ensure', lambda size, seed, echo: app.config['DATABASE'])
+    # run_size copies the file, so the test data must be in it rather than in the WAL.
+    pool.dispose(app.config['DATABASE'])
+    before = pool.stats()
+    results = bench.run_size('tiny', ['post_details'], 5, 1, 0, lambda message: None)
+    after = pool.stats()
+    assert results['post_details']['requests'] == 5
+    assert after['reused'] - before['reused'] >= 5
+    assert after['in_use'] == before['in_use']
+
+
+def test_loadtest_configure(app, monkeypatch):
+    # Overrides reach the parts of the app that read them when it is set up.
+    overrides = {'USER_CACHE_SIZE': 7, 'OAUTH_RETRIES': 5, 'OAUTH_DISCOVERY_TTL': 11, 'FEED_CACHE_TTL': 13}
+    for key, value in overrides.items():
+        monkeypatch.setitem(app.config, key, value)
+    client = oauth.client
+    try:
+        loadtest.configure(app, app.config['DATABASE'], overrides)
+        assert user._cache.maxsize == 7
+        assert oauth.client.retries == 5
+        assert oauth.discovery_cache.ttl == 11
+        assert feed_cache.feed_cache.ttl == 13
+    finally:
+        monkeypatch.undo()
+        loadtest.configure(app, app.config['DATABASE'], {})
+        # The client of the app also has pools for the hosts of the providers.
+        oauth.client = client
@@ -0,0 +1,46 @@
+import sys
+import os
+import time
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+from cache import TTLCache
+
+
+def test_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    # Reading 'a' makes 'b' the least recently used entry.
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['size'] == 2
+    assert stats['hits'] == 3
+    assert stats['misses'] == 1
+
+
+def test_ttl_expiration():
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set('a', 1, ttl=0.01)
+    cache.set('b', 2)
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert cache.stats()['expirations'] == 1
+
+
+def test_disabled():
+    cache = TTLCache(maxsize=0)
+    cache.set('a', 1)
+    assert cache.get('a') is None
+
+    cache = TTLCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.configure(1, 60)
+    assert cache.stats()['size'] == 1
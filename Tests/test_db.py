@@ -1,7 +1,10 @@
+import json
+import os
 import sqlite3
 
 import pytest
 import db
+from conftest import _data_sql
 
 
 def test_get_close_db(app):
@@ -9,12 +12,39 @@ def test_get_close_db(app):
         db_ = db.get_db()
         assert db_ is db.get_db()
 
+    # The connection is given back to the pool and reused by the next app context.
+    with app.app_context():
+        assert db.get_db() is db_
+        assert db.get_db().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    # It is closed when the pool is full.
+    app.config['SQLITE_POOL_SIZE'] = 0
+    db.pool.dispose()
+    with app.app_context():
+        db_ = db.get_db()
+    app.config.pop('SQLITE_POOL_SIZE')
+
     with pytest.raises(sqlite3.ProgrammingError) as e:
         db_.execute('SELECT 1')
 
     assert 'closed' in str(e.value)
 
 
+def test_pool_stats(app):
+    db.pool.dispose()
+    stats = db.pool.stats()
+    with app.app_context():
+        db.get_db()
+        assert db.pool.stats()['in_use'] == stats['in_use'] + 1
+    with app.app_context():
+        db.get_db()
+    new_stats = db.pool.stats()
+    assert new_stats['opened'] == stats['opened'] + 1
+    assert new_stats['reused'] == stats['reused'] + 1
+    assert new_stats['idle'] == 1
+    assert new_stats['in_use'] == stats['in_use']
+
+
 def test_init_db_command(runner, monkeypatch):
     class Recorder(object):
         called = False
@@ -26,3 +56,240 @@ def test_init_db_command(runner, monkeypatch):
     result = runner.invoke(args=['init-db'])
     assert 'Initialized' in result.output
     assert Recorder.called
+
+
+def test_like_count_triggers(app):
+    with app.app_context():
+        db_ = db.get_db()
+        assert db_.execute('SELECT like_count FROM post WHERE id = 1').fetchone()[0] == 4
+        db_.execute('DELETE FROM like WHERE post_id = 1 AND user_id = 1')
+        db_.execute('INSERT INTO like (post_id, user_id) VALUES (5, 1)')
+        assert db_.execute('SELECT like_count FROM post WHERE id = 1').fetchone()[0] == 3
+        assert db_.execute('SELECT like_count FROM post WHERE id = 5').fetchone()[0] == 1
+
+
+def test_rebuild_like_counts_command(app, runner):
+    with app.app_context():
+        db_ = db.get_db()
+        db_.execute('UPDATE post SET like_count = 100 WHERE id IN (1, 5)')
+        db_.commit()
+
+    result = runner.invoke(args=['rebuild-like-counts', '--verify-only'])
+    assert 'Found 2 post(s)' in result.output
+    assert result.exit_code == 1
+
+    result = runner.invoke(args=['rebuild-like-counts'])
+    assert 'Fixed 2 post(s).' in result.output
+    assert result.exit_code == 0
+
+    with app.app_context():
+        assert db.find_like_count_mismatches() == []
+        assert db.get_db().execute('SELECT like_count FROM post WHERE id = 1').fetchone()[0] == 4
+
+
+def test_excerpts(app, runner):
+    with app.app_context():
+        db_ = db.get_db()
+        # Posts inserted without an excerpt get one from the triggers.
+        db_.execute("INSERT INTO post (author_id, title, body) VALUES (1, 'Long', ?)", ('x' * 150,))
+        db_.execute("UPDATE post SET body = 'Short' WHERE id = 1")
+        db_.commit()
+        # The triggers and the app keep the same length.
+        assert db_.execute("SELECT excerpt FROM post WHERE title = 'Long'").fetchone()[0] == 'x' * db.EXCERPT_LENGTH
+        assert db_.execute('SELECT excerpt FROM post WHERE id = 1').fetchone()[0] == 'Short'
+
+        db_.execute("UPDATE post SET excerpt = NULL WHERE id IN (1, 2)")
+        db_.execute("UPDATE post SET excerpt = 'Stale' WHERE id = 3")
+        db_.commit()
+
+    result = runner.invoke(args=['backfill-excerpts'])
+    assert 'Updated the excerpt of 3 post(s).' in result.output
+    with app.app_context():
+        assert db.get_db().execute('SELECT COUNT(*) FROM post WHERE excerpt IS NOT substr(body, 1, ?)',
+                                   (db.EXCERPT_LENGTH,)).fetchone()[0] == 0
+    result = runner.invoke(args=['backfill-excerpts'])
+    assert 'Updated the excerpt of 0 post(s).' in result.output
+
+
+def test_rebuild_search_index_command(app, runner):
+    with app.app_context():
+        db_ = db.get_db()
+        db_.execute("INSERT INTO post_fts (post_fts) VALUES ('delete-all')")
+        db_.commit()
+        assert db_.execute("SELECT COUNT(*) FROM post_fts WHERE post_fts MATCH 'body'").fetchone()[0] == 0
+
+    result = runner.invoke(args=['rebuild-search-index'])
+    assert 'Indexed 18 post(s).' in result.output
+    with app.app_context():
+        assert db.get_db().execute("SELECT COUNT(*) FROM post_fts WHERE post_fts MATCH 'body'").fetchone()[0] == 18
+
+
+def get_schema(db_):
+    # Returns the tables, indexes and triggers of a db and the columns of each table.
+    objects = db_.execute(
+        "SELECT type, name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%' ORDER BY type, name"
+    ).fetchall()
+    columns = {name: [row[1] for row in db_.execute('PRAGMA table_info({})'.format(name))]
+               for type_, name in objects if type_ == 'table'}
+    return [tuple(row) for row in objects], columns
+
+
+def test_migrate_db(app):
+    # Tests/schema.sql is the schema before any migration.
+    with open(os.path.join(os.path.dirname(__file__), 'schema.sql'), 'rb') as f:
+        _old_schema_sql = f.read().decode('utf8')
+
+    with app.app_context():
+        latest = db.get_migrations()[-1][0]
+        # init_db() creates the latest schema directly.
+        assert db.get_schema_version() == latest
+        expected = get_schema(db.get_db())
+
+        db_ = db.get_db()
+        db_.executescript(_old_schema_sql + ';PRAGMA user_version = 0;' + _data_sql)
+        applied = db.migrate_db()
+        assert len(applied) == latest
+        assert db.get_schema_version() == latest
+        # Migrating gives the same schema as init_db() and keeps the data.
+        assert get_schema(db_) == expected
+        assert db_.execute('SELECT COUNT(*) FROM post').fetchone()[0] == 18
+        assert db.find_like_count_mismatches() == []
+
+        # Nothing is left to apply.
+        assert db.migrate_db() == []
+
+
+def test_import_data_command(app, runner, tmp_path):
+    with app.app_context():
+        expected = get_schema(db.get_db())
+
+    users = tmp_path / 'users.csv'
+    users.write_text('id,name,email,phone,occupation,type\n'
+                     '100,Imported,imported@example.com,,Writer,Google\n'
+                     ',Second,second@example.com,123,,Facebook\n')
+    result = runner.invoke(args=['import-data', 'user', str(users)])
+    assert 'Imported 2 row(s) into user' in result.output
+
+    posts = tmp_path / 'posts.ndjson'
+    posts.write_text(''.join(json.dumps({'author_id': 100, 'title': 'Imported {}'.format(i), 'body': 'b' * 150}) + '\n'
+                             for i in range(5)))
+    result = runner.invoke(args=['import-data', 'post', str(posts), '--batch-size', '2'])
+    assert 'Imported 4 row(s) (' in result.output
+    assert 'Imported 5 row(s) into post' in result.output
+
+    likes = tmp_path / 'likes.csv'
+    likes.write_text('post_id,user_id,created\n19,1,\n19,100,2022-07-01 00:00:00\n')
+    result = runner.invoke(args=['import-data', 'like', str(likes)])
+    assert 'Imported 2 row(s) into like' in result.output
+
+    # A file is only imported once.
+    result = runner.invoke(args=['import-data', 'like', str(likes)])
+    assert result.exit_code != 0
+    assert 'already imported' in result.output
+
+    with app.app_context():
+        db_ = db.get_db()
+        # The indexes and triggers are back, and what they maintain is up to date.
+        assert get_schema(db_) == expected
+        assert db.find_like_count_mismatches() == []
+        assert db_.execute('SELECT excerpt FROM post WHERE id = 19').fetchone()[0] == 'b' * db.EXCERPT_LENGTH
+        assert db_.execute("SELECT COUNT(*) FROM post_fts WHERE post_fts MATCH 'imported'").fetchone()[0] == 5
+        assert db_.execute('SELECT id FROM user WHERE email = ?', ('second@example.com',)).fetchone()[0] == 101
+
+
+def test_import_data_resume(app, runner, tmp_path):
+    with app.app_context():
+        expected = get_schema(db.get_db())
+
+    # The third post has no title, so the import stops after the first batch.
+    rows = [{'author_id': 1, 'title': 'Imported {}'.format(i), 'body': 'Body'} for i in range(6)]
+    rows[2]['title'] = None
+    posts = tmp_path / 'posts.ndjson'
+    posts.write_text(''.join(json.dumps(row) + '\n' for row in rows))
+    result = runner.invoke(args=['import-data', 'post', str(posts), '--batch-size', '2'])
+    assert result.exit_code != 0
+    assert 'Could not import rows 3 to 4' in result.output
+    with app.app_context():
+        db_ = db.get_db()
+        assert db_.execute('SELECT COUNT(*) FROM post').fetchone()[0] == 20
+        # The indexes and triggers are back, and the imported rows are searchable.
+        assert get_schema(db_) == expected
+        assert db_.execute('SELECT COUNT(*) FROM import_deferred').fetchone()[0] == 0
+        assert db_.execute("SELECT COUNT(*) FROM post_fts WHERE post_fts MATCH 'imported'").fetchone()[0] == 2
+
+    # Once the file is fixed, the import continues after the rows already imported.
+    rows[2]['title'] = 'Imported 2'
+    posts.write_text(''.join(json.dumps(row) + '\n' for row in rows))
+    result = runner.invoke(args=['import-data', 'post', str(posts), '--batch-size', '2'])
+    assert 'Imported 4 row(s) into post' in result.output
+    with app.app_context():
+        db_ = db.get_db()
+        titles = [row[0] for row in db_.execute("SELECT title FROM post WHERE title LIKE 'Imported%' ORDER BY id")]
+        assert titles == ['Imported {}'.format(i) for i in range(6)]
+        assert get_schema(db_) == expected
+
+    # --restart imports it again.
+    result = runner.invoke(args=['import-data', 'post', str(posts), '--restart'])
+    assert 'Imported 6 row(s) into post' in result.output
+
+    bad = tmp_path / 'bad.ndjson'
+    bad.write_text('{"author_id": 1, "title": "T", "body": "B", "color": "red"}\n')
+    result = runner.invoke(args=['import-data', 'post', str(bad)])
+    assert 'Unknown column(s) for post: color' in result.output
+    with app.app_context():
+        assert get_schema(db.get_db()) == expected
+
+
+def test_import_data_failure(app, runner, tmp_path):
+    with app.app_context():
+        expected = get_schema(db.get_db())
+        revision = db.get_db().execute("SELECT value FROM revision WHERE name = 'feed'").fetchone()[0]
+
+    # The second batch likes post 17 twice, so the import stops after the first batch.
+    likes = tmp_path / 'likes.csv'
+    likes.write_text('post_id,user_id\n18,1\n18,2\n17,1\n17,1\n')
+    result = runner.invoke(args=['import-data', 'like', str(likes), '--batch-size', '2'])
+    assert result.exit_code != 0
+    assert 'Could not import rows 3 to 4' in result.output
+
+    with app.app_context():
+        db_ = db.get_db()
+        # The triggers are back and work, and the counters include the rows imported before the failure.
+        assert get_schema(db_) == expected
+        assert db.find_like_count_mismatches() == []
+        assert db_.execute('SELECT like_count FROM post WHERE id = 18').fetchone()[0] == 2
+        assert db_.execute("SELECT value FROM revision WHERE name = 'feed'").fetchone()[0] > revision
+        db_.execute('INSERT INTO like (post_id, user_id) VALUES (17, 1)')
+        db_.commit()
+        assert db_.execute('SELECT like_count FROM post WHERE id = 17').fetchone()[0] == 1
+        assert db.find_like_count_mismatches() == []
+
+
+def test_import_data_created(app, runner, tmp_path):
+    # Dates are stored in the form read back by the timestamp converter, in UTC.
+    rows = [{'author_id': 1, 'title': 'Iso', 'body': 'B', 'created': '2023-01-01T10:00:00Z'},
+            {'author_id': 1, 'title': 'Offset', 'body': 'B', 'created': '2023-01-01T12:00:00+02:00'},
+            {'author_id': 1, 'title': 'Http', 'body': 'B', 'created': 'Sun, 01 Jan 2023 10:00:00 GMT'},
+            {'author_id': 1, 'title': 'Plain', 'body': 'B', 'created': '2023-01-01 10:00:00'}]
+    posts = tmp_path / 'posts.ndjson'
+    posts.write_text(''.join(json.dumps(row) + '\n' for row in rows))
+    result = runner.invoke(args=['import-data', 'post', str(posts)])
+    assert 'Imported 4 row(s) into post' in result.output
+    with app.app_context():
+        stored = db.get_db().execute("SELECT DISTINCT CAST(created AS TEXT) FROM post WHERE body = 'B'").fetchall()
+        assert [row[0] for row in stored] == ['2023-01-01 10:00:00']
+        assert db.get_db().execute("SELECT created FROM post WHERE title = 'Iso'").fetchone()[0].hour == 10
+
+    # An invalid date stops the import before its batch is written.
+    bad = tmp_path / 'bad.csv'
+    bad.write_text('post_id,user_id,created\n5,1,2023-01-01 10:00:00\n6,1,yesterday\n')
+    result = runner.invoke(args=['import-data', 'like', str(bad)])
+    assert result.exit_code != 0
+    assert "Could not import row 2: created is 'yesterday'" in result.output
+    with app.app_context():
+        assert db.get_db().execute('SELECT COUNT(*) FROM like WHERE post_id IN (5, 6)').fetchone()[0] == 0
+
+
+def test_migrate_db_command(runner):
+    result = runner.invoke(args=['migrate-db'])
+    assert 'The database is at version' in result.output
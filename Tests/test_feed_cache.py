@@ -0,0 +1,110 @@
+import sys
+import os
+import threading
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+import feed_cache
+import post
+import user
+from db import get_db
+from feed_cache import FeedCache, FeedCacheBackend, MemoryBackend
+from test_app import generate_mock_user_token
+
+
+class SharedBackend(FeedCacheBackend):
+    # Stands in for a cache server shared by several processes.
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ttl):
+        self.data[key] = value
+
+    def incr(self, key):
+        self.data[key] = self.data.get(key, 0) + 1
+        return self.data[key]
+
+    def get_int(self, key):
+        return self.data.get(key, 0)
+
+
+def test_invalidate(app):
+    cache = FeedCache(MemoryBackend(), ttl=60)
+    with app.app_context():
+        version = cache.version(1)
+        assert cache.get(version, 'page') is None
+        cache.set(version, 'page', b'[]')
+        assert cache.get(cache.version(1), 'page') == b'[]'
+        # A new revision, or a new db, makes the page outdated.
+        assert cache.get(cache.version(2), 'page') is None
+
+        cache.invalidate()
+        assert cache.get(cache.version(1), 'page') is None
+        assert cache.stats() == {'hits': 1, 'misses': 3, 'invalidations': 1, 'hit_rate': 1 / 4}
+
+
+def test_concurrent_counters(app):
+    # No lookup is lost when threads update the counters at the same time.
+    cache = FeedCache(MemoryBackend(), ttl=60)
+
+    def lookup():
+        with app.app_context():
+            for _ in range(2000):
+                cache.get(0, 'page')
+
+    threads = [threading.Thread(target=lookup) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.stats()['misses'] == 16000
+
+
+def test_shared_backend(app):
+    # Replacing the db in one process makes the pages of every process outdated.
+    backend = SharedBackend()
+    first, second = FeedCache(backend), FeedCache(backend)
+    with app.app_context():
+        first.set(first.version(1), 'page', b'[]')
+        assert second.get(second.version(1), 'page') == b'[]'
+        second.invalidate()
+        assert first.get(first.version(1), 'page') is None
+
+
+def test_feed_pages_cached(client, app):
+    headers = {'Authorization': 'Bearer {}'.format(generate_mock_user_token(app, 1))}
+    first = client.get('/', headers=headers).get_json()
+    hits = feed_cache.feed_cache.stats()['hits']
+    assert client.get('/', headers=headers).get_json() == first
+    assert feed_cache.feed_cache.stats()['hits'] == hits + 1
+
+    # Each write shows on the next request.
+    with app.app_context():
+        post.insert_like(1, post.get_homepage(1)[0].id)
+    assert client.get('/', headers=headers).get_json()['posts'][0]['likes'] != first['posts'][0]['likes']
+
+    with app.app_context():
+        user.update(1, 'NewName', '', 'Student')
+        post.insert_post(1, 'Newest', 'Body')
+    data = client.get('/', headers=headers).get_json()
+    assert data['posts'][0]['title'] == 'Newest'
+    assert data['posts'][0]['author_name'] == 'NewName'
+
+
+def test_feed_page_matches_etag(client, app):
+    # A write made outside this process, here straight to the db, changes the ETag and the page together.
+    headers = {'Authorization': 'Bearer {}'.format(generate_mock_user_token(app, 1))}
+    first = client.get('/', headers=headers)
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO post (author_id, title, body) VALUES (1, 'Elsewhere', 'Body')")
+        db.commit()
+    second = client.get('/', headers={**headers, 'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 200
+    assert second.headers['ETag'] != first.headers['ETag']
+    assert second.get_json()['posts'][0]['title'] == 'Elsewhere'
+    third = client.get('/', headers={**headers, 'If-None-Match': second.headers['ETag']})
+    assert third.status_code == 304
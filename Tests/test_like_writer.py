@@ -0,0 +1,97 @@
+import sys
+import os
+import sqlite3
+import threading
+
+import pytest
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+import like_writer
+import post
+from like_writer import LikeWriter
+
+
+def test_write(app):
+    writer = LikeWriter()
+    with app.app_context():
+        # Post 5 has no likes.
+        assert writer.write([('like', 1, 5), ('like', 1, 5), ('unlike', 3, 5), ('like', 3, 5)]) == \
+            [True, False, False, True]
+        assert writer.write([('unlike', 1, 5)]) == [True]
+        assert [user_.id for user_ in post.get_liked_users(5)] == [3]
+        assert writer.stats() == {'batches': 2, 'writes': 5}
+
+
+def test_group_commit(app):
+    # Writes made while a batch waits to be committed are committed with it.
+    writer = LikeWriter(window=0.2)
+    barrier = threading.Barrier(8)
+    results = {}
+
+    def like(post_id):
+        with app.app_context():
+            barrier.wait()
+            results[post_id] = writer.write([('like', 1, post_id)])
+
+    threads = [threading.Thread(target=like, args=(post_id,)) for post_id in range(5, 13)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {post_id: [True] for post_id in range(5, 13)}
+    assert writer.stats()['writes'] == 8
+    assert writer.stats()['batches'] < 8
+    with app.app_context():
+        assert all(post.get_like(1, post_id) for post_id in range(5, 13))
+
+
+def test_commit_failure(app, monkeypatch):
+    # When the leader can't get a connection, every request of the batch gets the error instead of waiting forever.
+    writer = LikeWriter(window=0.2)
+    barrier = threading.Barrier(2)
+    errors = {}
+
+    def get_db():
+        raise sqlite3.OperationalError('unable to open database file')
+
+    monkeypatch.setattr(like_writer, 'get_db', get_db)
+
+    def like(post_id):
+        with app.app_context():
+            barrier.wait()
+            try:
+                writer.write([('like', 1, post_id)])
+            except sqlite3.OperationalError as e:
+                errors[post_id] = e
+
+    threads = [threading.Thread(target=like, args=(post_id,), daemon=True) for post_id in (5, 6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert not any(thread.is_alive() for thread in threads)
+    assert sorted(errors) == [5, 6]
+
+    # The next writes start a new batch.
+    monkeypatch.undo()
+    with app.app_context():
+        assert writer.write([('like', 1, 5)]) == [True]
+
+
+def test_commit_interrupted(app, monkeypatch):
+    # An interruption of the leader, which is not an Exception, reaches the leader and fails the other requests.
+    writer = LikeWriter()
+    batch = like_writer._Batch()
+    batch.writes = [('like', 1, 5)]
+
+    def get_db():
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(like_writer, 'get_db', get_db)
+    with app.app_context():
+        with pytest.raises(KeyboardInterrupt):
+            writer._commit(batch, app.config['DATABASE'])
+    assert batch.done.is_set()
+    assert isinstance(batch.error, RuntimeError)
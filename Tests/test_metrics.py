@@ -0,0 +1,116 @@
+import sys
+import os
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+import db
+import metrics
+import queries
+from test_app import generate_mock_user_token
+
+
+def sample(text, line_start):
+    # Returns the value of the sample of the metrics text starting with line_start, or 0 if there is none.
+    for line in text.splitlines():
+        if line.startswith(line_start + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return 0
+
+
+def test_request_metrics(client, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_ENABLED', True)
+    token = generate_mock_user_token(app, 1)
+    headers = {'Authorization': 'Bearer ' + token}
+    before = client.get('/metrics').get_data(as_text=True)
+
+    response = client.get('/', headers=headers)
+    size = len(response.get_data())
+    assert response.status_code == 200
+    client.get('/nothing-here').get_data()
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type == metrics.CONTENT_TYPE
+    text = response.get_data(as_text=True)
+
+    for line_start, delta in (
+            ('blog_http_requests_total{endpoint="index",method="GET",status="200"}', 1),
+            ('blog_http_requests_total{endpoint="unmatched",method="GET",status="404"}', 1),
+            ('blog_http_request_duration_seconds_count{endpoint="index"}', 1),
+            ('blog_http_request_duration_seconds_bucket{endpoint="index",le="+Inf"}', 1),
+            ('blog_http_response_size_bytes_sum{endpoint="index"}', size)):
+        assert sample(text, line_start) == sample(before, line_start) + delta
+    # The feed runs statements, which are counted against its endpoint.
+    assert sample(text, 'blog_http_sql_statements_sum{endpoint="index"}') > \
+        sample(before, 'blog_http_sql_statements_sum{endpoint="index"}')
+    assert sample(text, 'blog_sql_statement_calls_total{statement="post.homepage"}') > 0
+    # The request to /metrics being served is in flight.
+    assert sample(text, 'blog_http_requests_in_flight') >= 1
+    assert 'blog_feed_cache_hits_total' in text
+    assert 'blog_db_pool_in_use' in text
+
+
+def test_streamed_response_size(client, app):
+    headers = {'Authorization': 'Bearer ' + generate_mock_user_token(app, 1)}
+    before = metrics.request_metrics.snapshot()['size'].get('export')
+    size = len(client.get('/export', query_string={'table': 'post'}, headers=headers).get_data())
+    after = metrics.request_metrics.snapshot()['size']['export']
+    assert after.sum - (before.sum if before else 0) == size
+
+
+def test_metrics_token(client, app, monkeypatch):
+    # Metrics are not served unless they are enabled or protected by a token.
+    assert client.get('/metrics').status_code == 404
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'secret')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer s\u00e9cret'}).status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+
+
+def test_histogram_and_labels():
+    histogram = metrics.Histogram((1, 2, 5))
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value)
+    assert histogram.counts == [2, 0, 1, 1]
+    assert histogram.sum == 14.5
+
+    writer = metrics._Writer()
+    writer.histogram('test_seconds', 'Help.', {'a"b': histogram}, 'endpoint')
+    text = writer.render()
+    assert 'test_seconds_bucket{endpoint="a\\"b",le="2"} 2' in text
+    assert 'test_seconds_bucket{endpoint="a\\"b",le="+Inf"} 4' in text
+    assert 'test_seconds_count{endpoint="a\\"b"} 4' in text
+
+
+def test_statement_listener(client, app, monkeypatch):
+    calls = []
+    monkeypatch.setattr(queries, '_statement_listeners', [lambda name, seconds: calls.append(name)])
+    with app.app_context():
+        queries.fetch_one('user.get', (1,))
+    assert calls == ['user.get']
+
+
+def test_sql_listener(app, monkeypatch):
+    # Every call that runs SQL on a connection is reported, not only the statements of queries.py.
+    with app.app_context():
+        db_ = db.get_db()
+        calls = []
+        monkeypatch.setattr(db, '_sql_listeners', [lambda seconds, statement: calls.append(statement)])
+        db_.execute('SELECT 1').fetchall()
+        db_.executescript('SELECT 1;')
+        db_.commit()
+    assert calls == [True, False, True, True]
+
+
+def test_commits_counted(client, app):
+    # The statements of a write request include its commit.
+    headers = {'Authorization': 'Bearer ' + generate_mock_user_token(app, 1)}
+    calls = sum(stats['calls'] for stats in queries.stats().values())
+    before = metrics.request_metrics.snapshot()['statements'].get('create_post')
+    response = client.post('/create', headers=headers, json={'title': 'Title', 'body': 'Body'})
+    response.get_data()
+    assert response.status_code == 201
+    calls = sum(stats['calls'] for stats in queries.stats().values()) - calls
+    after = metrics.request_metrics.snapshot()['statements']['create_post']
+    assert after.sum - (before.sum if before else 0) == calls + 1
@@ -0,0 +1,31 @@
+import sys
+import os
+import datetime
+
+import pytest
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+from models import User, Post, Like
+
+
+def test_to_dict():
+    user_ = User(1, 'name', 'a@b.com', '', 'Student', 'Google')
+    assert user_.to_dict() == {'id': 1, 'name': 'name', 'email': 'a@b.com', 'phone': '', 'occupation': 'Student',
+                               'type': 'Google'}
+
+    created = datetime.datetime(2022, 6, 1)
+    post_ = Post(1, 'Title', 'x' * 150, created, 1, 'name')
+    assert post_.to_dict('likes') == {'title': 'Title', 'body': 'x' * 150, 'created': created, 'author_id': 1,
+                                      'author_name': 'name', 'likes': 'likes'}
+    assert post_.to_export_dict() == {'id': 1, 'title': 'Title', 'body': 'x' * 150, 'created': '2022-06-01 00:00:00',
+                                      'author_id': 1}
+
+    assert Like(1, 2, created).to_dict() == {'post_id': 1, 'user_id': 2, 'created': created}
+    assert Like(1, 2, created).to_export_dict() == {'post_id': 1, 'user_id': 2, 'created': '2022-06-01 00:00:00'}
+
+
+def test_slots():
+    # Models have no per-instance __dict__.
+    with pytest.raises(AttributeError):
+        User(1, 'name', 'a@b.com', '', 'Student', 'Google').extra = 1
@@ -0,0 +1,155 @@
+import sys
+import os
+import time
+
+import pytest
+import requests
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+import oauth
+
+DOCUMENT = {'authorization_endpoint': 'https://example.com/auth',
+            'token_endpoint': 'https://example.com/token',
+            'userinfo_endpoint': 'https://example.com/userinfo'}
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_parse_cache_control():
+    assert oauth.parse_cache_control('public, max-age=3600, stale-while-revalidate="60"') == \
+        {'public': None, 'max-age': '3600', 'stale-while-revalidate': '60'}
+    assert oauth.parse_cache_control(None) == {}
+
+
+def test_discovery_cache_max_age(provider_stub):
+    provider_stub.routes['/config'] = (200, {'Cache-Control': 'public, max-age=3600'}, DOCUMENT)
+    cache = oauth.DiscoveryCache(ttl=0)
+    url = provider_stub.url('/config')
+    assert cache.get(url) == DOCUMENT
+    assert cache.get(url) == DOCUMENT
+    # max-age sent by the provider is used instead of the fallback ttl.
+    assert provider_stub.count('/config') == 1
+
+
+def test_discovery_cache_fallback_ttl(provider_stub):
+    provider_stub.routes['/config'] = (200, {}, DOCUMENT)
+    url = provider_stub.url('/config')
+    cache = oauth.DiscoveryCache(ttl=3600)
+    cache.get(url)
+    cache.get(url)
+    assert provider_stub.count('/config') == 1
+
+    # Without a stale window, an expired document is fetched again before it is returned.
+    cache = oauth.DiscoveryCache(ttl=0, stale_ttl=0)
+    cache.get(url)
+    cache.get(url)
+    assert provider_stub.count('/config') == 3
+
+    # no-store and no-cache documents are not kept, not even to be served stale.
+    for count, directive in ((5, 'no-store'), (7, 'no-cache')):
+        provider_stub.routes['/config'] = (200, {'Cache-Control': directive}, DOCUMENT)
+        cache = oauth.DiscoveryCache(ttl=3600, stale_ttl=3600)
+        assert cache.get(url) == DOCUMENT
+        assert cache.get(url) == DOCUMENT
+        assert provider_stub.count('/config') == count
+        assert cache.stats()['stale_hits'] == 0
+        assert cache.stats()['documents'] == 0
+
+
+def test_discovery_cache_stale_while_revalidate(provider_stub):
+    provider_stub.routes['/config'] = (200, {'Cache-Control': 'max-age=0'}, DOCUMENT)
+    url = provider_stub.url('/config')
+    cache = oauth.DiscoveryCache(stale_ttl=3600)
+    cache.get(url)
+
+    # The expired copy is returned at once and a new one is fetched in the background.
+    new_document = dict(DOCUMENT, token_endpoint='https://example.com/token2')
+    provider_stub.routes['/config'] = (200, {'Cache-Control': 'max-age=3600'}, new_document)
+    assert cache.get(url) == DOCUMENT
+    assert wait_for(lambda: cache.get(url) == new_document)
+    assert provider_stub.count('/config') == 2
+    assert cache.stats()['background_refreshes'] == 1
+
+    # A failed refresh keeps serving the stale copy.
+    provider_stub.routes['/other'] = (200, {'Cache-Control': 'max-age=0'}, DOCUMENT)
+    other = provider_stub.url('/other')
+    cache.get(other)
+    provider_stub.routes['/other'] = (500, {}, {})
+    assert cache.get(other) == DOCUMENT
+    assert wait_for(lambda: not cache._refreshing)
+    assert cache.get(other) == DOCUMENT
+
+
+def test_discovery_cache_preload(provider_stub):
+    provider_stub.routes['/config'] = (200, {}, DOCUMENT)
+    cache = oauth.DiscoveryCache()
+    cache.preload([provider_stub.url('/config'), provider_stub.url('/missing')], background=False)
+    assert provider_stub.count('/config') == 1
+    assert cache.get(provider_stub.url('/config')) == DOCUMENT
+    assert provider_stub.count('/config') == 1
+
+
+def test_login_uses_cache(client, app, provider_stub, monkeypatch):
+    provider_stub.routes['/google'] = (200, {'Cache-Control': 'max-age=3600'}, DOCUMENT)
+    monkeypatch.setattr('app.GOOGLE_DISCOVERY_URL', provider_stub.url('/google'))
+    monkeypatch.setattr(oauth, 'discovery_cache', oauth.DiscoveryCache())
+    assert client.get('/google').status_code == 200
+    assert client.get('/google').status_code == 200
+    assert provider_stub.count('/google') == 1
+
+
+def test_outbound_client_retries(provider_stub):
+    provider_stub.routes['/busy'] = (503, {}, {})
+    client = oauth.OutboundClient(retries=2, backoff=0)
+    # GET requests are retried up to the retry budget.
+    assert client.get('test.get', provider_stub.url('/busy')).status_code == 503
+    assert provider_stub.count('/busy') == 3
+    # POST requests are not retried once the provider has received them.
+    assert client.post('test.post', provider_stub.url('/busy')).status_code == 503
+    assert provider_stub.count('/busy') == 4
+
+    stats = client.stats()
+    assert stats['test.get']['calls'] == 1
+    assert stats['test.post']['calls'] == 1
+    assert stats['test.get']['errors'] == 0
+
+
+def test_outbound_client_timeout(provider_stub):
+    provider_stub.routes['/slow'] = (200, {}, {})
+    provider_stub.delays['/slow'] = 0.5
+    client = oauth.OutboundClient(read_timeout=0.1, retries=0)
+    with pytest.raises(requests.RequestException):
+        client.get('test.slow', provider_stub.url('/slow'))
+    assert client.stats()['test.slow']['errors'] == 1
+
+
+def test_google_callback(client, app, provider_stub, monkeypatch):
+    # oauthlib only allows http URLs, as used by the stub, when this is set.
+    monkeypatch.setenv('OAUTHLIB_INSECURE_TRANSPORT', '1')
+    provider_stub.routes['/google'] = (200, {}, dict(DOCUMENT, token_endpoint=provider_stub.url('/token'),
+                                                     userinfo_endpoint=provider_stub.url('/userinfo')))
+    provider_stub.routes['/token'] = (200, {}, {'access_token': 'access', 'token_type': 'Bearer'})
+    provider_stub.routes['/userinfo'] = (200, {}, {'email': 'new@gmail.com', 'email_verified': True})
+    monkeypatch.setattr('app.GOOGLE_DISCOVERY_URL', provider_stub.url('/google'))
+    monkeypatch.setattr(oauth, 'discovery_cache', oauth.DiscoveryCache())
+    monkeypatch.setattr(oauth, 'client', oauth.OutboundClient())
+
+    response = client.get('/google/callback', query_string={'code': 'code'})
+    assert response.status_code == 200
+    assert response.get_json()['token']
+    assert response.get_json()['refresh_token']
+    assert oauth.client.stats()['google.token']['calls'] == 1
+    assert oauth.client.stats()['google.userinfo']['calls'] == 1
+
+    # The provider being down results in a 502.
+    provider_stub.routes['/token'] = (200, {}, {})
+    provider_stub.delays['/token'] = 0.5
+    monkeypatch.setattr(oauth, 'client', oauth.OutboundClient(read_timeout=0.1, retries=0))
+    response = client.get('/google/callback', query_string={'code': 'code'})
+    assert response.status_code == 502
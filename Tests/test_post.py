@@ -0,0 +1,32 @@
+import sys
+import os
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+import post
+
+
+# Test get_like_summaries()
+def test_get_like_summaries(client, app):
+    with app.app_context():
+        summaries = post.get_like_summaries([1, 2, 3, 4, 5])
+        # Counts match the full list of likers.
+        for post_id in (1, 2, 3, 4):
+            assert summaries[post_id][0] == len(post.get_liked_users(post_id))
+        # At most two names are loaded per post.
+        assert len(summaries[1][1]) == 2
+        assert len(summaries[3][1]) == 2
+        assert summaries[4] == (1, ['valid_gg_user2'])
+        # Posts with no likes are left out.
+        assert 5 not in summaries
+        assert post.get_like_summaries([]) == {}
+
+
+# Test that insert_post() stores the excerpt read by the feeds
+def test_insert_post_excerpt(client, app):
+    with app.app_context():
+        post.insert_post(1, 'Long', 'y' * 150)
+        post_ = post.get_homepage(1)[0]
+        assert post_.title == 'Long'
+        assert post_.body == 'y' * post.EXCERPT_LENGTH
+        assert post.get_post_details(post_.id).body == 'y' * 150
@@ -0,0 +1,41 @@
+import sys
+import os
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+import db
+import models
+import queries
+
+
+def test_rows_and_stats(client, app):
+    with app.app_context():
+        calls = queries.stats().get('user.get', {}).get('calls', 0)
+        user_ = queries.fetch_one('user.get', (1,))
+        assert isinstance(user_, models.User)
+        assert user_.name == 'valid_gg_user'
+        assert user_.type == 'Google'
+        assert queries.fetch_one('user.get', (9999,)) is None
+
+        posts = queries.fetch_all('post.user_page', (3, 2, 0))
+        assert [post_.title for post_ in posts] == ['Post 4', 'Post 3']
+
+        stats = queries.stats()
+        assert stats['user.get']['calls'] == calls + 2
+        assert stats['user.get']['seconds'] > 0
+
+
+def test_statements_are_valid(client, app):
+    # Every statement in the registry compiles against the current schema.
+    with app.app_context():
+        for name, statement in queries.STATEMENTS.items():
+            db.get_db().execute('EXPLAIN ' + statement.sql, (None,) * statement.sql.count('?'))
+
+
+def test_fetch_chunks(client, app):
+    with app.app_context():
+        chunks = list(queries.fetch_chunks('post.export', size=5))
+        assert [len(chunk) for chunk in chunks] == [5, 5, 5, 3]
+        assert [post_.id for chunk in chunks for post_ in chunk] == list(range(1, 19))
+        assert isinstance(chunks[0][0], models.Post)
+        assert list(queries.fetch_chunks('post.user_all', (9999,))) == []
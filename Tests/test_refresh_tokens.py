@@ -0,0 +1,43 @@
+import sys
+import os
+
+sys.path.append(os.path.join(sys.path[0], '..'))
+
+import refresh_tokens
+
+
+def test_rotate(app):
+    with app.app_context():
+        first = refresh_tokens.issue(1)
+        user_id, second = refresh_tokens.rotate(first)
+        assert user_id == 1
+        assert second != first
+        user_id, third = refresh_tokens.rotate(second)
+        assert user_id == 1
+        assert refresh_tokens.rotate('unknown') is None
+
+        # Using a token again revokes its whole family, including the newest token.
+        assert refresh_tokens.rotate(first) is None
+        assert refresh_tokens.rotate(third) is None
+
+        # Other logins are not affected.
+        other = refresh_tokens.issue(1)
+        assert refresh_tokens.rotate(other) is not None
+
+
+def test_revoke_and_expiry(app, monkeypatch):
+    with app.app_context():
+        token = refresh_tokens.issue(1)
+        assert refresh_tokens.revoke(token)
+        assert refresh_tokens.rotate(token) is None
+        assert not refresh_tokens.revoke('unknown')
+
+        monkeypatch.setitem(app.config, 'REFRESH_TOKEN_TTL', -1)
+        expired = refresh_tokens.issue(1)
+        assert refresh_tokens.rotate(expired) is None
+        assert refresh_tokens.purge_expired() == 1
+
+
+def test_purge_command(app, runner):
+    result = runner.invoke(args=['purge-refresh-tokens'])
+    assert 'Deleted 0 expired refresh token(s).' in result.output
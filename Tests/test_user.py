@@ -35,3 +35,23 @@ def test_info_valid(client, app):
         assert user.info_valid(4, 'Google') is False
         assert user.info_valid(4, 'Facebook') is False
         assert user.info_valid(4, 'Invalid') is False
+
+
+# Test the user cache
+def test_cache(client, app):
+    with app.app_context():
+        user.get(1)
+        hits = user.cache_stats()['hits']
+        assert user.get(1).name == 'valid_gg_user'
+        assert user.get('1').name == 'valid_gg_user'
+        assert user.cache_stats()['hits'] == hits + 2
+
+        # update() evicts the row so the new info is read back.
+        user.update(1, 'NewName', '', 'Student')
+        assert user.get(1).name == 'NewName'
+
+        # get_by_email() shares the cached row.
+        assert user.get_by_email('testgg@gmail.com', 'Google').name == 'NewName'
+        hits = user.cache_stats()['hits']
+        assert user.get_by_email('testgg@gmail.com', 'Google').id == 1
+        assert user.cache_stats()['hits'] > hits
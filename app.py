@@ -1,6 +1,7 @@
 # Imports
 # Python standard libraries
 import datetime
+import hmac
 import json
 import os
 from os.path import join, dirname
@@ -8,15 +9,23 @@ from functools import wraps
 
 import requests
 # Third-party libraries
-from flask import Flask, request, url_for, jsonify
+from flask import Flask, request, url_for, jsonify, g, stream_with_context, after_this_request
+from flask import json as flask_json
 from oauthlib.oauth2 import WebApplicationClient
 from dotenv import load_dotenv
 import jwt
+from itsdangerous import URLSafeSerializer, BadSignature
 # Internal imports
-from werkzeug.exceptions import abort, HTTPException
+from werkzeug.exceptions import abort, HTTPException, BadGateway
 
+import auth
 import db
+import feed_cache
+import like_writer
+import metrics
+import oauth
 import post
+import refresh_tokens
 import user
 
 # App setup
@@ -43,12 +52,14 @@ GOOGLE_CLIENT_ID = app.config.get('GOOGLE_CLIENT_ID', None)
 GOOGLE_CLIENT_SECRET = app.config.get('GOOGLE_CLIENT_SECRET', None)
 FACEBOOK_CLIENT_ID = app.config.get('FACEBOOK_CLIENT_ID', None)
 FACEBOOK_CLIENT_SECRET = app.config.get('FACEBOOK_CLIENT_SECRET', None)
-GOOGLE_DISCOVERY_URL = (
-    "https://accounts.google.com/.well-known/openid-configuration"
+GOOGLE_DISCOVERY_URL = app.config.get(
+    'GOOGLE_DISCOVERY_URL', "https://accounts.google.com/.well-known/openid-configuration"
 )
-FACEBOOK_DISCOVERY_URL = (
-    "https://www.facebook.com/.well-known/openid-configuration"
+FACEBOOK_DISCOVERY_URL = app.config.get(
+    'FACEBOOK_DISCOVERY_URL', "https://www.facebook.com/.well-known/openid-configuration"
 )
+FACEBOOK_TOKEN_URL = app.config.get('FACEBOOK_TOKEN_URL', "https://graph.facebook.com/v14.0/oauth/access_token")
+FACEBOOK_USERINFO_URL = app.config.get('FACEBOOK_USERINFO_URL', "https://graph.facebook.com/me")
 # Load environment variables.
 dotenv_path = join(dirname(__file__), '.env')
 load_dotenv(dotenv_path)
@@ -56,14 +67,37 @@ load_dotenv(dotenv_path)
 # Run "flask init-db" to initialise db.
 # Remember to change directory and activate venv.
 db.init_app(app)
+# Cache user rows. Set USER_CACHE_SIZE and USER_CACHE_TTL in config.py to change its size and how long rows are kept.
+user.init_app(app)
+# Cache rendered feed pages. See feed_cache.init_app for the settings.
+feed_cache.init_app(app)
+# Refresh tokens are valid for REFRESH_TOKEN_TTL seconds, 30 days by default.
+refresh_tokens.init_app(app)
+# Cache verified tokens. See auth.init_app for the settings.
+auth.init_app(app)
+# Commit likes of concurrent requests together. See like_writer.init_app for the settings.
+like_writer.init_app(app)
+# Record the latency, SQL statements and response size of every request, served at /metrics.
+metrics.init_app(app)
 
 # OAuth 2 google and facebook client setup.
 google_client = WebApplicationClient(GOOGLE_CLIENT_ID)
 facebook_client = WebApplicationClient(FACEBOOK_CLIENT_ID)
+# Set up the pooled client used for all calls to the providers and cache their discovery documents. Set
+# OAUTH_PRELOAD_DISCOVERY to True in config.py to fetch them when the app starts instead of on the first login.
+# GOOGLE_POOL_SIZE and FACEBOOK_POOL_SIZE set how many connections are kept alive per host of each provider.
+oauth.init_app(app, [GOOGLE_DISCOVERY_URL, FACEBOOK_DISCOVERY_URL], [
+    ('https://accounts.google.com', app.config.get('GOOGLE_POOL_SIZE', 10)),
+    ('https://oauth2.googleapis.com', app.config.get('GOOGLE_POOL_SIZE', 10)),
+    ('https://openidconnect.googleapis.com', app.config.get('GOOGLE_POOL_SIZE', 10)),
+    ('https://www.facebook.com', app.config.get('FACEBOOK_POOL_SIZE', 10)),
+    ('https://graph.facebook.com', app.config.get('FACEBOOK_POOL_SIZE', 10)),
+])
 
 
 def get_provider_cfg(discovery_url):
-    return requests.get(discovery_url).json()
+    # Gets the discovery document of a provider, which says what URLs to hit to log in.
+    return oauth.discovery_cache.get(discovery_url)
 
 
 @app.route("/facebook", methods=["GET"])
@@ -94,12 +128,13 @@ def facebook_callback():
 
     # Prepare and send a request to get tokens.
     token_url, headers, body = facebook_client.prepare_token_request(
-        "https://graph.facebook.com/v14.0/oauth/access_token",
+        FACEBOOK_TOKEN_URL,
         authorization_response=request.url,
         redirect_url=request.base_url,
         code=code
     )
-    token_response = requests.post(
+    token_response = oauth.client.post(
+        'facebook.token',
         token_url,
         headers=headers,
         data=body,
@@ -109,8 +144,8 @@ def facebook_callback():
     facebook_client.parse_request_body_response(json.dumps(token_response.json()))
     # Get user info.
     payload = {'fields': 'email'}
-    uri, headers, body = facebook_client.add_token("https://graph.facebook.com/me")
-    userinfo_response = requests.get(uri, headers=headers, data=body, params=payload)
+    uri, headers, body = facebook_client.add_token(FACEBOOK_USERINFO_URL)
+    userinfo_response = oauth.client.get('facebook.userinfo', uri, headers=headers, data=body, params=payload)
 
     # Return error if email does not exist.
     if userinfo_response.json().get("email"):
@@ -123,14 +158,7 @@ def facebook_callback():
         user.create('', users_email, '', '', 'Facebook')
 
     user_ = user.get_by_email(users_email, 'Facebook')
-    # Generate a token for the authenticated user. 'exp' is the time the token expires, set to be 60 minutes after
-    # creation.
-    token = jwt.encode({'id': user_[0],
-                        'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=60)},
-                       app.config['SECRET_KEY'])
-    return jsonify({'message': 'Login successful. Send the provided token as a bearer token in the header of your '
-                               'HTTP request to the API to authenticate yourself.',
-                    'token': token}), 200
+    return login_response(user_)
 
 
 @app.route("/google", methods=["GET"])
@@ -171,7 +199,8 @@ def google_callback():
         code=code
     )
 
-    token_response = requests.post(
+    token_response = oauth.client.post(
+        'google.token',
         token_url,
         headers=headers,
         data=body,
@@ -185,7 +214,7 @@ def google_callback():
     userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
     uri, headers, body = google_client.add_token(userinfo_endpoint)
 
-    userinfo_response = requests.get(uri, headers=headers, data=body)
+    userinfo_response = oauth.client.get('google.userinfo', uri, headers=headers, data=body)
 
     # Make sure email is verified by Google.
     if userinfo_response.json().get("email_verified"):
@@ -198,14 +227,54 @@ def google_callback():
         user.create('', users_email, '', '', 'Google')
 
     user_ = user.get_by_email(users_email, 'Google')
+    return login_response(user_)
+
+
+def create_access_token(user_id):
     # Generate a token for the authenticated user. 'exp' is the time the token expires, set to be 60 minutes after
     # creation.
-    token = jwt.encode({'id': user_[0],
-                        'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=60)},
-                       app.config['SECRET_KEY'])
+    return jwt.encode({'id': user_id,
+                       'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=60)},
+                      app.config['SECRET_KEY'])
+
+
+def login_response(user_):
+    # Returns the access token and a new refresh token of a user who just logged in with Google or Facebook.
     return jsonify({'message': 'Login successful. Send the provided token as a bearer token in the header of your '
-                               'HTTP request to the API to authenticate yourself.',
-                    'token': token}), 200
+                               'HTTP request to the API to authenticate yourself. When it expires, send the '
+                               'refresh token to /token/refresh to get a new one.',
+                    'token': create_access_token(user_.id),
+                    'refresh_token': refresh_tokens.issue(user_.id)}), 200
+
+
+@app.route('/token/refresh', methods=['POST'])
+def refresh_token():
+    # Exchanges a refresh token for a new access token and a new refresh token, without logging in with the provider
+    # again. The refresh token sent can't be used again.
+    data = request.get_json(silent=True)
+    token = data.get('refresh_token') if isinstance(data, dict) else None
+    if not isinstance(token, str) or not token:
+        return abort(400, 'Include the `refresh_token` returned at login or by the last refresh in the request body.')
+
+    result = refresh_tokens.rotate(token)
+    if result is None:
+        return abort(401, 'Refresh token is invalid, has expired or was already used. Log in again at /google or '
+                          '/facebook.')
+    user_id, new_token = result
+    if not user.get(user_id):
+        return abort(401, 'The user of this refresh token no longer exists.')
+    return jsonify({'token': create_access_token(user_id), 'refresh_token': new_token}), 200
+
+
+@app.route('/token/revoke', methods=['POST'])
+def revoke_token():
+    # Revokes a refresh token and all the refresh tokens issued with it since login, e.g. to log out.
+    data = request.get_json(silent=True)
+    token = data.get('refresh_token') if isinstance(data, dict) else None
+    if not isinstance(token, str) or not token:
+        return abort(400, 'Include the `refresh_token` to revoke in the request body.')
+    refresh_tokens.revoke(token)
+    return jsonify({'message': 'Refresh token revoked.'}), 200
 
 
 def token_required(func):
@@ -213,17 +282,17 @@ def token_required(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         # Get the token from the header.
-        auth_header = request.headers.get('Authorization')
-        if auth_header:
-            token = auth_header.split(" ")[1]
-        else:
-            token = ''
+        auth_header = request.headers.get('Authorization', '')
+        token = auth_header.partition(' ')[2].strip()
 
         if not token:
             return abort(401, 'Token is missing.')
 
+        # Tokens already verified are found in the token cache with their user, so most requests skip the signature
+        # check and the user lookup. The authenticated user is loaded once for the whole request: routes and
+        # valid_info_required read it from g.user instead of querying the db again.
         try:
-            data = jwt.decode(token, app.config["SECRET_KEY"], ['HS256'], verify_signature=True)
+            data, g.user = auth.token_cache.authenticate(token)
             # Pass data into decorated function.
             kwargs['user_data'] = data
         # An exception is thrown when jwt cannot decode the token provided (i.e. it is not correct). InvalidTokenError
@@ -232,6 +301,21 @@ def token_required(func):
         # Error args: exception.args
         except jwt.exceptions.InvalidTokenError:
             return abort(401, 'Token is invalid or has expired.')
+
+        if not g.user:
+            return abort(404, 'Uh oh. You don\'t seem to exist in the db? Something must be wrong.')
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def valid_info_required(func):
+    # Decorator to check if the authenticated user has the info required to use the blog. Must be used after
+    # token_required. Returns 403 otherwise.
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not user.has_valid_info(g.user, g.user.type):
+            return abort(403, message_403())
         return func(*args, **kwargs)
 
     return wrapper
@@ -239,42 +323,45 @@ def token_required(func):
 
 def author_post_mismatch(author_id, post_):
     # Checks if a post belongs to an author.
+    # The author only needs to be looked up to tell which error to show when the post does not belong to them.
+    try:
+        if post_ is not None and int(author_id) == post_.author_id:
+            return
+    except ValueError:
+        pass
+
     if not user.get(author_id):
         abort(404, 'Resource not found! The specified user does not exist.')
-    author_id = int(author_id)
     if post_ is None:
         abort(404, 'Resource not found! The specified post does not exist.')
-    elif author_id != post_[4]:
-        abort(404, 'Resource not found! The specified post does not belong to the specified user.')
+    abort(404, 'Resource not found! The specified post does not belong to the specified user.')
 
 
-def format_likes_to_display(post_id):
-    # Get the list of users who like a post and format a string to be displayed.
+# Like summary of a post that no one has liked.
+NO_LIKES = (0, [])
 
-    users = post.get_liked_users(post_id)
 
-    if len(users) == 0:
+def format_likes_to_display(summary):
+    # Format a string to be displayed from the like summary of a post, given as (count, names) by
+    # post.get_like_summaries(). names holds the names of the two most recent likers.
+    count, names = summary
+
+    if count == 0:
         return 'No one has liked this post yet.'
-    elif len(users) == 1:
-        return '{} liked this post.'.format(users[0][1])
-    elif len(users) == 2:
-        return '{} and {} liked this post.'.format(users[0][1], users[1][1])
+    elif count == 1:
+        return '{} liked this post.'.format(names[0])
+    elif count == 2:
+        return '{} and {} liked this post.'.format(names[0], names[1])
     else:
-        return '{}, {} and {} other people liked this post.'.format(users[0][1], users[1][1], len(users) - 2)
+        return '{}, {} and {} other people liked this post.'.format(names[0], names[1], count - 2)
 
 
 def format_posts_to_display(posts):
     # Format a string that display a list of posts.
-    output = []
-    for post_ in posts:
-        # Shows first 100 chars of body.
-        body_to_show = post_[2][:100]
-        likes_to_show = format_likes_to_display(post_[0])
-        post_data = \
-            {'title': post_[1], 'body': body_to_show, 'created': post_[3], 'author_id': post_[4],
-             'author_name': post_[5], 'likes': likes_to_show}
-        output.append(post_data)
-    return output
+    # The likes of all posts are loaded together in a single query.
+    summaries = post.get_like_summaries(post_.id for post_ in posts)
+    # The posts of the feeds only hold the first 100 chars of their body, see db.EXCERPT_LENGTH.
+    return [post_.to_dict(format_likes_to_display(summaries.get(post_.id, NO_LIKES))) for post_ in posts]
 
 
 def get_value(dict_, name, default):
@@ -294,21 +381,12 @@ def message_403():
             "not need to provide a phone number. Facebook users do not need to provide an occupation.")
 
 
-@app.route("/", methods=["GET"])
-@token_required
-# @valid_info_required
-def index(**kwargs):
-    # Shows the homepage, containing all posts by all users, which is paginated.
-    user_data = kwargs.get('user_data')
-    user_ = user.get(user_data.get('id'))
-    user_id, user_type = user_[0], user_[5]
-    args = request.args
+# Largest offset SQLite accepts, the largest signed 64-bit integer.
+MAX_OFFSET = 2 ** 63 - 1
 
-    # Checks if user has valid info required.
-    if not user.info_valid(user_id, user_type):
-        return abort(403, message_403())
 
-    # If args are not provided, generate some default values.
+def get_page_args(args):
+    # Reads the page and perpage query parameters. If they are not provided, generate some default values.
     # Also checks if the values contain only numbers.
     page = (get_value(args, 'page', '1'))
     if page.isdecimal():
@@ -321,48 +399,175 @@ def index(**kwargs):
         perpage = int(perpage)
     else:
         perpage = 5
+    # perpage is capped at MAX_PER_PAGE, and page so that the offset of the page still fits in an SQLite integer.
+    # Pages past the last post are empty anyway.
+    perpage = min(perpage, app.config.get('MAX_PER_PAGE', 100))
+    if perpage:
+        page = min(page, MAX_OFFSET // perpage)
+    return page, perpage
 
-    start_index = (page - 1) * perpage
-    end_index = page * perpage
 
-    # Shows all posts by all users.
-    posts = post.get_homepage()
-    # Get all posts in a page and format them for displaying.
-    final_posts = posts[start_index:end_index]
-    output = format_posts_to_display(final_posts)
+def page_token_serializer():
+    # Signs the tokens that point to the next page of a feed so clients cannot forge or tamper with them.
+    return URLSafeSerializer(app.config['SECRET_KEY'], salt='feed-page')
 
-    return jsonify({'posts': output,
-                    'next_page': '{}?page={}&perpage={}'.format(url_for("index"), page + 1, perpage)}), 200
 
+def load_page_token(token):
+    # Returns the id of the last post of the previous page stored in a token made by get_feed().
+    try:
+        return page_token_serializer().loads(token)['after']
+    except (BadSignature, KeyError, TypeError):
+        return abort(400, 'The `next` page token is invalid. Use the token returned with the previous page.')
 
-@app.route("/info", methods=["GET"])
+
+def vary_on_accept(response):
+    # Tells caches that the response depends on the Accept header, so they keep the JSON and NDJSON variants apart.
+    response.vary.add('Accept')
+    return response
+
+
+def wants_ndjson():
+    # Returns True if the client asked for the whole result streamed as NDJSON, one JSON object per line, with
+    # `format=ndjson` or by accepting application/x-ndjson over application/json.
+    # Either way the response, including a 304 or an error, is sent with Vary: Accept.
+    after_this_request(vary_on_accept)
+    if request.args.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+
+def ndjson_response(chunks):
+    # Streams the objects of chunks, an iterable of lists of dicts, as NDJSON while they are read from the db. Only
+    # one list and about 64 KiB of output are in memory at a time, however many objects there are.
+    def generate():
+        buffer = []
+        size = 0
+        for chunk in chunks:
+            for record in chunk:
+                line = flask_json.dumps(record) + '\n'
+                buffer.append(line)
+                size += len(line)
+                if size >= 65536:
+                    yield ''.join(buffer)
+                    buffer = []
+                    size = 0
+        if buffer:
+            yield ''.join(buffer)
+
+    return vary_on_accept(app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson'))
+
+
+def not_modified(etag):
+    # Returns a 304 response if the client sent If-None-Match with etag, i.e. it already has this version of the
+    # resource. Otherwise returns None and the resource is read and sent with the ETag.
+    if etag is not None and request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def post_etag(author_id, post_id, resource):
+    # Returns the ETag of a resource of a post from the version of the post. Returns None if the post does not exist
+    # or does not belong to the author, so the request goes on and shows the error.
+    row = post.get_post_version(post_id)
+    try:
+        if row is None or int(author_id) != row[0]:
+            return None
+    except ValueError:
+        return None
+    return '{}-{}-{}'.format(resource, post_id, row[1])
+
+
+def get_feed(load_posts, endpoint, **values):
+    # Gets a page of a feed and the link to its next page. load_posts(limit, offset, after) reads the posts.
+    # A page can be requested by number with `page` or by the `next` token returned with the previous page. Following
+    # the token is cheaper for deep pages and does not skip or repeat posts when new ones are created in between.
+    # Pages are the same for every user, so they are served from the feed cache when possible.
+    # The ETag is the feed revision, read before the posts, and cached pages are stored under that same revision, so a
+    # page is never older than its ETag. If a write happens in between, the page is newer than its ETag and the client
+    # just gets the page again on its next request.
+    revision = post.get_feed_revision()
+    etag = 'feed-{}'.format(revision)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    args = request.args
+    page, perpage = get_page_args(args)
+    token = args.get('next')
+
+    version = feed_cache.feed_cache.version(revision)
+    page_key = '{}:{}:{}:{}'.format(endpoint, sorted(values.items()), token or page, perpage)
+    body = feed_cache.feed_cache.get(version, page_key)
+    if body is None:
+        body = render_feed(load_posts, endpoint, values, page, perpage, token).get_data()
+        feed_cache.feed_cache.set(version, page_key, body)
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response, 200
+
+
+def render_feed(load_posts, endpoint, values, page, perpage, token):
+    # Reads a page of a feed and returns it as a JSON response. See get_feed().
+    if token:
+        posts = load_posts(perpage, 0, load_page_token(token))
+    else:
+        # Pages start at 1; page 0 is treated as the first page.
+        posts = load_posts(perpage, max(page - 1, 0) * perpage, None)
+
+    # There is no next page when this one is not full.
+    next_token = None
+    next_page = None
+    if posts and len(posts) == perpage:
+        next_token = page_token_serializer().dumps({'after': posts[-1].id})
+        next_page = url_for(endpoint, next=next_token, perpage=perpage, **values)
+
+    return jsonify({'posts': format_posts_to_display(posts), 'next': next_token, 'next_page': next_page})
+
+
+@app.route("/", methods=["GET"])
 @token_required
-def get_info(**kwargs):
-    # Shows the info of the authenticated user.
-    user_data = kwargs.get('user_data')
-    user_ = user.get(user_data.get('id'))
-    user_id, user_type = user_[0], user_[5]
+@valid_info_required
+def index(**kwargs):
+    # Shows the homepage, containing all posts by all users, which is paginated.
+    return get_feed(post.get_homepage, 'index')
 
-    # Checks if user has valid info required.
-    if not user.info_valid(user_id, user_type):
-        return abort(403, message_403())
 
-    if not user_:
-        return abort(404, 'Uh oh. You don\'t seem to exist in the db? Something must be wrong.')
-    output = {'id': user_[0], 'name': user_[1], 'email': user_[2], 'phone': user_[3],
-              'occupation': user_[4], 'type': user_[5]}
+@app.route("/search", methods=["GET"])
+@token_required
+@valid_info_required
+def search(**kwargs):
+    # Shows the posts whose title or body contain every word of the `q` query parameter, best match first.
+    # Paginated with `page` and `perpage` like the homepage.
+    terms = request.args.get('q', '')
+    if not post.make_match_query(terms):
+        abort(400, 'The search query cannot be empty. Include the words to search for in the `q` query parameter.')
+    page, perpage = get_page_args(request.args)
+    results = post.search_posts(terms, perpage, max(page - 1, 0) * perpage)
+
+    summaries = post.get_like_summaries(result.id for result in results)
+    next_page = None
+    if results and len(results) == perpage:
+        next_page = url_for('search', q=terms, page=max(page, 1) + 1, perpage=perpage)
+    return jsonify({'posts': [result.to_dict(format_likes_to_display(summaries.get(result.id, NO_LIKES)))
+                              for result in results],
+                    'next_page': next_page}), 200
 
-    return jsonify(output), 200
+
+@app.route("/info", methods=["GET"])
+@token_required
+@valid_info_required
+def get_info(**kwargs):
+    # Shows the info of the authenticated user.
+    return jsonify(g.user.to_dict()), 200
 
 
 @app.route("/updateinfo", methods=["PATCH"])
 @token_required
 def updateinfo(**kwargs):
     # Attempts to update authenticated user's info.
-    user_data = kwargs.get('user_data')
-    user_ = user.get(user_data.get('id'))
-
-    user_id, user_type = user_[0], user_[5]
+    user_id, user_type = g.user.id, g.user.type
     data = request.get_json()
     # name is always required.
     name = get_value(data, 'name', '')
@@ -398,150 +603,300 @@ def updateinfo(**kwargs):
     return jsonify({'message': 'User info successfully updated!'}), 200
 
 
-@app.route('/create', methods=['POST'])
-@token_required
-def create_post(**kwargs):
-    # Attempts to create a new post using the provided info.
-    user_data = kwargs.get('user_data')
-    user_ = user.get(user_data.get('id'))
-    user_id, user_type = user_[0], user_[5]
-    data = request.get_json()
-
-    # Checks if user has valid info required.
-    if not user.info_valid(user_id, user_type):
-        return abort(403, message_403())
+def check_post_data(data):
+    # Checks the title and body of a post sent by a user. Returns the message of the error to show, or None if they
+    # are valid.
+    if not isinstance(data, dict):
+        return 'A post must be a JSON object with a `title` and a `body` field.'
 
     # Title is required.
     title = get_value(data, 'title', '')
     if title == '':
         # Handles title missing.
-        return abort(400, 'Post title cannot be empty. Include a `title` field in the request body and '
-                          'make sure it is not empty.')
+        return ('Post title cannot be empty. Include a `title` field in the request body and '
+                'make sure it is not empty.')
     # Body is required.
     body = get_value(data, 'body', '')
     if body == '':
         # Handles body missing.
-        return abort(400, 'Post body cannot be empty. Include a `body` field in the request body and '
-                          'make sure it is not empty.')
+        return ('Post body cannot be empty. Include a `body` field in the request body and '
+                'make sure it is not empty.')
+    if not isinstance(title, str) or not isinstance(body, str):
+        return 'Post title and body must be strings.'
+    return None
 
-    post.insert_post(user_id, title, body)
+
+@app.route('/create', methods=['POST'])
+@token_required
+@valid_info_required
+def create_post(**kwargs):
+    # Attempts to create a new post using the provided info.
+    user_id = g.user.id
+    data = request.get_json()
+
+    error = check_post_data(data)
+    if error:
+        return abort(400, error)
+
+    post.insert_post(user_id, data['title'], data['body'])
 
     return jsonify({'message': 'New post created!'}), 201
 
 
-@app.route('/<author_id>/posts', methods=['GET'])
+def read_batch_items():
+    # Reads the posts sent to /create/batch. They are either a JSON array or, with the application/x-ndjson content
+    # type, one JSON object per line. Returns a list of (item, error) where error is set for lines that are not JSON.
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append((json.loads(line), None))
+            except ValueError:
+                items.append((None, 'This line is not valid JSON.'))
+        return items
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        abort(400, 'Send the posts as a JSON array, or as one JSON object per line with the '
+                   'application/x-ndjson content type.')
+    return [(item, None) for item in data]
+
+
+@app.route('/create/batch', methods=['POST'])
 @token_required
-def user_posts(author_id, **kwargs):
-    # Shows all posts made by a user.
-    user_data = kwargs.get('user_data')
-    user_ = user.get(user_data.get('id'))
-    user_id, user_type = user_[0], user_[5]
+@valid_info_required
+def create_posts(**kwargs):
+    # Attempts to create many posts at once. Every post is checked first, then the valid ones are all saved in one
+    # transaction, which is much cheaper than one request and one commit per post.
+    # Returns the result of each post in the order they were sent.
+    items = read_batch_items()
+    max_posts = app.config.get('BATCH_CREATE_MAX_POSTS', 1000)
+    if len(items) > max_posts:
+        abort(413, 'Too many posts. Send at most {} posts per request.'.format(max_posts))
+
+    results = []
+    posts = []
+    for index, (item, error) in enumerate(items):
+        error = error or check_post_data(item)
+        if error:
+            results.append({'index': index, 'status': 400, 'message': error})
+        else:
+            results.append({'index': index, 'status': 201, 'message': 'New post created!'})
+            posts.append((item['title'], item['body']))
+    if posts:
+        post.insert_posts(g.user.id, posts)
+
+    # 201 if every post was created, 400 if none was, 207 (Multi-Status) if only some were.
+    if not items or not posts:
+        status = 400
+    elif len(posts) == len(items):
+        status = 201
+    else:
+        status = 207
+    return jsonify({'created': len(posts), 'failed': len(items) - len(posts), 'results': results}), status
 
-    # Checks if user has valid info required.
-    if not user.info_valid(user_id, user_type):
-        return abort(403, message_403())
 
+@app.route('/<author_id>/posts', methods=['GET'])
+@token_required
+@valid_info_required
+def user_posts(author_id, **kwargs):
+    # Shows all posts made by a user, which is paginated the same way as the homepage.
+    # With `format=ndjson`, all posts are streamed instead, one per line.
     # Checks if author exists.
     if not user.get(author_id):
         abort(404, 'Resource not found! The author specified does not exist!')
 
-    posts = post.get_user_page(author_id)
-    output = format_posts_to_display(posts)
-    return jsonify({'posts': output}), 200
+    if wants_ndjson():
+        # All posts of the author, in the same form as on the pages.
+        return ndjson_response(format_posts_to_display(posts) for posts in post.iter_user_posts(author_id))
+
+    def load_posts(limit, offset, after):
+        return post.get_user_page(author_id, limit, offset, after)
+
+    return get_feed(load_posts, 'user_posts', author_id=author_id)
 
 
 @app.route('/<author_id>/posts/<post_id>', methods=['GET'])
 @token_required
+@valid_info_required
 def post_details(author_id, post_id, **kwargs):
     # Shows details of a post.
-    user_data = kwargs.get('user_data')
-    user_ = user.get(user_data.get('id'))
-    user_id, user_type = user_[0], user_[5]
-
-    # Checks if user has valid info required.
-    if not user.info_valid(user_id, user_type):
-        return abort(403, message_403())
+    etag = post_etag(author_id, post_id, 'post')
+    response = not_modified(etag)
+    if response is not None:
+        return response
 
     post_ = post.get_post_details(post_id)
     author_post_mismatch(author_id, post_)
-    likes_to_show = format_likes_to_display(post_id)
-    post_data = \
-        {'title': post_[1], 'body': post_[2], 'created': post_[3],
-         'author_id': post_[4], 'author_name': post_[5], 'likes': likes_to_show}
+    summaries = post.get_like_summaries([post_.id])
+    likes_to_show = format_likes_to_display(summaries.get(post_.id, NO_LIKES))
 
-    return jsonify(post_data), 200
+    response = jsonify(post_.to_dict(likes_to_show))
+    response.set_etag(etag)
+    return response, 200
 
 
 @app.route('/<author_id>/posts/<post_id>/like', methods=['POST'])
 @token_required
+@valid_info_required
 def like_post(author_id, post_id, **kwargs):
     # Make the authenticated user like a post.
-    user_data = kwargs.get('user_data')
-    user_ = user.get(user_data.get('id'))
-    user_id, user_type = user_[0], user_[5]
-
-    # Checks if user has valid info required.
-    if not user.info_valid(user_id, user_type):
-        return abort(403, message_403())
+    user_id = g.user.id
 
     post_ = post.get_post_details(post_id)
     author_post_mismatch(author_id, post_)
 
-    # If user has already liked the post, returns 400.
-    if post.is_liked(user_id, post_id):
+    # If user has already liked the post, nothing is inserted and returns 400.
+    if not post.insert_like(user_id, post_id):
         abort(400, 'You have already liked the post!')
 
-    post.insert_like(user_id, post_id)
     return jsonify({'message': 'Liked the post!'}), 201
 
 
 @app.route('/<author_id>/posts/<post_id>/like', methods=['DELETE'])
 @token_required
+@valid_info_required
 def unlike_post(author_id, post_id, **kwargs):
     # Make the authenticated user unlike a post.
-    user_data = kwargs.get('user_data')
-    user_ = user.get(user_data.get('id'))
-    user_id, user_type = user_[0], user_[5]
-
-    # Checks if user has valid info required.
-    if not user.info_valid(user_id, user_type):
-        return abort(403, message_403())
+    user_id = g.user.id
 
     post_ = post.get_post_details(post_id)
     author_post_mismatch(author_id, post_)
 
-    # If the authenticated user has not liked the post previously, returns 400.
-    if not post.is_liked(user_id, post_id):
+    # If the authenticated user has not liked the post previously, nothing is deleted and returns 400.
+    if not post.delete_like(user_id, post_id):
         abort(400, 'You have not liked the post!')
 
-    post.delete_like(user_id, post_id)
     return jsonify({'message': 'Removed like from post!'}), 200
 
 
+# Result of each write of /likes/batch: (status, message) when it changed something, and when it did not.
+LIKE_BATCH_MESSAGES = {
+    'like': ((201, 'Liked the post!'), (400, 'You have already liked the post!')),
+    'unlike': ((200, 'Removed like from post!'), (400, 'You have not liked the post!')),
+}
+
+
+@app.route('/likes/batch', methods=['POST'])
+@token_required
+@valid_info_required
+def write_likes(**kwargs):
+    # Make the authenticated user like or unlike many posts at once. The body is a JSON array of objects with the
+    # `post_id` of a post and the `action` to take on it, 'like' or 'unlike'. All writes are saved in one transaction.
+    # Returns the result of each item in the order they were sent.
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        abort(400, 'Send a JSON array of objects with a `post_id` and an `action` field, which is "like" or "unlike".')
+    max_items = app.config.get('LIKE_BATCH_MAX_ITEMS', 1000)
+    if len(items) > max_items:
+        abort(413, 'Too many items. Send at most {} items per request.'.format(max_items))
+
+    def post_id_of(item):
+        # Returns the post id of an item, or None if it is missing or not a number.
+        post_id = item.get('post_id') if isinstance(item, dict) else None
+        return post_id if type(post_id) is int else None
+
+    def action_of(item):
+        # Returns the action of an item, or None if it is missing or not one of the actions. Checked to be a string
+        # first, as a list or an object can't be looked up in LIKE_BATCH_MESSAGES.
+        action = item.get('action') if isinstance(item, dict) else None
+        return action if isinstance(action, str) and action in LIKE_BATCH_MESSAGES else None
+
+    # The posts are looked up in one query.
+    existing = post.get_existing_posts(post_id_of(item) for item in items if post_id_of(item) is not None)
+    results = [None] * len(items)
+    writes = []
+    indexes = []
+    for index, item in enumerate(items):
+        if action_of(item) is None:
+            results[index] = (400, 'Each item needs an `action` field, which is "like" or "unlike".')
+        elif post_id_of(item) not in existing:
+            results[index] = (404, 'Resource not found! The specified post does not exist.')
+        else:
+            writes.append((item['action'], g.user.id, item['post_id']))
+            indexes.append(index)
+    for index, (action, user_id, post_id), changed in zip(indexes, writes, post.write_likes(writes)):
+        results[index] = LIKE_BATCH_MESSAGES[action][0 if changed else 1]
+
+    # 200 if every item succeeded, 400 if none did, 207 (Multi-Status) if only some did.
+    succeeded = sum(status < 400 for status, message in results)
+    if succeeded == len(items) and items:
+        status = 200
+    elif succeeded == 0:
+        status = 400
+    else:
+        status = 207
+    return jsonify({'succeeded': succeeded, 'failed': len(items) - succeeded,
+                    'results': [{'index': index, 'status': status_, 'message': message}
+                                for index, (status_, message) in enumerate(results)]}), status
+
+
 @app.route('/<author_id>/posts/<post_id>/likes', methods=['GET'])
 @token_required
+@valid_info_required
 def view_likes(author_id, post_id, **kwargs):
     # View all users who liked a post.
-    user_data = kwargs.get('user_data')
-    user_ = user.get(user_data.get('id'))
-    user_id, user_type = user_[0], user_[5]
+    # With `format=ndjson`, they are streamed one per line instead of being sent as one list.
+    if wants_ndjson():
+        author_post_mismatch(author_id, post.get_post_details(post_id))
+        return ndjson_response([user_.to_dict() for user_ in users] for users in post.iter_liked_users(post_id))
 
-    # Checks if user has valid info required.
-    if not user.info_valid(user_id, user_type):
-        return abort(403, message_403())
+    etag = post_etag(author_id, post_id, 'likes')
+    response = not_modified(etag)
+    if response is not None:
+        return response
 
     post_ = post.get_post_details(post_id)
     author_post_mismatch(author_id, post_)
 
     users = post.get_liked_users(post_id)
+    response = jsonify({'users': [user_.to_dict() for user_ in users]})
+    response.set_etag(etag)
+    return response, 200
 
-    output = []
 
-    for user_ in users:
-        user_data = {'id': user_[0], 'name': user_[1], 'email': user_[2], 'phone': user_[3],
-                     'occupation': user_[4], 'type': user_[5]}
-        output.append(user_data)
-    return jsonify({'users': output}), 200
+@app.route('/export', methods=['GET'])
+@token_required
+@valid_info_required
+def export(**kwargs):
+    # Streams every row of the table in the `table` query parameter, "post" or "like", as NDJSON for backups and
+    # analytics. Each line has the columns of the table, so the file can be loaded back with "flask import-data".
+    # Memory use stays the same however large the site is.
+    exporters = {'post': post.iter_all_posts, 'like': post.iter_all_likes}
+    table = request.args.get('table')
+    if table not in exporters:
+        abort(400, 'Choose the table to export with the `table` query parameter, "post" or "like".')
+
+    def chunks():
+        # The rows are read in one read transaction, so the export is a snapshot of the table even when rows are
+        # written while it is streamed.
+        db_ = db.get_db()
+        db_.execute('BEGIN')
+        try:
+            for rows in exporters[table]():
+                yield [row.to_export_dict() for row in rows]
+        finally:
+            db_.rollback()
+
+    return ndjson_response(chunks())
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Serves the metrics of this process in the Prometheus text format. They show how the site is used, so they are
+    # only served when METRICS_TOKEN is set in config.py, and the scraper must send it as a bearer token, or when
+    # METRICS_ENABLED is set to serve them to anyone, e.g. behind a proxy that only lets the scraper in.
+    metrics_token = app.config.get('METRICS_TOKEN')
+    if not metrics_token and not app.config.get('METRICS_ENABLED', False):
+        return abort(404, 'Resource not found!')
+    # The token is compared in constant time, so response times don't tell how much of it was guessed. As bytes, since
+    # compare_digest() rejects strings with non-ASCII characters.
+    sent = request.headers.get('Authorization', '').encode('utf8')
+    if metrics_token and not hmac.compare_digest(sent, ('Bearer ' + metrics_token).encode('utf8')):
+        return abort(401, 'Send the METRICS_TOKEN as a bearer token to read the metrics.')
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
 
 
 @app.errorhandler(HTTPException)
@@ -560,5 +915,11 @@ def handle_exception(e):
     return response
 
 
+@app.errorhandler(requests.RequestException)
+def handle_provider_error(e):
+    # Return a 502 when Google or Facebook can't be reached or times out, instead of a generic 500.
+    return handle_exception(BadGateway('Could not reach the login provider. Try again later.'))
+
+
 if __name__ == "__main__":
     app.run(debug=True, ssl_context='adhoc')
@@ -0,0 +1,95 @@
+# Contains the cache of verified tokens used by token_required
+# A client sends the same token with every request until it expires. Checking its signature and loading its user
+# every time costs more than the rest of many requests, so once a token is verified its claims and user are kept,
+# keyed by a digest of the token, until the token expires or AUTH_CACHE_TTL seconds pass. Entries of a user are
+# dropped when the user changes, like the user cache.
+import hashlib
+import threading
+import time
+
+import jwt
+from flask import current_app
+
+import user
+from cache import TTLCache
+from db import on_init_db
+
+
+class TokenCache:
+
+    def __init__(self, maxsize=4096, ttl=60):
+        self.hits = 0
+        self.misses = 0
+        self.verify_seconds = 0.0
+        self._entries = TTLCache(maxsize, ttl)
+        # Number of changes of each user id. An entry made before the last change of its user is outdated.
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize, ttl):
+        self._entries.configure(maxsize, ttl)
+
+    def authenticate(self, token):
+        # Returns (claims, user) of a token, or (claims, None) if its user does not exist. Raises
+        # jwt.exceptions.InvalidTokenError if the token is invalid or has expired.
+        key = (current_app.config['DATABASE'], hashlib.sha256(token.encode()).digest())
+        entry = self._entries.get(key)
+        if entry is not None:
+            claims, user_, generation = entry
+            if generation == self._generations.get(user_.id, 0):
+                with self._lock:
+                    self.hits += 1
+                return claims, user_
+
+        start = time.perf_counter()
+        claims = jwt.decode(token, current_app.config['SECRET_KEY'], ['HS256'])
+        generation = self._generations.get(claims.get('id'), 0)
+        user_ = user.get(claims.get('id'))
+        with self._lock:
+            self.misses += 1
+            self.verify_seconds += time.perf_counter() - start
+        if user_ is None:
+            return claims, None
+
+        # Keep the entry no longer than the token is valid.
+        ttl = self._entries.ttl
+        if 'exp' in claims:
+            ttl = min(ttl, claims['exp'] - time.time())
+        if ttl > 0:
+            self._entries.set(key, (claims, user_, generation), ttl)
+        return claims, user_
+
+    def forget_user(self, user_id):
+        # Makes the entries of a user outdated, so the next request with one of its tokens loads the user again.
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        # Returns the hit and miss counters, the seconds spent verifying tokens and loading users on misses, and an
+        # estimate of the seconds saved by the hits.
+        with self._lock:
+            average = self.verify_seconds / self.misses if self.misses else 0.0
+            return {'hits': self.hits, 'misses': self.misses, 'size': self._entries.stats()['size'],
+                    'verify_seconds': self.verify_seconds, 'saved_seconds': average * self.hits}
+
+
+token_cache = TokenCache()
+
+
+def init_app(app):
+    # Sets up the token cache with AUTH_CACHE_SIZE and AUTH_CACHE_TTL from the config. A change to a user made by
+    # another process is seen after at most AUTH_CACHE_TTL seconds, as with the user cache.
+    token_cache.configure(app.config.get('AUTH_CACHE_SIZE', 4096), app.config.get('AUTH_CACHE_TTL', 60))
+
+
+@user.on_change
+def forget_user(user_id):
+    token_cache.forget_user(user_id)
+
+
+@on_init_db
+def clear_cache():
+    token_cache.clear()
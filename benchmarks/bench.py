@@ -0,0 +1,280 @@
+# Benchmarks of the main routes at several data sizes
+# Each scenario sends requests through the Flask test client to a database built by datagen.py and reports the
+# throughput and the 50th, 95th and 99th percentiles of the latency. Requests pick users, authors and posts with the
+# same Zipf skew as the data, so popular posts are requested more often. Results can be saved as baselines and later
+# runs compared against them: a scenario whose p95 grew by more than --threshold is reported as a regression and the
+# command exits with status 1.
+#
+# Baselines depend on the machine, so compare runs made on the same machine. Usage (from the repository root):
+#   $ python benchmarks/bench.py --size small --size medium
+#   $ python benchmarks/bench.py --size small --save            # Record the baselines.
+#   $ python benchmarks/bench.py --size small --compare         # Flag regressions.
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import time
+
+import click
+
+import datagen
+from datagen import Zipf
+
+import auth
+import feed_cache
+import refresh_tokens
+from app import app, create_access_token
+from db import get_db, pool
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+SEARCH_WORDS = ('python', 'coffee', 'travel', 'garden recipe', 'weekend review', 'book')
+
+
+class Scenario:
+    # A kind of request. make(bench) returns (method, url, kwargs) for the next request, after doing any setup that
+    # should not be timed, like invalidating a cache. It runs in an app context of its own. ok is the set of expected
+    # status codes.
+
+    def __init__(self, name, make, ok=(200,)):
+        self.name = name
+        self.make = make
+        self.ok = ok
+
+
+class Bench:
+    # Picks users and posts for the requests of one database.
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        db = get_db()
+        self.users = [row[0] for row in db.execute('SELECT id FROM user ORDER BY id')]
+        # Posts ranked by likes, most liked first, so the Zipf ranks request popular posts most often.
+        self.posts = db.execute('SELECT id, author_id FROM post ORDER BY like_count DESC, id DESC').fetchall()
+        self.user_rank = Zipf(len(self.users), datagen.DEFAULT_SKEW, self.rng)
+        self.post_rank = Zipf(len(self.posts), datagen.DEFAULT_SKEW, self.rng)
+        self.tokens = {}
+        self.toggles = 0
+        self.toggled = None
+
+    def user(self):
+        return self.users[self.user_rank.draw()]
+
+    def post(self):
+        return tuple(self.posts[self.post_rank.draw()])
+
+    def headers(self, user_id=None):
+        # A token per user, reused like a real client does, so the token cache is warm after the first request.
+        user_id = user_id or self.user()
+        if user_id not in self.tokens:
+            self.tokens[user_id] = create_access_token(user_id)
+        return {'Authorization': 'Bearer ' + self.tokens[user_id]}
+
+
+def feed(bench):
+    # Mostly the first pages, as users rarely scroll far.
+    return 'GET', '/?page={}'.format(1 + min(int(bench.rng.expovariate(0.5)), 19)), {'headers': bench.headers()}
+
+
+def feed_uncached(bench):
+    feed_cache.feed_cache.invalidate()
+    return feed(bench)
+
+
+def user_posts(bench):
+    post_id, author_id = bench.post()
+    return 'GET', '/{}/posts'.format(author_id), {'headers': bench.headers()}
+
+
+def post_details(bench):
+    post_id, author_id = bench.post()
+    return 'GET', '/{}/posts/{}'.format(author_id, post_id), {'headers': bench.headers()}
+
+
+def view_likes(bench):
+    post_id, author_id = bench.post()
+    return 'GET', '/{}/posts/{}/likes'.format(author_id, post_id), {'headers': bench.headers()}
+
+
+def like_toggle(bench):
+    # Alternates liking a post the user has not liked and unliking it, so the data stays the same during the run.
+    bench.toggles += 1
+    if bench.toggles % 2:
+        while True:
+            bench.toggled = bench.post() + (bench.user(),)
+            if get_db().execute('SELECT 1 FROM like WHERE post_id = ? AND user_id = ?',
+                                (bench.toggled[0], bench.toggled[2])).fetchone() is None:
+                break
+    post_id, author_id, user_id = bench.toggled
+    method = 'POST' if bench.toggles % 2 else 'DELETE'
+    return method, '/{}/posts/{}/like'.format(author_id, post_id), {'headers': bench.headers(user_id)}
+
+
+def search(bench):
+    return 'GET', '/search', {'headers': bench.headers(), 'query_string': {'q': bench.rng.choice(SEARCH_WORDS)}}
+
+
+def auth_cached(bench):
+    return 'GET', '/info', {'headers': bench.headers()}
+
+
+def auth_uncached(bench):
+    auth.token_cache.clear()
+    return auth_cached(bench)
+
+
+def token_refresh(bench):
+    return 'POST', '/token/refresh', {'json': {'refresh_token': refresh_tokens.issue(bench.user())}}
+
+
+SCENARIOS = [
+    Scenario('feed', feed),
+    Scenario('feed_uncached', feed_uncached),
+    Scenario('user_posts', user_posts),
+    Scenario('post_details', post_details),
+    Scenario('view_likes', view_likes),
+    Scenario('like_toggle', like_toggle, ok=(200, 201)),
+    Scenario('search', search),
+    Scenario('auth_cached', auth_cached),
+    Scenario('auth_uncached', auth_uncached),
+    Scenario('token_refresh', token_refresh),
+]
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of a sorted list.
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(client, bench, scenario, requests_, warmup):
+    # Sends warmup untimed requests, then requests_ timed ones. Returns the results in milliseconds.
+    # Requests are sent outside of any app context, so each one gets its own as in production and takes its
+    # connection from the pool and gives it back. The setup of a request runs in a short app context before it.
+    latencies = []
+    errors = 0
+    for index in range(warmup + requests_):
+        with app.app_context():
+            method, url, kwargs = scenario.make(bench)
+        start = time.perf_counter()
+        response = client.open(url, method=method, **kwargs)
+        # Read the whole body, as streamed responses are only produced when read.
+        response.get_data()
+        elapsed = time.perf_counter() - start
+        if index < warmup:
+            continue
+        latencies.append(elapsed * 1000)
+        if response.status_code not in scenario.ok:
+            errors += 1
+    latencies.sort()
+    return {'requests': requests_, 'errors': errors, 'rps': round(requests_ / (sum(latencies) / 1000), 1),
+            'p50': round(percentile(latencies, 0.50), 3), 'p95': round(percentile(latencies, 0.95), 3),
+            'p99': round(percentile(latencies, 0.99), 3)}
+
+
+def run_size(size, names, requests_, warmup, seed, echo):
+    path = datagen.ensure(size, seed=seed, echo=echo)
+    # Work on a copy so the writes of the benchmarks don't change the generated database.
+    copy = path + '.run'
+    shutil.copyfile(path, copy)
+    old_config = {key: app.config.get(key) for key in ('DATABASE', 'TESTING')}
+    app.config.update({'DATABASE': copy, 'TESTING': True})
+    results = {}
+    try:
+        with app.app_context():
+            feed_cache.feed_cache.invalidate()
+            auth.token_cache.clear()
+            bench = Bench(seed)
+        client = app.test_client()
+        for scenario in SCENARIOS:
+            if names and scenario.name not in names:
+                continue
+            results[scenario.name] = run_scenario(client, bench, scenario, requests_, warmup)
+            echo(format_row(size, scenario.name, results[scenario.name]))
+    finally:
+        pool.dispose(copy)
+        app.config.update(old_config)
+        os.unlink(copy)
+    return results
+
+
+def format_row(size, name, result, note=''):
+    return '{:<8} {:<15} {:>9.1f} {:>9.3f} {:>9.3f} {:>9.3f} {:>6} {}'.format(
+        size, name, result['rps'], result['p50'], result['p95'], result['p99'], result['errors'], note).rstrip()
+
+
+def compare(results, baselines, threshold):
+    # Returns (size, scenario, baseline p95, p95) for every scenario whose p95 grew by more than threshold, a fraction,
+    # over its baseline. Scenarios without a baseline are skipped.
+    regressions = []
+    for size, scenarios in results.items():
+        for name, result in scenarios.items():
+            baseline = baselines.get('results', {}).get(size, {}).get(name)
+            if baseline and result['p95'] > baseline['p95'] * (1 + threshold):
+                regressions.append((size, name, baseline['p95'], result['p95']))
+    return regressions
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {'results': {}}
+    with open(path, encoding='utf8') as f:
+        return json.load(f)
+
+
+def save_baselines(path, results):
+    # Replaces the baselines of the sizes and scenarios that were run, keeping the others.
+    baselines = load_baselines(path)
+    for size, scenarios in results.items():
+        baselines['results'].setdefault(size, {}).update(scenarios)
+    baselines['machine'] = {'python': platform.python_version(), 'platform': platform.platform(),
+                            'processor': platform.processor() or platform.machine()}
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+@click.command()
+@click.option('--size', 'sizes', multiple=True, type=click.Choice(sorted(datagen.SIZES)),
+              help='Data size to run at. Can be repeated. Defaults to small.')
+@click.option('--scenario', 'names', multiple=True, type=click.Choice([s.name for s in SCENARIOS]),
+              help='Scenario to run. Can be repeated. Defaults to all.')
+@click.option('--requests', 'requests_', default=300, show_default=True, help='Timed requests per scenario.')
+@click.option('--warmup', default=30, show_default=True, help='Untimed requests before each scenario.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--save', is_flag=True, help='Save the results as the new baselines.')
+@click.option('--compare', 'compare_', is_flag=True, help='Compare the results with the baselines.')
+@click.option('--threshold', default=0.25, show_default=True,
+              help='Relative growth of p95 over its baseline reported as a regression.')
+@click.option('--baselines', 'baselines_path', default=BASELINES, show_default=True, type=click.Path(dir_okay=False))
+@click.option('--output', type=click.Path(dir_okay=False), help='Also write the results to this JSON file.')
+def main(sizes, names, requests_, warmup, seed, save, compare_, threshold, baselines_path, output):
+    """Benchmark the routes on generated databases and report their latency percentiles in milliseconds."""
+    click.echo('{:<8} {:<15} {:>9} {:>9} {:>9} {:>9} {:>6}'.format(
+        'size', 'scenario', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    results = {}
+    for size in sizes or ('small',):
+        results[size] = run_size(size, names, requests_, warmup, seed, click.echo)
+
+    if output:
+        with open(output, 'w', encoding='utf8') as f:
+            json.dump({'results': results}, f, indent=2, sort_keys=True)
+    if save:
+        save_baselines(baselines_path, results)
+        click.echo('Saved the baselines to {}.'.format(baselines_path))
+    if compare_:
+        regressions = compare(results, load_baselines(baselines_path), threshold)
+        for size, name, before, after in regressions:
+            click.echo('REGRESSION {} {}: p95 {:.3f} ms -> {:.3f} ms (+{:.0%})'.format(
+                size, name, before, after, after / before - 1))
+        if regressions:
+            sys.exit(1)
+        click.echo('No regression over {:.0%}.'.format(threshold))
+
+
+if __name__ == '__main__':
+    main()
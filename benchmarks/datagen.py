@@ -0,0 +1,186 @@
+# Builds databases of synthetic users, posts and likes for the benchmarks
+# The data is skewed the way a real blog is: a few authors write most posts and a few posts get most likes, following
+# a Zipf distribution, so the benchmarks see posts with thousands of likes as well as posts with none. The same
+# parameters and seed always give the same database. Rows are loaded with db.import_data(), the same path as
+# "flask import-data", so the indexes, counters and search index are built as they are in production.
+#
+# Usage (from the repository root):
+#   $ python benchmarks/datagen.py --size small
+#   $ python benchmarks/datagen.py --users 500 --posts 5000 --likes 20000 --output /tmp/blog.sqlite
+import bisect
+import datetime
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import click
+
+# The repository root holds the modules of the app.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import db
+from app import app
+
+# Number of (users, posts, likes) of each named size.
+SIZES = {
+    'tiny': (100, 1000, 5000),
+    'small': (1000, 10000, 50000),
+    'medium': (10000, 100000, 500000),
+    'large': (50000, 500000, 2500000),
+}
+
+# Zipf exponent of the number of posts per author and of likes per post and per user. Around 1 for social sites.
+DEFAULT_SKEW = 1.0
+
+# Databases built by ensure() are kept here between runs.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+WORDS = ('blog', 'python', 'flask', 'sqlite', 'coffee', 'travel', 'music', 'garden', 'recipe', 'weekend', 'review',
+         'story', 'photo', 'learning', 'project', 'update', 'morning', 'city', 'running', 'book', 'movie', 'family',
+         'design', 'code', 'school', 'summer', 'winter', 'market', 'news', 'idea', 'question', 'answer')
+OCCUPATIONS = ('Student', 'Teacher', 'Engineer', 'Designer', 'Nurse', 'Writer', 'Chef', 'Artist')
+
+FIRST_CREATED = datetime.datetime(2022, 1, 1)
+
+
+class Zipf:
+    # Draws ranks 0 to n - 1, rank k with a probability proportional to 1 / (k + 1) ** skew.
+
+    def __init__(self, n, skew, rng):
+        self.rng = rng
+        self.cum_weights = list(itertools.accumulate(1 / (k + 1) ** skew for k in range(n)))
+
+    def draw(self):
+        return bisect.bisect(self.cum_weights, self.rng.random() * self.cum_weights[-1])
+
+
+def file_name(users, posts, likes, skew, seed):
+    return 'u{}-p{}-l{}-s{}-r{}.sqlite'.format(users, posts, likes, skew, seed)
+
+
+def user_records(count, rng):
+    for id_ in range(1, count + 1):
+        # Every user has the info required to use the blog, so benchmarks can act as any of them.
+        if id_ % 2:
+            yield {'id': id_, 'name': 'user{}'.format(id_), 'email': 'user{}@example.com'.format(id_), 'phone': '',
+                   'occupation': rng.choice(OCCUPATIONS), 'type': 'Google'}
+        else:
+            yield {'id': id_, 'name': 'user{}'.format(id_), 'email': 'user{}@example.com'.format(id_),
+                   'phone': str(rng.randrange(10 ** 8, 10 ** 9)), 'occupation': '', 'type': 'Facebook'}
+
+
+def post_records(count, users, skew, rng):
+    # Posts are spread over a year in id order. Authors are ranked in a shuffled order so the prolific authors are not
+    # simply the first users.
+    authors = list(range(1, users + 1))
+    rng.shuffle(authors)
+    author_rank = Zipf(users, skew, rng)
+    step = 365 * 24 * 3600 / max(count, 1)
+    for id_ in range(1, count + 1):
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))).capitalize()
+        # Bodies from a sentence to a few paragraphs, so some of them are long enough for overflow pages.
+        body = ' '.join(rng.choice(WORDS) for _ in range(int(rng.paretovariate(1.5) * 20)))
+        created = FIRST_CREATED + datetime.timedelta(seconds=int(id_ * step))
+        yield {'id': id_, 'author_id': authors[author_rank.draw()], 'created': created.strftime('%Y-%m-%d %H:%M:%S'),
+               'title': title, 'body': body}
+
+
+def like_records(count, users, posts, skew, rng):
+    # Unique (post, user) pairs. The most liked posts are mostly the recent ones, as on a real feed, and a few users
+    # like much more than the others. A post liked by every user can't get more likes, so drawing gives up after
+    # trying many duplicates.
+    post_rank = Zipf(posts, skew, rng)
+    user_rank = Zipf(users, skew, rng)
+    post_order = list(range(posts, 0, -1))
+    # Swap a part of the ranks so popular posts are not only the most recent ones.
+    for _ in range(posts // 4):
+        i, j = rng.randrange(posts), rng.randrange(posts)
+        post_order[i], post_order[j] = post_order[j], post_order[i]
+    user_order = list(range(1, users + 1))
+    rng.shuffle(user_order)
+
+    seen = set()
+    attempts = 0
+    while len(seen) < count:
+        attempts += 1
+        if attempts > count * 20:
+            raise ValueError('Could not draw {} distinct likes; use fewer likes or more users or posts.'.format(count))
+        pair = (post_order[post_rank.draw()], user_order[user_rank.draw()])
+        if pair in seen:
+            continue
+        seen.add(pair)
+        created = FIRST_CREATED + datetime.timedelta(seconds=rng.randrange(365 * 24 * 3600))
+        yield {'post_id': pair[0], 'user_id': pair[1], 'created': created.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def generate(path, users, posts, likes, skew=DEFAULT_SKEW, seed=0, echo=None):
+    # Creates a new database at path with the given numbers of users, posts and likes. echo(message) is called with
+    # the progress.
+    rng = random.Random(seed)
+    echo = echo or (lambda message: None)
+    if os.path.exists(path):
+        os.unlink(path)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = {}
+        for table, records in (('user', user_records(users, rng)), ('post', post_records(posts, users, skew, rng)),
+                               ('like', like_records(likes, users, posts, skew, rng))):
+            files[table] = os.path.join(tmp, table + '.ndjson')
+            with open(files[table], 'w', encoding='utf8') as f:
+                for record in records:
+                    f.write(json.dumps(record))
+                    f.write('\n')
+
+        old_database = app.config['DATABASE']
+        app.config['DATABASE'] = path
+        try:
+            with app.app_context():
+                db.init_db()
+                for table in ('user', 'post', 'like'):
+                    start = time.perf_counter()
+                    rows = db.import_data(table, files[table], 'ndjson', batch_size=50000)
+                    echo('Imported {} {} row(s) in {:.1f}s.'.format(rows, table, time.perf_counter() - start))
+                db.get_db().execute('ANALYZE')
+        finally:
+            db.pool.dispose(path)
+            app.config['DATABASE'] = old_database
+
+
+def ensure(size, skew=DEFAULT_SKEW, seed=0, echo=None):
+    # Returns the path of the database of a named size, generating it in DATA_DIR if it doesn't exist yet.
+    users, posts, likes = SIZES[size]
+    path = os.path.join(DATA_DIR, file_name(users, posts, likes, skew, seed))
+    if not os.path.exists(path):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        # Build under another name so an interrupted run doesn't leave a partial database behind.
+        partial = path + '.partial'
+        generate(partial, users, posts, likes, skew, seed, echo)
+        os.replace(partial, path)
+    return path
+
+
+@click.command()
+@click.option('--size', type=click.Choice(sorted(SIZES)), help='Named size; overrides the counts.')
+@click.option('--users', default=1000, show_default=True)
+@click.option('--posts', default=10000, show_default=True)
+@click.option('--likes', default=50000, show_default=True)
+@click.option('--skew', default=DEFAULT_SKEW, show_default=True, help='Zipf exponent of the distributions.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), help='Database to create. Defaults to benchmarks/data/.')
+def main(size, users, posts, likes, skew, seed, output):
+    """Generate a database of synthetic users, posts and likes."""
+    if size:
+        users, posts, likes = SIZES[size]
+    if output is None:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        output = os.path.join(DATA_DIR, file_name(users, posts, likes, skew, seed))
+    generate(output, users, posts, likes, skew, seed, click.echo)
+    click.echo('Generated {}.'.format(output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+# Load test of the app under concurrent traffic
+# The app is served by the Werkzeug server in a child process, with a thread or a forked process per request, on a
+# copy of a database built by datagen.py. Virtual users log in through /google/callback and /facebook/callback against
+# a local stub of the OAuth providers, fill in their info with /updateinfo, then send a weighted mix of requests until
+# the duration is over. The report gives a latency histogram, percentiles and the error rate of each kind of request,
+# and how many requests failed because SQLite was locked, counted in the server with the got_request_exception signal.
+#
+# Usage (from the repository root):
+#   $ python benchmarks/loadtest.py --users 16 --duration 30
+#   $ python benchmarks/loadtest.py --server processes --mix feed=40,post=20,create=10,like=25,updateinfo=5
+#   $ python benchmarks/loadtest.py --set SQLITE_BUSY_TIMEOUT=0 --set LIKE_COMMIT_WINDOW=0.002
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import click
+import requests
+from flask import got_request_exception
+from werkzeug.serving import make_server
+
+import datagen
+from bench import percentile
+from datagen import Zipf
+
+import app as app_module
+import oauth
+
+# Upper bounds of the latency histogram buckets, in milliseconds. The last bucket holds everything slower.
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+DEFAULT_MIX = 'feed=50,post=20,create=5,like=20,updateinfo=5'
+
+
+class ProviderStub:
+    # Local HTTP server standing in for Google and Facebook. The token endpoint returns the authorization code as the
+    # access token, and the userinfo endpoints return the email of the virtual user named by that token, so every
+    # virtual user logs in as its own user.
+
+    def __init__(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/google':
+                    self.respond({'authorization_endpoint': stub.url('/auth'), 'token_endpoint': stub.url('/token'),
+                                  'userinfo_endpoint': stub.url('/userinfo')})
+                elif path == '/userinfo':
+                    code = self.headers.get('Authorization', '').partition(' ')[2]
+                    self.respond({'email': 'load{}@example.com'.format(code), 'email_verified': True})
+                else:
+                    self.respond({'error': 'not found'}, 404)
+
+            def do_POST(self):
+                form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+                self.respond({'access_token': form.get('code', [''])[0], 'token_type': 'Bearer'})
+
+            def respond(self, body, status=200):
+                data = json.dumps(body).encode('utf8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server.server_port, path)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def configure(app, database, overrides):
+    # Applies the --set overrides to the config of app and sets up again every part of the app that reads its settings
+    # when the app is set up, so they take effect.
+    app.config.update(overrides)
+    app.config['DATABASE'] = database
+    app_module.user.init_app(app)
+    app_module.feed_cache.init_app(app)
+    app_module.auth.init_app(app)
+    app_module.like_writer.init_app(app)
+    oauth.init_app(app, [app_module.GOOGLE_DISCOVERY_URL])
+
+
+def serve(database, server, processes, overrides, stub_url, ready, counters):
+    # Runs in the child process: sets up the app against the database and the provider stub, then serves it until the
+    # process is terminated. The port is put on ready. counters are shared with the parent: unhandled exceptions, and
+    # those that are SQLite lock errors.
+    app = app_module.app
+    # oauthlib only allows http URLs, as used by the stub, when this is set.
+    os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+    app_module.GOOGLE_DISCOVERY_URL = stub_url + '/google'
+    app_module.FACEBOOK_TOKEN_URL = stub_url + '/token'
+    app_module.FACEBOOK_USERINFO_URL = stub_url + '/userinfo'
+    configure(app, database, overrides)
+
+    def count_exception(sender, exception, **extra):
+        with counters.get_lock():
+            counters[0] += 1
+            if isinstance(exception, sqlite3.OperationalError) and 'locked' in str(exception):
+                counters[1] += 1
+
+    got_request_exception.connect(count_exception, app)
+    # Werkzeug logs every request and Flask every exception, which would slow the server down and flood the terminal.
+    # The exceptions are counted instead.
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app.logger.setLevel(logging.CRITICAL)
+
+    if server == 'processes':
+        httpd = make_server('127.0.0.1', 0, app, processes=processes)
+    else:
+        httpd = make_server('127.0.0.1', 0, app, threaded=True)
+    ready.put(httpd.server_port)
+    httpd.serve_forever()
+
+
+class Stats:
+    # Latencies in milliseconds and failures of one kind of request.
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.failures = 0
+
+    def add(self, elapsed, status, ok):
+        self.latencies.append(elapsed * 1000)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if not ok:
+            self.failures += 1
+
+    def merge(self, other):
+        self.latencies.extend(other.latencies)
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.failures += other.failures
+
+    def histogram(self):
+        counts = [0] * (len(BUCKETS) + 1)
+        for latency in self.latencies:
+            index = 0
+            while index < len(BUCKETS) and latency > BUCKETS[index]:
+                index += 1
+            counts[index] += 1
+        return counts
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return {'requests': count, 'failures': self.failures,
+                'error_rate': round(self.failures / count, 4) if count else 0.0,
+                'statuses': {str(status): n for status, n in sorted(self.statuses.items(), key=str)},
+                'p50': round(percentile(latencies, 0.50), 3), 'p95': round(percentile(latencies, 0.95), 3),
+                'p99': round(percentile(latencies, 0.99), 3), 'histogram': self.histogram()}
+
+
+class VirtualUser:
+    # One client with its own HTTP connection and user, sending requests of the mix one after the other.
+
+    def __init__(self, number, base_url, posts, mix, seed):
+        self.number = number
+        self.base_url = base_url
+        self.posts = posts
+        self.rng = random.Random(seed * 1000 + number)
+        self.post_rank = Zipf(len(posts), datagen.DEFAULT_SKEW, self.rng)
+        self.kinds, self.weights = zip(*mix.items())
+        self.session = requests.Session()
+        self.provider = 'google' if number % 2 else 'facebook'
+        self.liked = set()
+        self.logged_in = False
+        self.stats = {}
+
+    def request(self, kind, method, path, ok=(200,), **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=60, **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            status = 'connection error'
+            response = None
+        self.stats.setdefault(kind, Stats()).add(time.perf_counter() - start, status, status in ok)
+        return response
+
+    def login(self):
+        # Logs in as a new user through the provider stub and fills in the info required to use the blog.
+        response = self.request('login', 'GET', '/{}/callback'.format(self.provider), params={'code': self.number})
+        if response is None or response.status_code != 200:
+            return
+        self.session.headers['Authorization'] = 'Bearer ' + response.json()['token']
+        response = self.update_info()
+        self.logged_in = response is not None and response.status_code == 200
+
+    def update_info(self):
+        info = {'name': 'load{}'.format(self.number), 'occupation': 'Tester',
+                'phone': str(self.rng.randrange(10 ** 8, 10 ** 9))}
+        return self.request('updateinfo', 'PATCH', '/updateinfo', json=info)
+
+    def run(self, deadline):
+        # A user that could not log in would only get 401s, so it sends nothing.
+        while self.logged_in and time.monotonic() < deadline:
+            kind = self.rng.choices(self.kinds, self.weights)[0]
+            post_id, author_id = self.posts[self.post_rank.draw()]
+            if kind == 'feed':
+                self.request(kind, 'GET', '/', params={'page': 1 + min(int(self.rng.expovariate(0.5)), 19)})
+            elif kind == 'post':
+                self.request(kind, 'GET', '/{}/posts/{}'.format(author_id, post_id))
+            elif kind == 'create':
+                self.request(kind, 'POST', '/create', ok=(201,),
+                             json={'title': 'Load test post', 'body': ' '.join(self.rng.choices(datagen.WORDS, k=50))})
+            elif kind == 'like':
+                # Likes posts the user has not liked and unlikes those it has, so each request changes something.
+                if post_id in self.liked:
+                    self.liked.discard(post_id)
+                    self.request('unlike', 'DELETE', '/{}/posts/{}/like'.format(author_id, post_id))
+                else:
+                    response = self.request(kind, 'POST', '/{}/posts/{}/like'.format(author_id, post_id), ok=(201,))
+                    if response is not None and response.status_code == 201:
+                        self.liked.add(post_id)
+            elif kind == 'updateinfo':
+                self.update_info()
+
+
+def parse_mix(mix):
+    # Parses "feed=50,like=20" into {'feed': 50.0, 'like': 20.0}.
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        kind = kind.strip()
+        if kind not in ('feed', 'post', 'create', 'like', 'updateinfo'):
+            raise click.BadParameter('Unknown kind of request: {}.'.format(kind), param_hint='--mix')
+        try:
+            weights[kind] = float(weight)
+        except ValueError:
+            raise click.BadParameter('Weight of {} must be a number.'.format(kind), param_hint='--mix')
+    if not any(weights.values()):
+        raise click.BadParameter('At least one weight must be positive.', param_hint='--mix')
+    return weights
+
+
+def parse_overrides(items):
+    # Parses KEY=VALUE config overrides, reading VALUE as JSON when possible so numbers stay numbers.
+    overrides = {}
+    for item in items:
+        key, _, value = item.partition('=')
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+
+def run_workers(users, action):
+    # Runs action(user) for every virtual user in its own thread and waits for all of them.
+    threads = [threading.Thread(target=action, args=(user,)) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def format_report(stats, elapsed, counters):
+    lines = []
+    total = sum(len(s.latencies) for kind, s in stats.items() if kind != 'login')
+    lines.append('{} requests in {:.1f}s, {:.1f} req/s. Unhandled exceptions in the server: {}, of which "database '
+                 'is locked": {}.'.format(total, elapsed, total / elapsed if elapsed else 0, counters[0], counters[1]))
+    for kind, stats_ in sorted(stats.items()):
+        summary = stats_.summary()
+        lines.append('')
+        lines.append('{}: {} requests, {:.2%} errors, p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms, statuses {}'.format(
+            kind, summary['requests'], summary['error_rate'], summary['p50'], summary['p95'], summary['p99'],
+            ' '.join('{}x{}'.format(n, status) for status, n in summary['statuses'].items())))
+        histogram = summary['histogram']
+        largest = max(histogram) or 1
+        # Only the buckets from the fastest to the slowest request.
+        used = [index for index, count in enumerate(histogram) if count] or [0]
+        for index in range(used[0], used[-1] + 1):
+            count = histogram[index]
+            label = '<= {} ms'.format(BUCKETS[index]) if index < len(BUCKETS) else ' > {} ms'.format(BUCKETS[-1])
+            lines.append('  {:>12} {:>7} {}'.format(label, count, '#' * round(40 * count / largest)))
+    return '\n'.join(lines)
+
+
+@click.command()
+@click.option('--size', default='small', show_default=True, type=click.Choice(sorted(datagen.SIZES)),
+              help='Size of the generated database the test starts from.')
+@click.option('--users', default=8, show_default=True, help='Concurrent virtual users.')
+@click.option('--duration', default=20.0, show_default=True, help='Seconds to send requests for, after logging in.')
+@click.option('--mix', default=DEFAULT_MIX, show_default=True, help='Relative weights of the kinds of requests.')
+@click.option('--server', default='threaded', show_default=True, type=click.Choice(['threaded', 'processes']),
+              help='Serve each request in a thread or in a forked process.')
+@click.option('--processes', default=8, show_default=True, help='Most processes at once with --server processes.')
+@click.option('--set', 'overrides', multiple=True, metavar='KEY=VALUE', help='Config to change, e.g. '
+              'SQLITE_JOURNAL_MODE=DELETE. Can be repeated.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), help='Also write the results to this JSON file.')
+def main(size, users, duration, mix, server, processes, overrides, seed, output):
+    """Send a mix of concurrent requests to the app and report latencies, errors and SQLite lock errors."""
+    weights = parse_mix(mix)
+    path = datagen.ensure(size, seed=seed, echo=click.echo)
+    database = path + '.load'
+    shutil.copyfile(path, database)
+    db = sqlite3.connect(database)
+    posts = db.execute('SELECT id, author_id FROM post ORDER BY like_count DESC, id DESC').fetchall()
+    db.close()
+
+    stub = ProviderStub()
+    # fork keeps the modules imported here; the server process sets itself up before serving.
+    context = multiprocessing.get_context('fork')
+    ready = context.Queue()
+    counters = context.Array('i', 2)
+    child = context.Process(target=serve, args=(database, server, processes, parse_overrides(overrides),
+                                                stub.url(''), ready, counters), daemon=True)
+    child.start()
+    try:
+        base_url = 'http://127.0.0.1:{}'.format(ready.get(timeout=30))
+        virtual_users = [VirtualUser(number, base_url, posts, weights, seed) for number in range(1, users + 1)]
+
+        click.echo('Logging in {} virtual users...'.format(users))
+        run_workers(virtual_users, VirtualUser.login)
+        # Requests sent while logging in are reported separately from the mix.
+        for user in virtual_users:
+            user.stats = {'login': user.stats.pop('login')}
+        logged_in = sum(user.logged_in for user in virtual_users)
+        if logged_in < users:
+            click.echo('{} virtual user(s) could not log in.'.format(users - logged_in))
+
+        click.echo('Sending requests for {:.0f}s with {} server...'.format(duration, server))
+        start = time.monotonic()
+        run_workers(virtual_users, lambda user: user.run(start + duration))
+        elapsed = time.monotonic() - start
+    finally:
+        child.terminate()
+        child.join()
+        stub.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(database + suffix):
+                os.unlink(database + suffix)
+
+    stats = {}
+    for user in virtual_users:
+        for kind, stats_ in user.stats.items():
+            stats.setdefault(kind, Stats()).merge(stats_)
+    click.echo(format_report(stats, elapsed, counters))
+    if output:
+        with open(output, 'w', encoding='utf8') as f:
+            json.dump({'elapsed': elapsed, 'server': server, 'users': users, 'mix': weights, 'buckets': BUCKETS,
+                       'exceptions': counters[0], 'database_locked': counters[1],
+                       'results': {kind: stats_.summary() for kind, stats_ in stats.items()}}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
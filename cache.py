@@ -0,0 +1,75 @@
+# Contains an in-process cache for rows and pages that are read much more often than they change
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    # Thread-safe cache holding at most maxsize entries, each for at most ttl seconds. When the cache is full, the
+    # least recently used entry is evicted. None is used to report a miss, so it cannot be stored as a value.
+    # A maxsize of 0 disables the cache.
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize, ttl):
+        # Changes the size and ttl of the cache, evicting entries if it is now too small.
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._evict()
+
+    def get(self, key):
+        # Returns the value stored for key, or None if there is none or it has expired.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        # Stores value for key for ttl seconds, or the ttl of the cache if it is not given.
+        if self.maxsize <= 0:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        # Returns the counters of the cache, for monitoring.
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'expirations': self.expirations}
+
+    def _evict(self):
+        # Evicts the least recently used entries until the cache fits in maxsize. The lock must be held.
+        while len(self._entries) > max(self.maxsize, 0):
+            self._entries.popitem(last=False)
+            self.evictions += 1
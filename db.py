@@ -1,17 +1,201 @@
+import csv
+import datetime
+import email.utils
+import itertools
+import json
+import os
 import sqlite3
+import threading
+import time
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
+# Number of characters of the body stored as the excerpt of a post, shown in the feeds. The excerpt triggers in
+# schema.sql use the same number; change both together.
+EXCERPT_LENGTH = 100
+
+# Functions called after init_db() replaces all data, e.g. to empty caches of rows that no longer exist.
+_init_db_listeners = []
+
+# Functions called with (seconds, statement) after each call that runs SQL on a connection. statement is True for the
+# calls that run statements (execute, executemany, executescript, commit and rollback) and False for those that fetch
+# rows of a statement that already ran.
+_sql_listeners = []
+
+# Default SQLite settings. Each can be changed with the config key of the same name.
+# WAL lets readers run while a write is in progress. With it, synchronous NORMAL is safe against corruption and only
+# risks losing the last transactions on a power failure. SQLITE_CACHE_SIZE is in KiB when negative, as in SQLite.
+DEFAULT_SETTINGS = {
+    'SQLITE_JOURNAL_MODE': 'WAL',
+    'SQLITE_SYNCHRONOUS': 'NORMAL',
+    'SQLITE_BUSY_TIMEOUT': 5000,
+    'SQLITE_CACHE_SIZE': -16000,
+    'SQLITE_MMAP_SIZE': 64 * 1024 * 1024,
+    'SQLITE_POOL_SIZE': 8,
+    'SQLITE_CACHED_STATEMENTS': 256,
+}
+
+
+def _timed(method, statement):
+    # Wraps a method of a connection or cursor to report its time to the SQL listeners.
+    def timed(self, *args):
+        if not _sql_listeners:
+            return method(self, *args)
+        start = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            seconds = time.perf_counter() - start
+            for listener in _sql_listeners:
+                listener(seconds, statement)
+    return timed
+
+
+class TimedCursor(sqlite3.Cursor):
+    # A cursor whose calls are reported to the SQL listeners. Rows read by iterating over the cursor are not timed, as
+    # that would add a Python call to every row; statements of queries.py fetch with the methods below.
+    execute = _timed(sqlite3.Cursor.execute, True)
+    executemany = _timed(sqlite3.Cursor.executemany, True)
+    executescript = _timed(sqlite3.Cursor.executescript, True)
+    fetchone = _timed(sqlite3.Cursor.fetchone, False)
+    fetchmany = _timed(sqlite3.Cursor.fetchmany, False)
+    fetchall = _timed(sqlite3.Cursor.fetchall, False)
+
+
+class TimedConnection(sqlite3.Connection):
+    # A connection that reports all the SQL it runs to the SQL listeners, whether it comes from queries.py or not,
+    # including commits.
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # The shortcuts of sqlite3.Connection make a plain cursor, so they go through cursor() instead.
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def executescript(self, *args):
+        return self.cursor().executescript(*args)
+
+    commit = _timed(sqlite3.Connection.commit, True)
+    rollback = _timed(sqlite3.Connection.rollback, True)
+
+
+def on_sql(func):
+    # Decorator to register a function to be called with (seconds, statement) after each call that runs SQL on a
+    # connection. See _sql_listeners.
+    _sql_listeners.append(func)
+    return func
+
+
+def connect(database, config):
+    # Opens a connection to the db file at database, tuned with the SQLITE_* settings in config.
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update((key, config[key]) for key in DEFAULT_SETTINGS if key in config)
+
+    # A pooled connection is used by one request at a time but not always from the same thread.
+    db = sqlite3.connect(
+        database,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        timeout=int(settings['SQLITE_BUSY_TIMEOUT']) / 1000,
+        check_same_thread=False,
+        factory=TimedConnection,
+        # Keep every statement in queries.py prepared for the life of the connection.
+        cached_statements=int(settings['SQLITE_CACHED_STATEMENTS']),
+    )
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode = {}'.format(settings['SQLITE_JOURNAL_MODE']))
+    db.execute('PRAGMA synchronous = {}'.format(settings['SQLITE_SYNCHRONOUS']))
+    db.execute('PRAGMA busy_timeout = {:d}'.format(int(settings['SQLITE_BUSY_TIMEOUT'])))
+    db.execute('PRAGMA cache_size = {:d}'.format(int(settings['SQLITE_CACHE_SIZE'])))
+    db.execute('PRAGMA mmap_size = {:d}'.format(int(settings['SQLITE_MMAP_SIZE'])))
+    return db
+
+
+class ConnectionPool:
+    # Keeps the connections of finished requests open so the next requests reuse them instead of opening a new
+    # connection, setting it up and reading the schema again. Up to max_idle connections are kept per db file.
+    # Connections are never shared between processes: a forked worker starts with an empty pool.
+
+    def __init__(self):
+        self.opened = 0
+        self.reused = 0
+        self.closed = 0
+        self.in_use = 0
+        self._idle = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def acquire(self, database, config):
+        # Returns an idle connection to database, or a new one if there is none.
+        with self._lock:
+            self._check_process()
+            idle = self._idle.get(database)
+            db = idle.pop() if idle else None
+            self.in_use += 1
+            if db is not None:
+                self.reused += 1
+                return db
+            self.opened += 1
+        try:
+            return connect(database, config)
+        except sqlite3.Error:
+            with self._lock:
+                self.in_use -= 1
+            raise
+
+    def release(self, database, db, max_idle):
+        # Gives back a connection taken with acquire(). It is closed if max_idle connections are already idle.
+        if db.in_transaction:
+            db.rollback()
+        with self._lock:
+            self._check_process()
+            self.in_use -= 1
+            idle = self._idle.setdefault(database, [])
+            if len(idle) < max_idle:
+                idle.append(db)
+                return
+            self.closed += 1
+        db.close()
+
+    def dispose(self, database=None):
+        # Closes the idle connections to database, or to every db if it is not given.
+        with self._lock:
+            if database is None:
+                connections = [db for idle in self._idle.values() for db in idle]
+                self._idle.clear()
+            else:
+                connections = self._idle.pop(database, [])
+            self.closed += len(connections)
+        for db in connections:
+            db.close()
+
+    def stats(self):
+        # Returns the counters of the pool, for monitoring.
+        with self._lock:
+            return {'opened': self.opened, 'reused': self.reused, 'closed': self.closed, 'in_use': self.in_use,
+                    'idle': sum(len(idle) for idle in self._idle.values())}
+
+    def _check_process(self):
+        # Forgets the connections inherited from the parent process after a fork. They must not be used or closed
+        # here. The lock must be held.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = {}
+            self.in_use = 0
+
+
+pool = ConnectionPool()
+
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db_path = current_app.config['DATABASE']
+        g.db = pool.acquire(g.db_path, current_app.config)
 
     return g.db
 
@@ -20,7 +204,8 @@ def close_db(e=None):
     db = g.pop('db', None)
 
     if db is not None:
-        db.close()
+        pool.release(g.pop('db_path'), db,
+                      current_app.config.get('SQLITE_POOL_SIZE', DEFAULT_SETTINGS['SQLITE_POOL_SIZE']))
 
 
 def init_db():
@@ -29,6 +214,288 @@ def init_db():
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
 
+    for listener in _init_db_listeners:
+        listener()
+
+
+def on_init_db(func):
+    # Decorator to register a function to be called after init_db().
+    _init_db_listeners.append(func)
+    return func
+
+
+def get_migrations():
+    # Returns (version, file name) of every migration in the migrations folder, in the order they must be applied.
+    # The version is the number the file name starts with, e.g. 3 for 003_lookup_indexes.sql.
+    folder = os.path.join(current_app.root_path, 'migrations')
+    return sorted((int(name.split('_', 1)[0]), name) for name in os.listdir(folder) if name.endswith('.sql'))
+
+
+def get_schema_version():
+    # Returns the version of the last migration applied to the db. It is stored in the user_version of the db file.
+    return get_db().execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate_db():
+    # Applies every migration newer than the version of the db, keeping the existing data. Each migration runs in its
+    # own transaction with the version update, so a failed migration leaves the db at the previous version.
+    # Returns the file names of the applied migrations.
+    db = get_db()
+    applied = []
+    for version, name in get_migrations():
+        if version <= get_schema_version():
+            continue
+        with current_app.open_resource(os.path.join('migrations', name)) as f:
+            script = f.read().decode('utf8')
+        try:
+            db.executescript('BEGIN;\n{}\nPRAGMA user_version = {};\nCOMMIT;'.format(script, version))
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.rollback()
+            raise
+        applied.append(name)
+    return applied
+
+
+def find_like_count_mismatches():
+    # Returns (post_id, like_count, actual_count) for every post whose like_count does not match its rows in like.
+    db = get_db()
+    return db.execute(
+        'SELECT p.id, p.like_count, COUNT(l.post_id)'
+        ' FROM post p LEFT JOIN like l ON l.post_id = p.id'
+        ' GROUP BY p.id'
+        ' HAVING p.like_count <> COUNT(l.post_id)'
+    ).fetchall()
+
+
+def rebuild_like_counts():
+    # Recomputes like_count of every post from the like table. Returns the number of posts that were fixed.
+    db = get_db()
+    cursor = db.execute(
+        'UPDATE post SET like_count = (SELECT COUNT(*) FROM like WHERE like.post_id = post.id)'
+        ' WHERE like_count <> (SELECT COUNT(*) FROM like WHERE like.post_id = post.id)'
+    )
+    db.commit()
+    return cursor.rowcount
+
+
+def backfill_excerpts():
+    # Sets the excerpt of every post to the first EXCERPT_LENGTH characters of its body, where it is missing or
+    # different. Returns the number of posts that were updated.
+    db = get_db()
+    cursor = db.execute(
+        'UPDATE post SET excerpt = substr(body, 1, :length)'
+        ' WHERE excerpt IS NULL OR excerpt IS NOT substr(body, 1, :length)', {'length': EXCERPT_LENGTH}
+    )
+    db.commit()
+    return cursor.rowcount
+
+
+def rebuild_search_index():
+    # Rebuilds the full-text index of posts from the post table, then merges it into as few segments as possible so
+    # searches read less. Returns the number of indexed posts.
+    db = get_db()
+    db.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")
+    db.execute("INSERT INTO post_fts (post_fts) VALUES ('optimize')")
+    db.commit()
+    return db.execute('SELECT COUNT(*) FROM post').fetchone()[0]
+
+
+# Columns that can be imported into each table with import_data(). Columns left out of a file get their default.
+IMPORT_COLUMNS = {
+    'user': ('id', 'name', 'email', 'phone', 'occupation', 'type'),
+    'post': ('id', 'author_id', 'created', 'title', 'body'),
+    'like': ('post_id', 'user_id', 'created'),
+}
+
+
+def read_records(path, format_):
+    # Yields the records of a CSV file with a header row, or of an NDJSON file with one JSON object per line, as
+    # dicts. The file is read as it goes, so it can be larger than memory.
+    with open(path, newline='', encoding='utf8') as f:
+        if format_ == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    raise ValueError('Line {} of {} is not valid JSON.'.format(number, path))
+
+
+def import_data(table, path, format_, batch_size=10000, restart=False, on_batch=None):
+    # Imports the records of a file into table, batch_size rows per transaction. Returns the number of rows imported.
+    # The indexes and triggers of the table are dropped during the import and created again at the end, which is much
+    # faster than updating them row by row; what the triggers maintain is then recomputed for the whole table. This
+    # is also done when the import fails, so the rows committed before are complete.
+    # The number of committed rows is saved with each batch, so if the import stops (an invalid row, the process is
+    # killed...), running it again with the same file continues after the last committed row. restart=True imports
+    # the file from the start instead. on_batch(rows, seconds) is called after each batch with the totals so far.
+    db = get_db()
+    source = os.path.realpath(path)
+    if restart:
+        db.execute('DELETE FROM import_progress WHERE source = ? AND table_name = ?', (source, table))
+        db.commit()
+    progress = db.execute('SELECT rows, finished FROM import_progress WHERE source = ? AND table_name = ?',
+                          (source, table)).fetchone()
+    if progress is not None and progress['finished']:
+        raise ValueError('{} was already imported into {}. Use --restart to import it again.'.format(path, table))
+    done = progress['rows'] if progress is not None else 0
+
+    # The columns are those of the first record. They are checked before anything is changed.
+    records = read_records(path, format_)
+    first = next(records, None)
+    if first is None:
+        raise ValueError('{} has no records.'.format(path))
+    columns = _import_columns(table, first)
+    sql = _import_sql(table, columns)
+
+    _defer_schema(db, table, source)
+
+    imported = 0
+    start = time.perf_counter()
+    batch = []
+    try:
+        for index, record in enumerate(itertools.chain([first], records)):
+            if index < done:
+                continue
+            batch.append(_import_values(record, columns, index + 1))
+            if len(batch) >= batch_size:
+                imported += _insert_batch(db, sql, batch, source, table, done + imported)
+                batch = []
+                if on_batch is not None:
+                    on_batch(imported, time.perf_counter() - start)
+        if batch:
+            imported += _insert_batch(db, sql, batch, source, table, done + imported)
+            if on_batch is not None:
+                on_batch(imported, time.perf_counter() - start)
+    finally:
+        # A batch interrupted by something other than a db error is still in its transaction.
+        if db.in_transaction:
+            db.rollback()
+        restore_deferred_schema()
+        _rebuild_derived(table)
+
+    db.execute('UPDATE import_progress SET finished = 1 WHERE source = ? AND table_name = ?', (source, table))
+    db.commit()
+    return imported
+
+
+def restore_deferred_schema():
+    # Creates again the indexes and triggers dropped by import_data(), including those of an import whose process was
+    # killed.
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        for name, sql in db.execute('SELECT name, sql FROM import_deferred').fetchall():
+            db.execute(sql)
+        db.execute('DELETE FROM import_deferred')
+        db.commit()
+    except sqlite3.Error as e:
+        db.rollback()
+        raise ValueError('Could not create the indexes and triggers again: {}. They are saved in the import_deferred '
+                         'table.'.format(e))
+
+
+def _defer_schema(db, table, source):
+    # Drops the indexes and triggers of table, saving them in import_deferred, and records that the import of source
+    # started, in one transaction.
+    db.execute('BEGIN IMMEDIATE')
+    db.execute('INSERT OR IGNORE INTO import_progress (source, table_name) VALUES (?, ?)', (source, table))
+    objects = db.execute(
+        "SELECT type, name, sql FROM sqlite_master"
+        " WHERE type IN ('index', 'trigger') AND tbl_name = ? AND sql IS NOT NULL", (table,)
+    ).fetchall()
+    for type_, name, sql in objects:
+        db.execute('INSERT OR REPLACE INTO import_deferred (name, sql) VALUES (?, ?)', (name, sql))
+        db.execute('DROP {} "{}"'.format(type_.upper(), name))
+    db.commit()
+
+
+def _import_columns(table, record):
+    # Returns the columns of table found in record, the first record of a file.
+    columns = tuple(column for column in IMPORT_COLUMNS[table] if column in record)
+    unknown = set(record) - set(IMPORT_COLUMNS[table])
+    if unknown:
+        raise ValueError('Unknown column(s) for {}: {}. Expected some of: {}.'.format(
+            table, ', '.join(sorted(unknown)), ', '.join(IMPORT_COLUMNS[table])))
+    return columns
+
+
+def _import_created(value, number):
+    # Returns the created column of record number as stored by SQLite, 'YYYY-MM-DD HH:MM:SS' in UTC, which is the only
+    # form the timestamp converter can read back. Accepts that form, ISO 8601 (e.g. 2023-01-01T10:00:00Z) and HTTP
+    # dates as written by /export. Returns None for an empty value, so the db uses the current time.
+    if value is None or value == '':
+        return None
+    created = None
+    if isinstance(value, str):
+        try:
+            created = datetime.datetime.fromisoformat(value.strip())
+        except ValueError:
+            try:
+                created = email.utils.parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                pass
+    if created is None:
+        raise ValueError('Could not import row {}: created is {!r}, expected a date such as "2022-06-01 '
+                         '12:00:00".'.format(number, value))
+    if created.tzinfo is not None:
+        created = created.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return created.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _import_values(record, columns, number):
+    # Returns the values of the columns of record number, in the order of columns.
+    return tuple(_import_created(record.get(column), number) if column == 'created' else record.get(column)
+                 for column in columns)
+
+
+def _import_sql(table, columns):
+    # Returns the INSERT statement for the columns of table. An empty id or created lets the db choose it, since CSV
+    # files have no null values.
+    values = []
+    for column in columns:
+        if column == 'id':
+            values.append("NULLIF(?, '')")
+        elif column == 'created':
+            values.append("COALESCE(NULLIF(?, ''), CURRENT_TIMESTAMP)")
+        else:
+            values.append('?')
+    return 'INSERT INTO "{}" ({}) VALUES ({})'.format(table, ', '.join(columns), ', '.join(values))
+
+
+def _insert_batch(db, sql, batch, source, table, done):
+    # Inserts a batch of rows and saves the progress in one transaction. Returns the number of rows inserted.
+    try:
+        db.executemany(sql, batch)
+        db.execute('UPDATE import_progress SET rows = ? WHERE source = ? AND table_name = ?',
+                   (done + len(batch), source, table))
+        db.commit()
+    except sqlite3.Error as e:
+        db.rollback()
+        raise ValueError('Could not import rows {} to {}: {}. The rows before were imported; fix the file and run the '
+                         'command again to continue.'.format(done + 1, done + len(batch), e))
+    return len(batch)
+
+
+def _rebuild_derived(table):
+    # Recomputes what the dropped triggers of table keep up to date, for the whole table.
+    db = get_db()
+    if table == 'post':
+        backfill_excerpts()
+        rebuild_search_index()
+    elif table == 'like':
+        rebuild_like_counts()
+        db.execute('UPDATE post SET version = version + 1')
+    elif table == 'user':
+        db.execute('UPDATE post SET version = version + 1')
+    # Tell clients that the feeds changed.
+    db.execute("UPDATE revision SET value = value + 1 WHERE name = 'feed'")
+    db.commit()
+
 
 @click.command('init-db')
 @with_appcontext
@@ -38,6 +505,85 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    """Apply new migrations to the database, keeping its data."""
+    applied = migrate_db()
+    for name in applied:
+        click.echo('Applied {}.'.format(name))
+    click.echo('The database is at version {}.'.format(get_schema_version()))
+
+
+@click.command('rebuild-like-counts')
+@click.option('--verify-only', is_flag=True, help='Only report posts with a wrong like count.')
+@with_appcontext
+def rebuild_like_counts_command(verify_only):
+    """Recompute the like count of every post and verify the result."""
+    mismatches = find_like_count_mismatches()
+    click.echo('Found {} post(s) with a wrong like count.'.format(len(mismatches)))
+    if verify_only:
+        for post_id, like_count, actual_count in mismatches:
+            click.echo('Post {}: like_count is {}, expected {}.'.format(post_id, like_count, actual_count))
+        if mismatches:
+            raise click.exceptions.Exit(1)
+        return
+
+    fixed = rebuild_like_counts()
+    click.echo('Fixed {} post(s).'.format(fixed))
+    remaining = find_like_count_mismatches()
+    if remaining:
+        raise click.ClickException('{} post(s) still have a wrong like count.'.format(len(remaining)))
+    click.echo('Verified the like count of every post.')
+
+
+@click.command('backfill-excerpts')
+@with_appcontext
+def backfill_excerpts_command():
+    """Recompute the excerpt shown in the feeds for every post."""
+    updated = backfill_excerpts()
+    click.echo('Updated the excerpt of {} post(s).'.format(updated))
+
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index_command():
+    """Rebuild the full-text index used to search posts."""
+    count = rebuild_search_index()
+    click.echo('Indexed {} post(s).'.format(count))
+
+
+@click.command('import-data')
+@click.argument('table', type=click.Choice(sorted(IMPORT_COLUMNS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'format_', type=click.Choice(['csv', 'ndjson']),
+              help='Format of the file. By default, .csv files are read as CSV and other files as NDJSON.')
+@click.option('--batch-size', default=10000, show_default=True, help='Number of rows inserted per transaction.')
+@click.option('--restart', is_flag=True, help='Import the file from the start even if it was imported before.')
+@with_appcontext
+def import_data_command(table, path, format_, batch_size, restart):
+    """Import users, posts or likes from a CSV or NDJSON file."""
+    if format_ is None:
+        format_ = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+
+    def on_batch(rows, seconds):
+        click.echo('Imported {} row(s) ({:.0f} rows/s).'.format(rows, rows / seconds if seconds else 0))
+
+    start = time.perf_counter()
+    try:
+        imported = import_data(table, path, format_, batch_size, restart, on_batch)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    seconds = time.perf_counter() - start
+    click.echo('Imported {} row(s) into {} in {:.1f}s ({:.0f} rows/s).'.format(
+        imported, table, seconds, imported / seconds if seconds else 0))
+
+
 def init_app(app):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(import_data_command)
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(rebuild_like_counts_command)
+    app.cli.add_command(backfill_excerpts_command)
+    app.cli.add_command(rebuild_search_index_command)
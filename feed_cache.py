@@ -0,0 +1,127 @@
+# Contains the cache of rendered feed pages
+# A page of a feed is the same for every user until a post or a like is added or removed, or an author changes their
+# name. Pages are stored as the JSON body sent to the client, under a key that includes the feed revision read from the
+# db, the same value that is sent as ETag. Triggers bump the revision with any of those writes, whichever process or
+# tool makes them, which makes every page stored before it unreachable; old pages then simply expire.
+import threading
+
+from flask import current_app
+
+from cache import TTLCache
+from db import on_init_db
+
+
+class FeedCacheBackend:
+    # Storage used by FeedCache. The default MemoryBackend keeps pages in this process, so a write in one worker
+    # process does not reach the pages cached by the others until they expire. A backend shared by all processes
+    # (e.g. a cache server) implements these methods so that every worker sees the same pages and version.
+
+    def get(self, key):
+        # Returns the bytes stored for key, or None.
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        # Stores the bytes value for key for ttl seconds.
+        raise NotImplementedError
+
+    def incr(self, key):
+        # Atomically adds 1 to the integer stored for key, starting from 0, and returns the new value. It must not
+        # expire or be evicted.
+        raise NotImplementedError
+
+    def get_int(self, key):
+        # Returns the integer stored for key by incr(), or 0.
+        raise NotImplementedError
+
+
+class MemoryBackend(FeedCacheBackend):
+    # Keeps pages in this process, evicting the least recently used ones when more than maxsize are stored.
+
+    def __init__(self, maxsize=512):
+        self.pages = TTLCache(maxsize)
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.pages.get(key)
+
+    def set(self, key, value, ttl):
+        self.pages.set(key, value, ttl)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def get_int(self, key):
+        return self._counters.get(key, 0)
+
+
+class FeedCache:
+
+    def __init__(self, backend, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Guards the counters, which are updated by concurrent requests.
+        self._lock = threading.Lock()
+
+    def _generation_key(self):
+        # The generation is kept per db file.
+        return 'feed-generation:{}'.format(current_app.config['DATABASE'])
+
+    def version(self, revision):
+        # Returns the version to store the pages of the feeds under, given the feed revision read from the db. Read the
+        # revision before reading the posts of a page, so a page read while a write is happening is stored under the
+        # old revision. The version also counts the calls to invalidate(), since a new db starts at revision 0 again.
+        return '{}-{}'.format(self.backend.get_int(self._generation_key()), revision)
+
+    def get(self, version, page_key):
+        # Returns the JSON body of the page stored under page_key for version, or None.
+        body = self.backend.get(self._page_key(version, page_key))
+        with self._lock:
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return body
+
+    def set(self, version, page_key, body):
+        self.backend.set(self._page_key(version, page_key), body, self.ttl)
+
+    def invalidate(self):
+        # Makes every stored page outdated. Writes to the db don't need it, as they change the revision; it is called
+        # when the db is replaced.
+        with self._lock:
+            self.invalidations += 1
+        self.backend.incr(self._generation_key())
+
+    def stats(self):
+        # Returns the hit, miss and invalidation counters and the hit rate, for monitoring.
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def _page_key(self, version, page_key):
+        return 'feed:{}:{}:{}'.format(current_app.config['DATABASE'], version, page_key)
+
+
+feed_cache = FeedCache(MemoryBackend())
+
+
+def init_app(app):
+    # Sets up the feed cache from the config. FEED_CACHE_BACKEND may be set to a FeedCacheBackend instance to share the
+    # cache between processes; otherwise pages are kept in memory, per process. Pages are never outdated either way,
+    # since their key includes the revision read from the db. FEED_CACHE_TTL is how long a page is kept.
+    backend = app.config.get('FEED_CACHE_BACKEND') or MemoryBackend(app.config.get('FEED_CACHE_SIZE', 512))
+    feed_cache.backend = backend
+    feed_cache.ttl = app.config.get('FEED_CACHE_TTL', 60)
+
+
+@on_init_db
+def invalidate():
+    # Makes every cached feed page outdated.
+    feed_cache.invalidate()
@@ -0,0 +1,113 @@
+# Contains the writer that saves likes and unlikes, committing the writes of concurrent requests together
+# SQLite lets one connection write at a time and each commit waits for the disk, so when many users like a post at
+# once, committing every like on its own makes requests queue behind each other. Instead, the first request to write
+# becomes the leader: it waits for the batch being committed before it, then commits its writes together with the
+# writes every other request added in the meantime. The other requests wait for that commit and get their result.
+# When there is no contention a batch holds the writes of one request and nothing waits.
+import threading
+import time
+
+from flask import current_app
+
+import queries
+from db import get_db
+
+# Statement run for each kind of write. Their row count tells whether the write changed anything: liking a post twice
+# is ignored and unliking a post that is not liked deletes nothing, so no separate read is needed.
+STATEMENTS = {'like': 'like.insert', 'unlike': 'like.delete'}
+
+
+class _Batch:
+    # Writes committed together, and the results shared with the requests that added them.
+
+    def __init__(self):
+        self.writes = []
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class LikeWriter:
+
+    def __init__(self, window=0.0):
+        # window is how many seconds a leader waits for more writes before committing. Batches already form while the
+        # previous batch commits, so it is only worth setting under heavy load.
+        self.window = window
+        self.batches = 0
+        self.writes = 0
+        self._pending = {}
+        self._commit_locks = {}
+        self._lock = threading.Lock()
+
+    def write(self, writes):
+        # Saves writes, given as (kind, user_id, post_id) where kind is 'like' or 'unlike', in order. Returns for each
+        # write whether it changed anything: False for a like that already existed or an unlike of a post that was not
+        # liked. The writes are committed with those of concurrent requests to the same db.
+        database = current_app.config['DATABASE']
+        with self._lock:
+            batch = self._pending.get(database)
+            leader = batch is None
+            if leader:
+                batch = self._pending[database] = _Batch()
+                commit_lock = self._commit_locks.setdefault(database, threading.Lock())
+            start = len(batch.writes)
+            batch.writes.extend(writes)
+
+        if leader:
+            with commit_lock:
+                self._commit(batch, database)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[start:start + len(writes)]
+
+    def stats(self):
+        # Returns the number of batches committed and of writes in them, for monitoring.
+        with self._lock:
+            return {'batches': self.batches, 'writes': self.writes}
+
+    def _close(self, batch, database):
+        # Takes batch out of _pending. No more writes can join it after that.
+        with self._lock:
+            if self._pending.get(database) is batch:
+                del self._pending[database]
+
+    def _commit(self, batch, database):
+        # Waits for more writes, then runs and commits the writes of batch on the connection of the leader and wakes
+        # up the other requests. Whatever fails, the batch is closed and the other requests are woken up with an
+        # error, so none of them waits forever.
+        db = None
+        try:
+            if self.window:
+                time.sleep(self.window)
+            self._close(batch, database)
+            db = get_db()
+            batch.results = [queries.execute(STATEMENTS[kind], (post_id, user_id)).rowcount > 0
+                             for kind, user_id, post_id in batch.writes]
+            db.commit()
+            with self._lock:
+                self.batches += 1
+                self.writes += len(batch.writes)
+        except Exception as e:
+            if db is not None and db.in_transaction:
+                db.rollback()
+            batch.error = e
+        except BaseException:
+            # e.g. KeyboardInterrupt, which only the leader raises.
+            if db is not None and db.in_transaction:
+                db.rollback()
+            batch.error = RuntimeError('The likes were not saved: the request committing them was interrupted.')
+            raise
+        finally:
+            self._close(batch, database)
+            batch.done.set()
+
+
+writer = LikeWriter()
+
+
+def init_app(app):
+    # LIKE_COMMIT_WINDOW is how many seconds a batch of likes waits for more writes before it is committed.
+    writer.window = app.config.get('LIKE_COMMIT_WINDOW', 0.0)
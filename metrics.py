@@ -0,0 +1,283 @@
+# Contains the metrics of the requests served, exposed in the Prometheus text format at /metrics
+# A WSGI middleware around the app times every request from the moment it arrives until its body has been sent, which
+# includes streamed responses, and counts the bytes of the body. The SQL run on the db connections during a request,
+# including commits and SQL that doesn't come from queries.py, is counted and timed against its endpoint. Each
+# request adds to a few counters under one lock, so the overhead is a few microseconds. The counters of the caches,
+# the like writer, the connection pool and the OAuth client are read when /metrics is scraped. Metrics are kept per
+# process: with several worker processes, each must be scraped.
+import bisect
+import threading
+import time
+
+from flask import has_request_context, request
+
+import auth
+import feed_cache
+import like_writer
+import oauth
+import queries
+import user
+from db import on_sql, pool
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds of the histogram buckets. Prometheus adds the +Inf bucket.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+STATEMENT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+# Key of the RequestState of a request in the WSGI environ.
+ENVIRON_KEY = 'metrics.request'
+
+
+class Histogram:
+    # Number of observed values in each bucket, their sum and count. Not thread-safe: the owner holds a lock.
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestState:
+    # What is known about a request while it is served.
+    __slots__ = ('endpoint', 'method', 'status', 'statements', 'sql_seconds', 'size')
+
+    def __init__(self, method):
+        self.endpoint = None
+        self.method = method
+        self.status = '500'
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.size = 0
+
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.in_flight = 0
+        # (endpoint, method, status) -> number of requests
+        self.requests = {}
+        # endpoint -> Histogram
+        self.latency = {}
+        self.size = {}
+        self.statements = {}
+        # endpoint -> seconds spent running statements
+        self.sql_seconds = {}
+        self._lock = threading.Lock()
+
+    def started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def finished(self, state, seconds):
+        endpoint = state.endpoint or 'unmatched'
+        with self._lock:
+            self.in_flight -= 1
+            key = (endpoint, state.method, state.status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if endpoint not in self.latency:
+                self.latency[endpoint] = Histogram(LATENCY_BUCKETS)
+                self.size[endpoint] = Histogram(SIZE_BUCKETS)
+                self.statements[endpoint] = Histogram(STATEMENT_BUCKETS)
+                self.sql_seconds[endpoint] = 0.0
+            self.latency[endpoint].observe(seconds)
+            self.size[endpoint].observe(state.size)
+            self.statements[endpoint].observe(state.statements)
+            self.sql_seconds[endpoint] += state.sql_seconds
+
+    def snapshot(self):
+        # Returns copies of the metrics, taken under the lock so they are consistent with each other.
+        with self._lock:
+            copy = {}
+            for name in ('latency', 'size', 'statements'):
+                histograms = {}
+                for endpoint, histogram in getattr(self, name).items():
+                    histograms[endpoint] = Histogram(histogram.buckets)
+                    histograms[endpoint].counts = list(histogram.counts)
+                    histograms[endpoint].sum = histogram.sum
+                    histograms[endpoint].count = histogram.count
+                copy[name] = histograms
+            copy.update({'in_flight': self.in_flight, 'requests': dict(self.requests),
+                         'sql_seconds': dict(self.sql_seconds)})
+            return copy
+
+
+request_metrics = RequestMetrics()
+
+
+class _Body:
+    # Body of a response that counts its bytes as they are sent. The request is recorded once the last chunk is sent,
+    # or when the server closes the body, whichever comes first.
+
+    def __init__(self, body, state, start):
+        self.body = body
+        self.state = state
+        self.start = start
+        self.recorded = False
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.state.size += len(chunk)
+            yield chunk
+        self._record()
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self._record()
+
+    def _record(self):
+        if not self.recorded:
+            self.recorded = True
+            request_metrics.finished(self.state, time.perf_counter() - self.start)
+
+
+class MetricsMiddleware:
+    # Wraps the WSGI app to record every request in request_metrics.
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        state = environ[ENVIRON_KEY] = RequestState(environ.get('REQUEST_METHOD', ''))
+        request_metrics.started()
+
+        def record_status(status, headers, exc_info=None):
+            state.status = status.split(' ', 1)[0]
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, record_status)
+        except BaseException:
+            request_metrics.finished(state, time.perf_counter() - start)
+            raise
+        return _Body(body, state, start)
+
+
+def record_endpoint():
+    # Saves the endpoint of the request, known once it is routed, so it can be recorded after the request ends.
+    state = request.environ.get(ENVIRON_KEY)
+    if state is not None:
+        state.endpoint = request.endpoint
+
+
+@on_sql
+def count_sql(seconds, statement):
+    if has_request_context():
+        state = request.environ.get(ENVIRON_KEY)
+        if state is not None:
+            state.statements += statement
+            state.sql_seconds += seconds
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in labels) + '}'
+
+
+def _format_number(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class _Writer:
+    # Writes metrics in the Prometheus text format.
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, type_, help_, samples):
+        # samples is a list of (labels, value), labels a list of (name, value) pairs.
+        self.lines.append('# HELP {} {}'.format(name, help_))
+        self.lines.append('# TYPE {} {}'.format(name, type_))
+        for labels, value in samples:
+            self.lines.append('{}{} {}'.format(name, _labels(labels), _format_number(value)))
+
+    def histogram(self, name, help_, histograms, label):
+        # histograms maps the value of label to a Histogram.
+        self.lines.append('# HELP {} {}'.format(name, help_))
+        self.lines.append('# TYPE {} histogram'.format(name))
+        for key, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                le = bound if bound == '+Inf' else _format_number(bound)
+                self.lines.append('{}_bucket{} {}'.format(name, _labels([(label, key), ('le', le)]), cumulative))
+            self.lines.append('{}_sum{} {}'.format(name, _labels([(label, key)]), _format_number(histogram.sum)))
+            self.lines.append('{}_count{} {}'.format(name, _labels([(label, key)]), histogram.count))
+
+    def counters(self, prefix, help_, stats, names):
+        # One metric per counter in names from a stats() dict.
+        for name in names:
+            type_ = 'gauge' if name in ('size', 'in_use', 'idle', 'hit_rate', 'documents') else 'counter'
+            metric = '{}_{}{}'.format(prefix, name, '_total' if type_ == 'counter' else '')
+            self.metric(metric, type_, '{} ({}).'.format(help_, name.replace('_', ' ')), [([], stats[name])])
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def render():
+    # Returns every metric in the Prometheus text format.
+    snapshot = request_metrics.snapshot()
+    writer = _Writer()
+    writer.metric('blog_http_requests_in_flight', 'gauge', 'Requests being served.', [([], snapshot['in_flight'])])
+    writer.metric('blog_http_requests_total', 'counter', 'Requests served by endpoint, method and status.',
+                  [([('endpoint', endpoint), ('method', method), ('status', status)], count)
+                   for (endpoint, method, status), count in sorted(snapshot['requests'].items())])
+    writer.histogram('blog_http_request_duration_seconds', 'Time to serve a request, until its body is sent.',
+                     snapshot['latency'], 'endpoint')
+    writer.histogram('blog_http_response_size_bytes', 'Size of the response bodies.', snapshot['size'], 'endpoint')
+    writer.histogram('blog_http_sql_statements', 'SQL statements run per request, commits included.',
+                     snapshot['statements'], 'endpoint')
+    writer.metric('blog_http_sql_seconds_total', 'counter', 'Time spent running SQL and reading rows, by endpoint.',
+                  [([('endpoint', endpoint)], seconds)
+                   for endpoint, seconds in sorted(snapshot['sql_seconds'].items())])
+
+    statements = queries.stats()
+    writer.metric('blog_sql_statement_calls_total', 'counter', 'Calls of each SQL statement.',
+                  [([('statement', name)], stats['calls']) for name, stats in sorted(statements.items())])
+    writer.metric('blog_sql_statement_seconds_total', 'counter', 'Time spent running each SQL statement.',
+                  [([('statement', name)], stats['seconds']) for name, stats in sorted(statements.items())])
+
+    writer.counters('blog_feed_cache', 'Feed cache', feed_cache.feed_cache.stats(),
+                    ('hits', 'misses', 'invalidations'))
+    writer.counters('blog_auth_cache', 'Verified token cache', auth.token_cache.stats(),
+                    ('hits', 'misses', 'size', 'verify_seconds', 'saved_seconds'))
+    writer.counters('blog_user_cache', 'User cache', user.cache_stats(),
+                    ('hits', 'misses', 'size', 'evictions', 'expirations'))
+    writer.counters('blog_like_writer', 'Like writer', like_writer.writer.stats(), ('batches', 'writes'))
+    writer.counters('blog_db_pool', 'SQLite connection pool', pool.stats(),
+                    ('opened', 'reused', 'closed', 'in_use', 'idle'))
+    writer.counters('blog_oauth_discovery', 'OAuth discovery document cache', oauth.discovery_cache.stats(),
+                    ('documents', 'fetches', 'stale_hits', 'background_refreshes'))
+
+    calls = oauth.client.stats()
+    for name, help_ in (('calls', 'Calls'), ('errors', 'Failed calls'), ('seconds', 'Time spent in calls')):
+        writer.metric('blog_oauth_{}_total'.format(name), 'counter', '{} to the OAuth providers.'.format(help_),
+                      [([('endpoint', endpoint)], metrics[name]) for endpoint, metrics in sorted(calls.items())])
+    return writer.render()
+
+
+def init_app(app):
+    # Records the metrics of every request of app.
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+    app.before_request(record_endpoint)
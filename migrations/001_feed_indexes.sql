@@ -0,0 +1,3 @@
+-- Indexes for reading the feeds a page at a time in (created, id) order.
+CREATE INDEX IF NOT EXISTS idx_post_created ON post (created, id);
+CREATE INDEX IF NOT EXISTS idx_post_author_created ON post (author_id, created, id);
@@ -0,0 +1,14 @@
+-- Number of likes of each post, kept up to date by triggers.
+ALTER TABLE post ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE post SET like_count = (SELECT COUNT(*) FROM like WHERE like.post_id = post.id);
+
+CREATE TRIGGER IF NOT EXISTS like_count_insert AFTER INSERT ON like
+BEGIN
+  UPDATE post SET like_count = like_count + 1 WHERE id = NEW.post_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS like_count_delete AFTER DELETE ON like
+BEGIN
+  UPDATE post SET like_count = like_count - 1 WHERE id = OLD.post_id;
+END;
@@ -0,0 +1,3 @@
+-- Indexes for looking up users at login and the likes of a post, most recent first.
+CREATE INDEX IF NOT EXISTS idx_user_email_type ON user (email, type);
+CREATE INDEX IF NOT EXISTS idx_like_post_created ON like (post_id, created, user_id);
@@ -0,0 +1,34 @@
+-- Version numbers used as ETags. The feed revision changes with every write shown in the feeds, and the version of a
+-- post changes with every write shown on its details and likes. Both are kept up to date by triggers.
+CREATE TABLE IF NOT EXISTS revision (
+  name TEXT PRIMARY KEY,
+  value INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO revision (name, value) VALUES ('feed', 0);
+
+ALTER TABLE post ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+
+CREATE TRIGGER IF NOT EXISTS version_post_insert AFTER INSERT ON post
+BEGIN
+  UPDATE revision SET value = value + 1 WHERE name = 'feed';
+END;
+
+CREATE TRIGGER IF NOT EXISTS version_like_insert AFTER INSERT ON like
+BEGIN
+  UPDATE post SET version = version + 1 WHERE id = NEW.post_id;
+  UPDATE revision SET value = value + 1 WHERE name = 'feed';
+END;
+
+CREATE TRIGGER IF NOT EXISTS version_like_delete AFTER DELETE ON like
+BEGIN
+  UPDATE post SET version = version + 1 WHERE id = OLD.post_id;
+  UPDATE revision SET value = value + 1 WHERE name = 'feed';
+END;
+
+-- Posts show the name of their author and the info of the users who liked them.
+CREATE TRIGGER IF NOT EXISTS version_user_update AFTER UPDATE ON user
+BEGIN
+  UPDATE post SET version = version + 1
+  WHERE author_id = NEW.id OR id IN (SELECT post_id FROM like WHERE user_id = NEW.id);
+  UPDATE revision SET value = value + 1 WHERE name = 'feed';
+END;
@@ -0,0 +1,23 @@
+-- Full-text index of the title and body of posts, kept up to date by triggers.
+CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(
+  title, body, content='post', content_rowid='id', tokenize='porter unicode61'
+);
+
+CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post
+BEGIN
+  INSERT INTO post_fts (rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body);
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post
+BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);
+END;
+
+CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF title, body ON post
+BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);
+  INSERT INTO post_fts (rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body);
+END;
+
+-- Index the existing posts.
+INSERT INTO post_fts (post_fts) VALUES ('rebuild');
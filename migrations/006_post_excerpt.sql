@@ -0,0 +1,61 @@
+-- Stores the start of the body of each post so the feeds do not read whole bodies.
+-- SQLite keeps the end of a long row in overflow pages, and reading a column stored after a long body means going
+-- through all of them. SQLite can only add columns at the end of a table, so the table is rebuilt with excerpt and
+-- the small columns before body. legacy_alter_table keeps the triggers of other tables referring to post as they are
+-- while it is renamed.
+PRAGMA legacy_alter_table = ON;
+
+CREATE TABLE post_new (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  author_id INTEGER NOT NULL,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  like_count INTEGER NOT NULL DEFAULT 0,
+  version INTEGER NOT NULL DEFAULT 0,
+  title TEXT NOT NULL,
+  excerpt TEXT,
+  body TEXT NOT NULL,
+  FOREIGN KEY (author_id) REFERENCES user (id)
+);
+
+INSERT INTO post_new (id, author_id, created, like_count, version, title, excerpt, body)
+SELECT id, author_id, created, like_count, version, title, substr(body, 1, 100), body FROM post;
+
+DROP TABLE post;
+ALTER TABLE post_new RENAME TO post;
+
+PRAGMA legacy_alter_table = OFF;
+
+-- Dropping the old table dropped its indexes and triggers.
+CREATE INDEX idx_post_created ON post (created, id);
+CREATE INDEX idx_post_author_created ON post (author_id, created, id);
+
+CREATE TRIGGER version_post_insert AFTER INSERT ON post
+BEGIN
+  UPDATE revision SET value = value + 1 WHERE name = 'feed';
+END;
+
+CREATE TRIGGER post_fts_insert AFTER INSERT ON post
+BEGIN
+  INSERT INTO post_fts (rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body);
+END;
+
+CREATE TRIGGER post_fts_delete AFTER DELETE ON post
+BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);
+END;
+
+CREATE TRIGGER post_fts_update AFTER UPDATE OF title, body ON post
+BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);
+  INSERT INTO post_fts (rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body);
+END;
+
+CREATE TRIGGER post_excerpt_insert AFTER INSERT ON post WHEN NEW.excerpt IS NULL
+BEGIN
+  UPDATE post SET excerpt = substr(NEW.body, 1, 100) WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER post_excerpt_update AFTER UPDATE OF body ON post
+BEGIN
+  UPDATE post SET excerpt = substr(NEW.body, 1, 100) WHERE id = NEW.id;
+END;
@@ -0,0 +1,14 @@
+-- Progress of "flask import-data", so an interrupted import resumes after the last committed row.
+CREATE TABLE IF NOT EXISTS import_progress (
+  source TEXT NOT NULL,
+  table_name TEXT NOT NULL,
+  rows INTEGER NOT NULL DEFAULT 0,
+  finished INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (source, table_name)
+);
+
+-- Indexes and triggers dropped while an import runs, to be created again when it finishes.
+CREATE TABLE IF NOT EXISTS import_deferred (
+  name TEXT PRIMARY KEY,
+  sql TEXT NOT NULL
+);
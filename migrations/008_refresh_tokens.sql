@@ -0,0 +1,16 @@
+-- Refresh tokens given at login and exchanged at /token/refresh for new access tokens. Only a hash of each token is
+-- stored. Each exchange marks the token used and issues the next token of its family, the chain of tokens that
+-- started with one login.
+CREATE TABLE IF NOT EXISTS refresh_token (
+  id INTEGER PRIMARY KEY,
+  token_hash TEXT NOT NULL UNIQUE,
+  family TEXT NOT NULL,
+  user_id INTEGER NOT NULL,
+  expires INTEGER NOT NULL,
+  used INTEGER NOT NULL DEFAULT 0,
+  revoked INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY (user_id) REFERENCES user (id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_refresh_token_family ON refresh_token (family);
+CREATE INDEX IF NOT EXISTS idx_refresh_token_user ON refresh_token (user_id);
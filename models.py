@@ -0,0 +1,89 @@
+# Contains the classes that rows of the user, post and like tables and search results are loaded into
+# They use __slots__ to keep each row small, and to_dict() is the one place a row is turned into the dict sent back
+# as JSON.
+import html
+
+# Form of the dates written by exports: the one SQLite stores timestamps in, in UTC, so "flask import-data" can read
+# them back as they are.
+EXPORT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Characters the search statement puts around matches in place of <mark> and </mark>.
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+
+class User:
+    __slots__ = ('id', 'name', 'email', 'phone', 'occupation', 'type')
+
+    def __init__(self, id_, name, email, phone, occupation, type_):
+        self.id = id_
+        self.name = name
+        self.email = email
+        self.phone = phone
+        self.occupation = occupation
+        self.type = type_
+
+    def to_dict(self):
+        return {'id': self.id, 'name': self.name, 'email': self.email, 'phone': self.phone,
+                'occupation': self.occupation, 'type': self.type}
+
+
+class Post:
+    __slots__ = ('id', 'title', 'body', 'created', 'author_id', 'author_name')
+
+    def __init__(self, id_, title, body, created, author_id, author_name):
+        self.id = id_
+        self.title = title
+        self.body = body
+        self.created = created
+        self.author_id = author_id
+        self.author_name = author_name
+
+    def to_dict(self, likes):
+        # likes is the text describing who liked the post.
+        return {'title': self.title, 'body': self.body, 'created': self.created, 'author_id': self.author_id,
+                'author_name': self.author_name, 'likes': likes}
+
+    def to_export_dict(self):
+        # The post as written by exports: the columns of the post table, which "flask import-data" reads back.
+        return {'id': self.id, 'author_id': self.author_id, 'created': self.created.strftime(EXPORT_DATE_FORMAT),
+                'title': self.title, 'body': self.body}
+
+
+class SearchResult:
+    # A post found by a search. title is the full title and snippet the part of the body that best matches the
+    # search, both escaped as HTML with the matching terms wrapped in <mark></mark>.
+    __slots__ = ('id', 'title', 'snippet', 'created', 'author_id', 'author_name')
+
+    def __init__(self, id_, title, snippet, created, author_id, author_name):
+        self.id = id_
+        self.title = mark_matches(title)
+        self.snippet = mark_matches(snippet)
+        self.created = created
+        self.author_id = author_id
+        self.author_name = author_name
+
+    def to_dict(self, likes):
+        return {'post_id': self.id, 'title': self.title, 'snippet': self.snippet, 'created': self.created,
+                'author_id': self.author_id, 'author_name': self.author_name, 'likes': likes}
+
+
+def mark_matches(text):
+    # Escapes the text of a post, so it can be shown as HTML, and only then turns the delimiters of matches into tags.
+    return html.escape(text).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+class Like:
+    __slots__ = ('post_id', 'user_id', 'created')
+
+    def __init__(self, post_id, user_id, created):
+        self.post_id = post_id
+        self.user_id = user_id
+        self.created = created
+
+    def to_dict(self):
+        return {'post_id': self.post_id, 'user_id': self.user_id, 'created': self.created}
+
+    def to_export_dict(self):
+        # The like as written by exports, see Post.to_export_dict().
+        return {'post_id': self.post_id, 'user_id': self.user_id, 'created': self.created.strftime(EXPORT_DATE_FORMAT)}
@@ -0,0 +1,222 @@
+# Contains functions relating to the Google and Facebook OAuth 2 providers
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Seconds a discovery document is kept when the provider does not send a max-age.
+DEFAULT_DISCOVERY_TTL = 3600
+# Seconds an expired discovery document may still be served while a fresh copy is fetched in the background.
+DEFAULT_DISCOVERY_STALE_TTL = 86400
+
+
+class OutboundClient:
+    # Shared HTTP client for every call to the providers. It keeps connections alive in a pool per host instead of
+    # opening a new TCP and TLS connection per call, applies connect and read timeouts so a slow provider can't hold a
+    # worker forever, and retries failed calls a bounded number of times with exponential backoff. Only connection
+    # errors are retried for POST requests, since the provider never saw them.
+    # The latency of each call is recorded under the name of the endpoint it was made to.
+
+    def __init__(self, pool_size=10, connect_timeout=3.05, read_timeout=10, retries=2, backoff=0.2):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.mount('https://', pool_size)
+        self.mount('http://', pool_size)
+        # endpoint -> {'calls', 'errors', 'seconds', 'max_seconds'}
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def mount(self, prefix, pool_size):
+        # Uses a pool of up to pool_size kept-alive connections per host for URLs starting with prefix.
+        retry = Retry(total=self.retries, backoff_factor=self.backoff, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'HEAD']), raise_on_status=False)
+        self.session.mount(prefix, HTTPAdapter(pool_maxsize=pool_size, max_retries=retry))
+
+    def request(self, endpoint, method, url, **kwargs):
+        # Sends a request and records its latency under endpoint. Raises requests.RequestException if it fails.
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = self.session.request(method, url, **kwargs)
+            failed = False
+            return response
+        finally:
+            self._record(endpoint, time.perf_counter() - start, failed)
+
+    def get(self, endpoint, url, **kwargs):
+        return self.request(endpoint, 'GET', url, **kwargs)
+
+    def post(self, endpoint, url, **kwargs):
+        return self.request(endpoint, 'POST', url, **kwargs)
+
+    def _record(self, endpoint, seconds, failed):
+        with self._lock:
+            metrics = self._metrics.setdefault(endpoint, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            metrics['calls'] += 1
+            metrics['errors'] += failed
+            metrics['seconds'] += seconds
+            metrics['max_seconds'] = max(metrics['max_seconds'], seconds)
+
+    def stats(self):
+        # Returns the calls, errors, total and maximum latency of each endpoint, for monitoring.
+        with self._lock:
+            return {endpoint: dict(metrics) for endpoint, metrics in self._metrics.items()}
+
+
+client = OutboundClient()
+
+
+def parse_cache_control(header):
+    # Returns the directives of a Cache-Control header as a dict, e.g. {'max-age': '3600', 'public': None}.
+    directives = {}
+    for directive in (header or '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip('"') or None
+    return directives
+
+
+def _seconds(value):
+    # Returns a Cache-Control delta-seconds value as an int, or None if it is missing or malformed.
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class DiscoveryCache:
+    # Keeps the OpenID discovery documents of the providers so logins do not fetch them on every request.
+    # A document is fresh for the max-age sent by the provider, or for ttl seconds if there is none. After that it is
+    # still served for stale_ttl seconds (or the provider's stale-while-revalidate) while a single background thread
+    # fetches a new copy. Only once it is older than that does a request wait for the provider.
+
+    def __init__(self, ttl=DEFAULT_DISCOVERY_TTL, stale_ttl=DEFAULT_DISCOVERY_STALE_TTL):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.fetches = 0
+        self.background_refreshes = 0
+        self.stale_hits = 0
+        # url -> (fresh_until, stale_until, document)
+        self._documents = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def configure(self, ttl, stale_ttl):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+    def get(self, url):
+        # Returns the discovery document at url.
+        entry = self._documents.get(url)
+        if entry is not None:
+            fresh_until, stale_until, document = entry
+            now = time.monotonic()
+            if now < fresh_until:
+                return document
+            if now < stale_until:
+                self.stale_hits += 1
+                self.refresh_in_background(url)
+                return document
+        return self.fetch(url)
+
+    def fetch(self, url):
+        # Fetches the discovery document at url from the provider and stores it. Raises requests.RequestException
+        # if it can't be fetched.
+        response = self.request(url)
+        response.raise_for_status()
+        document = response.json()
+
+        directives = parse_cache_control(response.headers.get('Cache-Control'))
+        if 'no-store' in directives or 'no-cache' in directives:
+            # no-store must not be kept at all. no-cache may only be reused after checking with the provider, which
+            # costs a request anyway, so it is not kept either. Both are fetched again by the next request.
+            with self._lock:
+                self.fetches += 1
+                self._documents.pop(url, None)
+            return document
+        ttl = _seconds(directives.get('max-age'))
+        if ttl is None:
+            ttl = self.ttl
+        stale_ttl = _seconds(directives.get('stale-while-revalidate'))
+        if stale_ttl is None:
+            stale_ttl = self.stale_ttl
+
+        now = time.monotonic()
+        with self._lock:
+            self.fetches += 1
+            self._documents[url] = (now + ttl, now + ttl + stale_ttl, document)
+        return document
+
+    def request(self, url):
+        # Sends the GET request for a discovery document.
+        return client.get('discovery', url)
+
+    def refresh_in_background(self, url):
+        # Fetches a new copy of the document at url in a background thread, unless one is already doing so.
+        # If the fetch fails, the stale copy keeps being served until it is too old.
+        with self._lock:
+            if url in self._refreshing:
+                return
+            self._refreshing.add(url)
+            self.background_refreshes += 1
+
+        def refresh():
+            try:
+                self.fetch(url)
+            except (requests.RequestException, ValueError):
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing.discard(url)
+
+        threading.Thread(target=refresh, name='discovery-refresh', daemon=True).start()
+
+    def preload(self, urls, background=True):
+        # Fetches the documents at urls ahead of the first login. Failures are ignored; the document is then fetched
+        # again by the first request that needs it.
+        def load():
+            for url in urls:
+                try:
+                    self.fetch(url)
+                except (requests.RequestException, ValueError):
+                    pass
+
+        if background:
+            threading.Thread(target=load, name='discovery-preload', daemon=True).start()
+        else:
+            load()
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+
+    def stats(self):
+        # Returns the counters of the cache, for monitoring.
+        return {'documents': len(self._documents), 'fetches': self.fetches, 'stale_hits': self.stale_hits,
+                'background_refreshes': self.background_refreshes}
+
+
+discovery_cache = DiscoveryCache()
+
+
+def init_app(app, discovery_urls, provider_pools=()):
+    # Sets up the outbound client and the discovery cache from the config, and preloads the documents at
+    # discovery_urls if OAUTH_PRELOAD_DISCOVERY is set. provider_pools lists (url prefix, pool size) pairs giving a
+    # provider's hosts their own pool size.
+    global client
+    client = OutboundClient(app.config.get('OAUTH_POOL_SIZE', 10),
+                            app.config.get('OAUTH_CONNECT_TIMEOUT', 3.05),
+                            app.config.get('OAUTH_READ_TIMEOUT', 10),
+                            app.config.get('OAUTH_RETRIES', 2),
+                            app.config.get('OAUTH_RETRY_BACKOFF', 0.2))
+    for prefix, pool_size in provider_pools:
+        client.mount(prefix, pool_size)
+    discovery_cache.configure(app.config.get('OAUTH_DISCOVERY_TTL', DEFAULT_DISCOVERY_TTL),
+                              app.config.get('OAUTH_DISCOVERY_STALE_TTL', DEFAULT_DISCOVERY_STALE_TTL))
+    if app.config.get('OAUTH_PRELOAD_DISCOVERY', False):
+        discovery_cache.preload(discovery_urls)
@@ -1,99 +1,133 @@
 # Contains functions relating to posts
-from db import get_db
+import json
 
+import like_writer
+import queries
+from db import EXCERPT_LENGTH, get_db
+
+
+def get_homepage(limit, offset=0, after=None):
+    # Shows a page of posts that are on the home page, most recent first.
+    # Only the rows of the requested page are read, so the cost does not grow with the number of posts.
+    # If after is given (the id of the last post on the previous page), the page starts right after that post and
+    # offset is ignored. Such a page costs the same no matter how deep it is.
+    if after is not None:
+        return queries.fetch_all('post.homepage_after', (after, limit))
+    return queries.fetch_all('post.homepage', (limit, offset))
+
+
+def get_user_page(user_id, limit, offset=0, after=None):
+    # Shows a page of posts that are made by one user, most recent first. Pagination works like get_homepage().
+    if after is not None:
+        return queries.fetch_all('post.user_page_after', (user_id, after, limit))
+    return queries.fetch_all('post.user_page', (user_id, limit, offset))
+
+
+def iter_user_posts(user_id):
+    # Yields all posts made by one user in lists, most recent first. See queries.fetch_chunks().
+    return queries.fetch_chunks('post.user_all', (user_id,))
 
-def get_homepage():
-    # Shows posts that are on the home page, most recent first
-    db = get_db()
-    posts = db.execute(
-        'SELECT p.id, title, body, created, author_id, name'
-        ' FROM post p JOIN user u ON p.author_id = u.id'
-        ' ORDER BY created DESC'
-    ).fetchall()
-    return posts
-
-
-def get_user_page(user_id):
-    # Shows posts that are made by one user
-    db = get_db()
-    posts = db.execute(
-        'SELECT p.id, title, body, created, author_id, name'
-        ' FROM post p JOIN user u ON p.author_id = u.id'
-        ' WHERE u.id = ?'
-        ' ORDER BY created DESC', (user_id,)
-    ).fetchall()
-
-    # Convert type Row to tuple to avoid datatype Row not serializable error
-    posts = [tuple(row) for row in posts]
-    return posts
+
+def iter_all_posts():
+    # Yields every post with its full body in lists, by id, for exports.
+    return queries.fetch_chunks('post.export')
+
+
+def iter_all_likes():
+    # Yields every like in lists, for exports.
+    return queries.fetch_chunks('like.export')
+
+
+def iter_liked_users(post_id):
+    # Yields all users who liked a post in lists, most recent first.
+    return queries.fetch_chunks('like.users', (post_id,))
 
 
 def get_post_details(post_id):
     # Shows a post with its full body that's not limited to the first 100 characters
     # Shows posts that are on the home page, most recent first
-    db = get_db()
-    post = db.execute(
-        'SELECT p.id, title, body, created, author_id, name'
-        ' FROM post p JOIN user u ON p.author_id = u.id'
-        ' WHERE p.id = ?', (post_id,)
-    ).fetchone()
-    return post
+    return queries.fetch_one('post.details', (post_id,))
+
+
+def search_posts(terms, limit, offset=0):
+    # Returns a page of the posts whose title or body contain every word of terms, best match first.
+    return queries.fetch_all('post.search', (make_match_query(terms), limit, offset))
+
+
+def make_match_query(terms):
+    # Turns the words typed by a user into an FTS5 query matching posts that contain all of them. Each word is quoted
+    # so characters such as - or * and keywords such as OR are searched for as text instead of being query syntax.
+    # Control characters are dropped: FTS5 rejects a query containing NUL. Returns '' if no word is left.
+    terms = ''.join(c if c.isprintable() or c.isspace() else ' ' for c in terms)
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in terms.split())
+
+
+def get_feed_revision():
+    # Returns a number that changes whenever a write changes what the feeds show.
+    return queries.fetch_one('revision.get', ('feed',))[0]
+
+
+def get_post_version(post_id):
+    # Returns (author_id, version) of a post, or None if it does not exist. The version changes whenever a write
+    # changes the details or the likes of the post.
+    return queries.fetch_one('post.version', (post_id,))
 
 
 def insert_post(author_id, title, body):
-    # Insert a post into the db
-    db = get_db()
-    db.execute(
-        "INSERT INTO post (author_id, title, body) "
-        "VALUES (?, ?, ?)",
-        (author_id, title, body),
-    )
-    db.commit()
+    # Insert a post into the db, with the excerpt shown in the feeds
+    queries.execute('post.insert', (author_id, title, body[:EXCERPT_LENGTH], body))
+    get_db().commit()
+
+
+def insert_posts(author_id, posts):
+    # Insert many posts, given as (title, body) pairs, into the db in one transaction. Either all of them are saved
+    # or none is.
+    queries.execute_many('post.insert', ((author_id, title, body[:EXCERPT_LENGTH], body) for title, body in posts))
+    get_db().commit()
 
 
 def is_liked(liker_id, post_id):
     # Returns True if there is a record of a user liking a post in the db
-    db = get_db()
-    like_ = db.execute(
-        "SELECT * FROM like WHERE post_id = ? AND user_id = ?", (post_id, liker_id)
-    ).fetchone()
+    return get_like(liker_id, post_id) is not None
+
 
-    if like_:
-        return True
-    return False
+def get_like(liker_id, post_id):
+    # Returns the like of a user on a post, or None if the user has not liked it
+    return queries.fetch_one('like.get', (post_id, liker_id))
 
 
 def insert_like(liker_id, post_id):
-    # Insert a like into the db
-    db = get_db()
-    db.execute(
-        "INSERT INTO like (post_id, user_id) "
-        "VALUES (?, ?)",
-        (post_id, liker_id),
-    )
-    db.commit()
+    # Insert a like into the db. Returns False if the user had already liked the post.
+    return like_writer.writer.write([('like', liker_id, post_id)])[0]
 
 
 def delete_like(liker_id, post_id):
-    # Delete a like from the db
-    db = get_db()
-    db.execute(
-        "DELETE FROM like "
-        "WHERE post_id = ? AND user_id = ?", (post_id, liker_id),
-    )
-    db.commit()
+    # Delete a like from the db. Returns False if the user had not liked the post.
+    return like_writer.writer.write([('unlike', liker_id, post_id)])[0]
+
+
+def write_likes(writes):
+    # Saves many likes and unlikes, given as (kind, user_id, post_id) where kind is 'like' or 'unlike', in one
+    # transaction. Returns for each write whether it changed anything.
+    return like_writer.writer.write(writes)
+
+
+def get_existing_posts(post_ids):
+    # Returns the set of the ids in post_ids that belong to a post.
+    return {row[0] for row in queries.fetch_all('post.existing', (json.dumps(list(post_ids)),))}
 
 
 def get_liked_users(post_id):
     # Get all users who liked a post
-    db = get_db()
-    users = db.execute(
-        'SELECT u.id, name, email, phone, occupation, type'
-        ' FROM like l JOIN user u ON l.user_id = u.id'
-        ' WHERE l.post_id = ?'
-        ' ORDER BY created DESC', (post_id,)
-    ).fetchall()
-
-    # Convert type Row to tuple to avoid datatype Row not serializable error
-    users = [tuple(user) for user in users]
-    return users
+    return queries.fetch_all('like.users', (post_id,))
+
+
+def get_like_summaries(post_ids):
+    # Gets the number of likes and the names of the two most recent likers of every post in post_ids.
+    # Returns a dict mapping a post id to a tuple (count, names). Posts with no likes are not in the dict.
+    # The count is read from like_count and only two likes per post are read, in one query for the whole list
+    # instead of one query per post.
+    summaries = {}
+    for post_id, like_count, name in queries.fetch_all('like.summaries', (json.dumps(list(post_ids)),)):
+        summaries.setdefault(post_id, (like_count, []))[1].append(name)
+    return summaries
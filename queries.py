@@ -0,0 +1,219 @@
+# Contains the SQL statements used by the post and user modules, by name
+# Every statement is written once here and run through fetch_one(), fetch_all() or execute(). Because the SQL of a
+# name never changes, sqlite3 prepares it once per pooled connection and reuses it from the connection's statement
+# cache (see SQLITE_CACHED_STATEMENTS in db.py). Rows are returned as the classes in models.py instead of sqlite3.Row,
+# and the calls and time spent per statement are recorded.
+import threading
+import time
+from collections import namedtuple
+from itertools import starmap
+
+from db import get_db
+from models import User, Post, Like, SearchResult
+
+LikeSummaryRow = namedtuple('LikeSummaryRow', 'post_id like_count name')
+
+# A statement and the type of the rows it returns, or None if it does not return rows.
+Statement = namedtuple('Statement', 'sql row_type')
+
+# Condition used by keyset pagination. It selects the posts that come after the post with the given id in
+# (created, id) order, most recent first. The boundary is looked up by primary key so the stored created value is
+# compared exactly as it is saved in the db.
+_AFTER_POST = ' (p.created, p.id) < (SELECT created, id FROM post WHERE id = ?)'
+
+STATEMENTS = {
+    'user.get': Statement(
+        'SELECT id, name, email, phone, occupation, type FROM user WHERE id = ?', User),
+    'user.get_by_email': Statement(
+        'SELECT id, name, email, phone, occupation, type FROM user WHERE email = ? AND type = ?', User),
+    'user.create': Statement(
+        'INSERT INTO user (name, email, phone, occupation, type) VALUES (?, ?, ?, ?, ?)', None),
+    'user.update': Statement(
+        'UPDATE user SET name = ?, phone = ?, occupation = ? WHERE id = ?', None),
+
+    # The feeds read the stored excerpt of each post into Post.body instead of the whole body.
+    'post.homepage': Statement(
+        'SELECT p.id, title, excerpt, created, author_id, name'
+        ' FROM post p JOIN user u ON p.author_id = u.id'
+        ' ORDER BY p.created DESC, p.id DESC'
+        ' LIMIT ? OFFSET ?', Post),
+    'post.homepage_after': Statement(
+        'SELECT p.id, title, excerpt, created, author_id, name'
+        ' FROM post p JOIN user u ON p.author_id = u.id'
+        ' WHERE' + _AFTER_POST +
+        ' ORDER BY p.created DESC, p.id DESC'
+        ' LIMIT ?', Post),
+    'post.user_page': Statement(
+        'SELECT p.id, title, excerpt, created, author_id, name'
+        ' FROM post p JOIN user u ON p.author_id = u.id'
+        ' WHERE p.author_id = ?'
+        ' ORDER BY p.created DESC, p.id DESC'
+        ' LIMIT ? OFFSET ?', Post),
+    'post.user_page_after': Statement(
+        'SELECT p.id, title, excerpt, created, author_id, name'
+        ' FROM post p JOIN user u ON p.author_id = u.id'
+        ' WHERE p.author_id = ? AND' + _AFTER_POST +
+        ' ORDER BY p.created DESC, p.id DESC'
+        ' LIMIT ?', Post),
+    # Every post of an author, in the order of the feeds, for streaming.
+    'post.user_all': Statement(
+        'SELECT p.id, title, excerpt, created, author_id, name'
+        ' FROM post p JOIN user u ON p.author_id = u.id'
+        ' WHERE p.author_id = ?'
+        ' ORDER BY p.created DESC, p.id DESC', Post),
+    'post.export': Statement(
+        'SELECT p.id, title, body, created, author_id, name'
+        ' FROM post p JOIN user u ON p.author_id = u.id'
+        ' ORDER BY p.id', Post),
+    'post.details': Statement(
+        'SELECT p.id, title, body, created, author_id, name'
+        ' FROM post p JOIN user u ON p.author_id = u.id'
+        ' WHERE p.id = ?', Post),
+    'post.version': Statement(
+        'SELECT author_id, version FROM post WHERE id = ?', None),
+    # Posts matching an FTS5 query, best match first. Matches in the title weigh more than matches in the body.
+    # Matches are delimited with the control characters models.SearchResult turns into <mark></mark> once the text
+    # is escaped.
+    'post.search': Statement(
+        'SELECT p.id, highlight(post_fts, 0, char(2), char(3)),'
+        " snippet(post_fts, 1, char(2), char(3), '...', 24), p.created, p.author_id, u.name"
+        ' FROM post_fts JOIN post p ON p.id = post_fts.rowid JOIN user u ON p.author_id = u.id'
+        ' WHERE post_fts MATCH ?'
+        ' ORDER BY bm25(post_fts, 4.0, 1.0), p.id DESC'
+        ' LIMIT ? OFFSET ?', SearchResult),
+    # Ids of the posts that exist among a JSON array of ids.
+    'post.existing': Statement(
+        'SELECT id FROM post WHERE id IN (SELECT value FROM json_each(?))', None),
+    'post.insert': Statement(
+        'INSERT INTO post (author_id, title, excerpt, body) VALUES (?, ?, ?, ?)', None),
+
+    'revision.get': Statement(
+        'SELECT value FROM revision WHERE name = ?', None),
+
+    'refresh_token.get': Statement(
+        'SELECT id, family, user_id, expires, used, revoked FROM refresh_token WHERE token_hash = ?', None),
+    'refresh_token.insert': Statement(
+        'INSERT INTO refresh_token (token_hash, family, user_id, expires) VALUES (?, ?, ?, ?)', None),
+    # Only one request can use a token: the row count is 0 if another one used it first.
+    'refresh_token.use': Statement(
+        'UPDATE refresh_token SET used = 1 WHERE id = ? AND used = 0 AND revoked = 0', None),
+    'refresh_token.revoke_family': Statement(
+        'UPDATE refresh_token SET revoked = 1 WHERE family = ? AND revoked = 0', None),
+    'refresh_token.purge': Statement(
+        'DELETE FROM refresh_token WHERE expires <= ?', None),
+
+    'like.get': Statement(
+        'SELECT post_id, user_id, created FROM like WHERE post_id = ? AND user_id = ?', Like),
+    'like.insert': Statement(
+        'INSERT OR IGNORE INTO like (post_id, user_id) VALUES (?, ?)', None),
+    'like.delete': Statement(
+        'DELETE FROM like WHERE post_id = ? AND user_id = ?', None),
+    'like.users': Statement(
+        'SELECT u.id, name, email, phone, occupation, type'
+        ' FROM like l JOIN user u ON l.user_id = u.id'
+        ' WHERE l.post_id = ?'
+        ' ORDER BY l.created DESC', User),
+    'like.export': Statement(
+        'SELECT post_id, user_id, created FROM like ORDER BY post_id, user_id', Like),
+    # The ids of the posts are given as a JSON array so the statement is the same for any number of posts.
+    # The two latest likes of a post are the last two entries of idx_like_post_created, (post_id, created, user_id),
+    # so they are read from the end of the index without going through the other likes. like is joined by rowid only:
+    # also joining on post_id would make SQLite scan every like of the post and run the subquery for each.
+    'like.summaries': Statement(
+        'SELECT p.id, p.like_count, u.name'
+        ' FROM post p'
+        ' JOIN like l ON l.rowid IN ('
+        '  SELECT rowid FROM like WHERE post_id = p.id ORDER BY created DESC, user_id DESC LIMIT 2)'
+        ' JOIN user u ON l.user_id = u.id'
+        ' WHERE p.id IN (SELECT value FROM json_each(?)) AND p.like_count > 0'
+        ' ORDER BY p.id, l.created DESC, l.user_id DESC', LikeSummaryRow),
+}
+
+# name -> [calls, seconds]
+_stats = {}
+_stats_lock = threading.Lock()
+
+# Functions called with the name and seconds of every statement run, e.g. to count the statements of each request.
+_statement_listeners = []
+
+
+def on_statement(func):
+    # Decorator to register a function to be called with the name and seconds of each statement after it runs.
+    _statement_listeners.append(func)
+    return func
+
+
+def _run(name, params, fetch, seq_of_params=None):
+    # Runs the statement called name and returns fetch(cursor), with the rows made by its row type.
+    # If seq_of_params is given, the statement is run once for each of its items instead of once with params.
+    statement = STATEMENTS[name]
+    start = time.perf_counter()
+    cursor = get_db().cursor()
+    # Plain tuples are the cheapest rows sqlite3 can make; their values are passed straight to the row type.
+    cursor.row_factory = None
+    if seq_of_params is None:
+        cursor.execute(statement.sql, params)
+    else:
+        cursor.executemany(statement.sql, seq_of_params)
+    result = fetch(cursor, statement.row_type)
+    seconds = time.perf_counter() - start
+    with _stats_lock:
+        stats = _stats.setdefault(name, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+    for listener in _statement_listeners:
+        listener(name, seconds)
+    return result
+
+
+def _fetch_one(cursor, row_type):
+    row = cursor.fetchone()
+    if row is None or row_type is None:
+        return row
+    return row_type(*row)
+
+
+def _fetch_all(cursor, row_type):
+    rows = cursor.fetchall()
+    if row_type is None:
+        return rows
+    return list(starmap(row_type, rows))
+
+
+def fetch_one(name, params=()):
+    # Returns the first row of the statement called name, or None if there is none.
+    return _run(name, params, _fetch_one)
+
+
+def fetch_all(name, params=()):
+    # Returns all rows of the statement called name as a list.
+    return _run(name, params, _fetch_all)
+
+
+def execute(name, params=()):
+    # Runs the statement called name, which does not return rows, and returns its cursor. The caller commits.
+    return _run(name, params, lambda cursor, row_type: cursor)
+
+
+def fetch_chunks(name, params=(), size=500):
+    # Yields the rows of the statement called name in lists of up to size rows. Only one list is in memory at a time,
+    # so it can go through any number of rows. The connection must stay open until the last list is read.
+    cursor = _run(name, params, lambda cursor, row_type: cursor)
+    row_type = STATEMENTS[name].row_type
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield rows if row_type is None else list(starmap(row_type, rows))
+
+
+def execute_many(name, seq_of_params):
+    # Runs the statement called name once for each set of parameters in seq_of_params, in one call. The caller
+    # commits. The stats count it as one call.
+    return _run(name, None, lambda cursor, row_type: cursor, seq_of_params)
+
+
+def stats():
+    # Returns the calls and total seconds of each statement, for monitoring.
+    with _stats_lock:
+        return {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in _stats.items()}
@@ -0,0 +1,86 @@
+# Contains the refresh tokens given at login
+# An access token is valid for 60 minutes. Instead of logging in again with Google or Facebook, which takes three
+# calls to the provider, a client exchanges its refresh token at /token/refresh for a new access token and a new
+# refresh token. Every refresh token can be used once. If a used token is sent again, it was stolen or leaked, so
+# every token of its family (all the tokens that come from the same login) is revoked and the user has to log in.
+import hashlib
+import secrets
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+import queries
+from db import get_db
+
+
+def _hash(token):
+    # Only the hash of a token is stored, so the tokens can't be read from the db.
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _ttl():
+    # Seconds a refresh token is valid for. Each exchange gives a token valid for this long again.
+    return current_app.config.get('REFRESH_TOKEN_TTL', 30 * 24 * 3600)
+
+
+def _insert(user_id, family):
+    token = secrets.token_urlsafe(32)
+    queries.execute('refresh_token.insert', (_hash(token), family, user_id, int(time.time()) + _ttl()))
+    return token
+
+
+def issue(user_id):
+    # Returns a new refresh token for a user who just logged in. It starts a new family.
+    token = _insert(user_id, secrets.token_hex(16))
+    get_db().commit()
+    return token
+
+
+def rotate(token):
+    # Exchanges a refresh token for the next one of its family. Returns (user_id, new token), or None if the token is
+    # unknown, expired, revoked or was already used. Using a token twice revokes its whole family.
+    row = queries.fetch_one('refresh_token.get', (_hash(token),))
+    if row is None:
+        return None
+    id_, family, user_id, expires, used, revoked = row
+    if revoked or expires <= time.time():
+        return None
+    if used or queries.execute('refresh_token.use', (id_,)).rowcount == 0:
+        queries.execute('refresh_token.revoke_family', (family,))
+        get_db().commit()
+        return None
+
+    new_token = _insert(user_id, family)
+    get_db().commit()
+    return user_id, new_token
+
+
+def revoke(token):
+    # Revokes a refresh token and every other token of its family, e.g. when the user logs out. Returns False if the
+    # token is unknown.
+    row = queries.fetch_one('refresh_token.get', (_hash(token),))
+    if row is None:
+        return False
+    queries.execute('refresh_token.revoke_family', (row[1],))
+    get_db().commit()
+    return True
+
+
+def purge_expired():
+    # Deletes the expired tokens. Returns how many were deleted.
+    count = queries.execute('refresh_token.purge', (int(time.time()),)).rowcount
+    get_db().commit()
+    return count
+
+
+@click.command('purge-refresh-tokens')
+@with_appcontext
+def purge_refresh_tokens_command():
+    """Delete expired refresh tokens."""
+    click.echo('Deleted {} expired refresh token(s).'.format(purge_expired()))
+
+
+def init_app(app):
+    app.cli.add_command(purge_refresh_tokens_command)
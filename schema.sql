@@ -1,6 +1,11 @@
+DROP TABLE IF EXISTS post_fts;
 DROP TABLE IF EXISTS user;
 DROP TABLE IF EXISTS post;
 DROP TABLE IF EXISTS like;
+DROP TABLE IF EXISTS revision;
+DROP TABLE IF EXISTS import_progress;
+DROP TABLE IF EXISTS import_deferred;
+DROP TABLE IF EXISTS refresh_token;
 
 CREATE TABLE user (
   id INTEGER PRIMARY KEY,
@@ -15,14 +20,144 @@ CREATE TABLE post (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   author_id INTEGER NOT NULL,
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  -- Number of rows in like for this post, kept up to date by the triggers below.
+  -- Run "flask rebuild-like-counts" to recompute it after restoring or editing the like table by hand.
+  like_count INTEGER NOT NULL DEFAULT 0,
+  -- Changes whenever the details or the likes of this post change. Used as ETag.
+  version INTEGER NOT NULL DEFAULT 0,
   title TEXT NOT NULL,
+  -- The first db.EXCERPT_LENGTH (100) characters of body, shown in the feeds. It is set by post.insert_post(), or by
+  -- the triggers below when a post is inserted without it. Run "flask backfill-excerpts" to recompute it.
+  -- The columns read by the feeds come before body: a long body is kept in overflow pages, which would have to be
+  -- read to get to a column stored after it.
+  excerpt TEXT,
   body TEXT NOT NULL,
   FOREIGN KEY (author_id) REFERENCES user (id)
 );
 
+CREATE INDEX idx_post_created ON post (created, id);
+CREATE INDEX idx_post_author_created ON post (author_id, created, id);
+
 CREATE TABLE like (
   post_id INTEGER NOT NULL,
   user_id INTEGER NOT NULL,
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   PRIMARY KEY (post_id, user_id)
-);
\ No newline at end of file
+);
+
+-- Users are looked up by email and type when they log in.
+CREATE INDEX idx_user_email_type ON user (email, type);
+-- Likes of a post are read most recent first, with the user who liked it.
+CREATE INDEX idx_like_post_created ON like (post_id, created, user_id);
+
+CREATE TRIGGER like_count_insert AFTER INSERT ON like
+BEGIN
+  UPDATE post SET like_count = like_count + 1 WHERE id = NEW.post_id;
+END;
+
+CREATE TRIGGER like_count_delete AFTER DELETE ON like
+BEGIN
+  UPDATE post SET like_count = like_count - 1 WHERE id = OLD.post_id;
+END;
+
+-- Version numbers used as ETags. The feed revision changes with every write shown in the feeds, and the version of a
+-- post changes with every write shown on its details and likes. Both are kept up to date by the triggers below.
+CREATE TABLE revision (
+  name TEXT PRIMARY KEY,
+  value INTEGER NOT NULL DEFAULT 0
+);
+INSERT INTO revision (name, value) VALUES ('feed', 0);
+
+CREATE TRIGGER version_post_insert AFTER INSERT ON post
+BEGIN
+  UPDATE revision SET value = value + 1 WHERE name = 'feed';
+END;
+
+CREATE TRIGGER version_like_insert AFTER INSERT ON like
+BEGIN
+  UPDATE post SET version = version + 1 WHERE id = NEW.post_id;
+  UPDATE revision SET value = value + 1 WHERE name = 'feed';
+END;
+
+CREATE TRIGGER version_like_delete AFTER DELETE ON like
+BEGIN
+  UPDATE post SET version = version + 1 WHERE id = OLD.post_id;
+  UPDATE revision SET value = value + 1 WHERE name = 'feed';
+END;
+
+-- Posts show the name of their author and the info of the users who liked them.
+CREATE TRIGGER version_user_update AFTER UPDATE ON user
+BEGIN
+  UPDATE post SET version = version + 1
+  WHERE author_id = NEW.id OR id IN (SELECT post_id FROM like WHERE user_id = NEW.id);
+  UPDATE revision SET value = value + 1 WHERE name = 'feed';
+END;
+
+-- Full-text index of the title and body of posts, kept up to date by the triggers below.
+-- Run "flask rebuild-search-index" to rebuild it after restoring or editing the post table with the triggers off.
+CREATE VIRTUAL TABLE post_fts USING fts5(
+  title, body, content='post', content_rowid='id', tokenize='porter unicode61'
+);
+
+CREATE TRIGGER post_fts_insert AFTER INSERT ON post
+BEGIN
+  INSERT INTO post_fts (rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body);
+END;
+
+CREATE TRIGGER post_fts_delete AFTER DELETE ON post
+BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);
+END;
+
+CREATE TRIGGER post_fts_update AFTER UPDATE OF title, body ON post
+BEGIN
+  INSERT INTO post_fts (post_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);
+  INSERT INTO post_fts (rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body);
+END;
+
+-- The length of the excerpts must be db.EXCERPT_LENGTH.
+CREATE TRIGGER post_excerpt_insert AFTER INSERT ON post WHEN NEW.excerpt IS NULL
+BEGIN
+  UPDATE post SET excerpt = substr(NEW.body, 1, 100) WHERE id = NEW.id;
+END;
+
+CREATE TRIGGER post_excerpt_update AFTER UPDATE OF body ON post
+BEGIN
+  UPDATE post SET excerpt = substr(NEW.body, 1, 100) WHERE id = NEW.id;
+END;
+
+-- Progress of "flask import-data", so an interrupted import resumes after the last committed row.
+CREATE TABLE import_progress (
+  source TEXT NOT NULL,
+  table_name TEXT NOT NULL,
+  rows INTEGER NOT NULL DEFAULT 0,
+  finished INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (source, table_name)
+);
+
+-- Indexes and triggers dropped while an import runs, to be created again when it finishes.
+CREATE TABLE import_deferred (
+  name TEXT PRIMARY KEY,
+  sql TEXT NOT NULL
+);
+
+-- Refresh tokens given at login and exchanged at /token/refresh for new access tokens. Only a hash of each token is
+-- stored. Each exchange marks the token used and issues the next token of its family, the chain of tokens that
+-- started with one login. expires is a Unix time.
+CREATE TABLE refresh_token (
+  id INTEGER PRIMARY KEY,
+  token_hash TEXT NOT NULL UNIQUE,
+  family TEXT NOT NULL,
+  user_id INTEGER NOT NULL,
+  expires INTEGER NOT NULL,
+  used INTEGER NOT NULL DEFAULT 0,
+  revoked INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY (user_id) REFERENCES user (id)
+);
+
+CREATE INDEX idx_refresh_token_family ON refresh_token (family);
+CREATE INDEX idx_refresh_token_user ON refresh_token (user_id);
+
+-- Number of the last file in the migrations folder. The schema above already includes every migration up to it.
+-- Remember to update it when adding a migration.
+PRAGMA user_version = 8;
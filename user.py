@@ -1,60 +1,114 @@
-from db import get_db
+from flask import current_app
+
+import queries
+from cache import TTLCache
+from db import get_db, on_init_db
+
+# Cache of user rows by id and of user ids by email and type. A row is evicted by update() so this process never
+# serves an old row, but other processes serving the app have their own cache, so they may keep serving it for up to
+# USER_CACHE_TTL seconds.
+_cache = TTLCache()
+
+# Functions called with the id of a user after it changes, e.g. to drop copies of it kept elsewhere.
+_change_listeners = []
+
+
+def init_app(app):
+    # Sets up the user cache with the size and ttl in the config.
+    _cache.configure(app.config.get('USER_CACHE_SIZE', 1024), app.config.get('USER_CACHE_TTL', 60))
+
+
+@on_init_db
+def clear_cache():
+    # Removes every user from the cache.
+    _cache.clear()
+
+
+def on_change(func):
+    # Decorator to register a function to be called with the id of a user after update() changes it.
+    _change_listeners.append(func)
+    return func
+
+
+def cache_stats():
+    # Returns the hit, miss and eviction counters of the user cache.
+    return _cache.stats()
+
+
+def _id_key(user_id):
+    # Returns the cache key of a user id, or None if the id is not a number and therefore can't be cached.
+    try:
+        return 'id', current_app.config['DATABASE'], int(user_id)
+    except (TypeError, ValueError):
+        return None
+
+
+def _email_key(email, type_):
+    return 'email', current_app.config['DATABASE'], email, type_
 
 
 def get(user_id):
     # Gets a user from a db given its id
-    db = get_db()
-    user = db.execute(
-        "SELECT * FROM user WHERE id = ?", (user_id,)
-    ).fetchone()
+    key = _id_key(user_id)
+    if key is not None:
+        user = _cache.get(key)
+        if user is not None:
+            return user
+
+    user = queries.fetch_one('user.get', (user_id,))
+    if user is not None and key is not None and user.id == key[2]:
+        _cache.set(key, user)
     return user
 
 
 def get_by_email(email, type_):
     # Gets a user from a db given its email and type
-    db = get_db()
-    user = db.execute(
-        "SELECT * FROM user WHERE email = ? AND type = ?", (email, type_,)
-    ).fetchone()
+    user_id = _cache.get(_email_key(email, type_))
+    if user_id is not None:
+        user = get(user_id)
+        if user is not None:
+            return user
+
+    user = queries.fetch_one('user.get_by_email', (email, type_))
+    if user is not None:
+        _cache.set(_email_key(email, type_), user.id)
+        _cache.set(_id_key(user.id), user)
     return user
 
 
 def create(name, email, phone, occupation, type_):
     # Creates a new user with the provided info and saves to db
-    db = get_db()
-    db.execute(
-        "INSERT INTO user (name, email, phone, occupation, type) "
-        "VALUES (?, ?, ?, ?, ?)",
-        (name, email, phone, occupation, type_),
-    )
-    db.commit()
+    queries.execute('user.create', (name, email, phone, occupation, type_))
+    get_db().commit()
+    _cache.delete(_email_key(email, type_))
 
 
 def update(user_id, name, phone, occupation):
     # Update data of a user in the database with the new values
-    db = get_db()
-    db.execute(
-        "UPDATE user SET name = ?, phone = ?, occupation = ? WHERE id = ?",
-        (name, phone, occupation, user_id),
-    )
-    db.commit()
+    queries.execute('user.update', (name, phone, occupation, user_id))
+    get_db().commit()
+    key = _id_key(user_id)
+    if key is not None:
+        _cache.delete(key)
+        for listener in _change_listeners:
+            listener(key[2])
 
 
-def info_valid(user_id, type_):
-    # Checks if the info of the user with id and type provided is valid. Returns True if it is, False otherwise.
-    db = get_db()
+def has_valid_info(user, type_):
+    # Checks if a user row has the info required for the type provided. Google users need a name and an occupation,
+    # Facebook users need a name and a phone number. Returns True if it does, False otherwise.
+    if not user:
+        return False
     if type_ == 'Google':
-        user = db.execute(
-            "SELECT * FROM user WHERE id = ? AND (name <> '') AND (occupation <> '')", (user_id,)
-        ).fetchone()
+        required = ('name', 'occupation')
     elif type_ == 'Facebook':
-        user = db.execute(
-            "SELECT * FROM user WHERE id = ? AND (name <> '') AND (phone <> '')", (user_id,)
-        ).fetchone()
+        required = ('name', 'phone')
     # Somehow type is neither 'Google' nor 'Facebook'
     else:
-        user = None
+        return False
+    return all(getattr(user, field) is not None and getattr(user, field) != '' for field in required)
+
 
-    if user:
-        return True
-    return False
+def info_valid(user_id, type_):
+    # Checks if the info of the user with id and type provided is valid. Returns True if it is, False otherwise.
+    return has_valid_info(get(user_id), type_)